@@ -1,42 +1,201 @@
 # aiko_diary_report.py 　AI愛子が日報を生成しLINEで送信
+#
+# 1時間ごとに、その時間帯の会話ログを短い要約（時間別要約）にしてローカルに保存しておく。
+# 日報は直近24時間分（最大24件）の時間別要約をまとめ直すだけなので、プロンプトの大きさは会話量に左右されない。
+# 会話ログの読み込みはキャッシュや書き込み待ちの分だけ遅れるので、要約したあとにその時間帯の行が増えていたら要約し直す。
 
 import os
+import re
+import time
 import random
+import logging
+import threading
 from datetime import datetime, timedelta
 import pytz
 from linebot import LineBotApi
 from linebot.models import TextSendMessage
 from company_info_load import get_conversation_log, get_google_sheets_service
 from company_info_save import write_company_info
-from openai_client import client  # OpenAIクライアント
+from local_store import get_connection
+from clients import get_openai_client  # OpenAIクライアント（初回利用時に作る）
+
+# 1回の要約に渡す会話ログの上限文字数。超える時間帯は分割して要約してからまとめる
+HOUR_CHUNK_CHARS = int(os.getenv("REPORT_HOUR_CHUNK_CHARS", "6000"))
+# 時間別要約1件の上限文字数
+PARTIAL_MAX_CHARS = 600
+# 日報に含める、まだ要約していない現在の時間帯の会話の上限文字数
+OPEN_HOUR_MAX_CHARS = 2000
+HOURLY_SUMMARY_INTERVAL = int(os.getenv("REPORT_SUMMARY_INTERVAL", "300"))
+# 要約中のまま止まった時間帯を、別のワーカーが引き継ぐまでの秒数
+STALE_CLAIM_SECONDS = 900
+
+SUMMARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hourly_summary (
+    hour TEXT PRIMARY KEY,
+    summary TEXT,
+    row_count INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+HOUR_KEY_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}")
 
 # JSTを使用
 
 def now_jst():
     return datetime.now(pytz.timezone("Asia/Tokyo"))
 
-def parse_jst(timestamp_str):
-    try:
-        naive_dt = datetime.strptime(timestamp_str, "%Y-%m-%dT%H:%M:%S")
-        return pytz.timezone("Asia/Tokyo").localize(naive_dt)
-    except Exception:
-        return now_jst()
+# 会話ログのタイムスタンプ（JSTのISO形式）から時間帯キー "YYYY-MM-DDTHH" を取り出す。読めなければ空文字
+def hour_key(timestamp_str):
+    key = (timestamp_str or "")[:13]
+    return key if HOUR_KEY_PATTERN.fullmatch(key) else ""
+
+def _summary_db():
+    return get_connection("daily_report", SUMMARY_SCHEMA)
+
+def _chat(prompt):
+    response = get_openai_client().chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "あなたはAIアシスタント愛子です。"},
+            {"role": "user", "content": prompt}
+        ]
+    )
+    return response.choices[0].message.content.strip()
+
+# 直近 hours 時間分の会話を時間帯ごとにまとめる。ログは時刻順なので末尾から遡り、範囲外に出たら止める
+# （日時が空・壊れている行は飛ばすだけで、そこで止めない）
+def group_recent_lines_by_hour(logs, since_key):
+    grouped = {}
+    for log in reversed(logs):
+        if len(log) < 5:
+            continue
+        key = hour_key(log[0])
+        if not key:
+            continue
+        if key < since_key:
+            break
+        grouped.setdefault(key, []).append(f"{log[3]}: {log[4]}")
+    for lines in grouped.values():
+        lines.reverse()
+    return grouped
+
+def _chunk_lines(lines, max_chars):
+    chunks, current, size = [], [], 0
+    for line in lines:
+        if current and size + len(line) > max_chars:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(line[:max_chars])
+        size += len(line)
+    if current:
+        chunks.append(current)
+    return chunks
+
+# 1時間分の会話を要約する。長すぎる場合は分割して要約（map）し、それらをまとめる（reduce）
+def summarize_hour(hour, lines):
+    partials = []
+    for chunk in _chunk_lines(lines, HOUR_CHUNK_CHARS):
+        prompt = (
+            f"以下は{hour}時台の愛子とユーザーの会話ログです。\n"
+            f"どんな仕事や話題があったかを{PARTIAL_MAX_CHARS}文字以内で箇条書きにまとめてください。\n\n"
+            + "\n".join(chunk)
+        )
+        partials.append(_chat(prompt))
+    if len(partials) == 1:
+        return partials[0][:PARTIAL_MAX_CHARS]
+    prompt = (
+        f"以下は{hour}時台の会話ログを分割して要約したものです。\n"
+        f"重複を除いて{PARTIAL_MAX_CHARS}文字以内の箇条書きにまとめ直してください。\n\n"
+        + "\n\n".join(partials)
+    )
+    return _chat(prompt)[:PARTIAL_MAX_CHARS]
+
+# 他のワーカーと重ならないよう、時間帯を「要約中」として確保する。
+# 要約済みでも、そのときより行が増えていれば（遅れて届いた行）要約し直す。前の要約は作り直すまで残す
+def _claim_hour(conn, hour, row_count):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    row = conn.execute("SELECT state, updated_at, row_count FROM hourly_summary WHERE hour = ?", (hour,)).fetchone()
+    claimed = (
+        row is None
+        or (row[0] == "working" and now - row[1] > STALE_CLAIM_SECONDS)
+        or (row[0] == "done" and row[2] < row_count)
+    )
+    if claimed and row is None:
+        conn.execute(
+            "INSERT INTO hourly_summary (hour, summary, row_count, state, updated_at) VALUES (?, NULL, 0, 'working', ?)",
+            (hour, now)
+        )
+    elif claimed:
+        conn.execute("UPDATE hourly_summary SET state = 'working', updated_at = ? WHERE hour = ?", (now, hour))
+    conn.execute("COMMIT")
+    return claimed
+
+# 締まった時間帯（現在の時間帯より前）のうち、まだ要約がないもの・要約後に行が増えたものを要約して保存する
+def summarize_closed_hours():
+    now = now_jst()
+    current_key = now.strftime("%Y-%m-%dT%H")
+    since_key = (now - timedelta(hours=24)).strftime("%Y-%m-%dT%H")
+    grouped = group_recent_lines_by_hour(get_conversation_log(), since_key)
+
+    conn = _summary_db()
+    done = 0
+    for hour in sorted(grouped):
+        if hour >= current_key or not _claim_hour(conn, hour, len(grouped[hour])):
+            continue
+        try:
+            summary = summarize_hour(hour, grouped[hour])
+            conn.execute(
+                "UPDATE hourly_summary SET summary = ?, row_count = ?, state = 'done', updated_at = ? WHERE hour = ?",
+                (summary, len(grouped[hour]), time.time(), hour)
+            )
+            done += 1
+        except Exception as e:
+            logging.error(f"❌ {hour}時台の要約に失敗: {e}")
+            # 前の要約があればそれに戻し、なければ確保を取り消す
+            conn.execute("DELETE FROM hourly_summary WHERE hour = ? AND summary IS NULL", (hour,))
+            conn.execute("UPDATE hourly_summary SET state = 'done' WHERE hour = ?", (hour,))
+    conn.execute("DELETE FROM hourly_summary WHERE hour < ?", ((now - timedelta(days=7)).strftime("%Y-%m-%dT%H"),))
+    return done
+
+def _periodic_hourly_summary(interval):
+    while True:
+        try:
+            summarize_closed_hours()
+        except Exception as e:
+            logging.error(f"❌ 時間別要約エラー: {e}")
+        time.sleep(interval)
+
+def start_hourly_summary_thread(interval=HOURLY_SUMMARY_INTERVAL):
+    thread = threading.Thread(target=lambda: _periodic_hourly_summary(interval), daemon=True)
+    thread.start()
+    return thread
 
 # === AI愛子の日報を生成 ===
 def generate_daily_report():
     now = now_jst()
-    one_day_ago = now - timedelta(hours=24)
+    current_key = now.strftime("%Y-%m-%dT%H")
+    since_key = (now - timedelta(hours=24)).strftime("%Y-%m-%dT%H")
 
-    sheet = get_google_sheets_service()
-    logs = get_conversation_log(sheet)
-    recent_logs = [log for log in logs if len(log) >= 5 and parse_jst(log[0]) > one_day_ago]
+    # 要約がまだない締まった時間帯があれば先に埋める（通常はバックグラウンドで済んでいる）
+    summarize_closed_hours()
+    partials = _summary_db().execute(
+        "SELECT hour, summary FROM hourly_summary WHERE hour >= ? AND hour < ? AND summary IS NOT NULL ORDER BY hour",
+        (since_key, current_key)
+    ).fetchall()
+    open_lines = group_recent_lines_by_hour(get_conversation_log(), current_key).get(current_key, [])
+    open_text = "\n".join(open_lines)[-OPEN_HOUR_MAX_CHARS:]
 
-    if not recent_logs:
+    if not partials and not open_lines:
         return "この24時間で記録された会話が見つかりませんでした。"
 
-    text = "\n".join([f"{log[3]}: {log[4]}" for log in recent_logs])
+    text = "\n\n".join(f"【{hour[-2:]}時台】\n{summary}" for hour, summary in partials)
+    if open_text:
+        text += f"\n\n【{current_key[-2:]}時台（途中）の会話】\n{open_text}"
     prompt = (
-        "以下は愛子とユーザーの会話ログです\n"
+        "以下は愛子とユーザーの会話を1時間ごとにまとめたものです\n"
         "これらをもとに『この24時間でどんな仕事をしたのか』を2000文字以内でまとめてください\n"
         "文体は愛子らしく、口調は柔らかく、わかりやすくしてください\n\n"
         f"{text}"
@@ -58,17 +217,10 @@ def generate_daily_report():
     ending = random.choice(endings)
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたはAIアシスタント愛子です。"},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        summary = response.choices[0].message.content.strip()
+        summary = _chat(prompt)
         date_str = now.strftime("%Y-%m-%d")
         summary_with_ending = f"{summary}\n\n{ending}"
-        write_company_info(sheet, [date_str, summary_with_ending])
+        write_company_info(get_google_sheets_service(), [date_str, summary_with_ending])
         return summary_with_ending
     except Exception as e:
         return f"要約の作成に失敗しました: {e}"
@@ -81,3 +233,9 @@ def send_daily_report(line_bot_api: LineBotApi, user_id: str):
         line_bot_api.push_message(user_id, TextSendMessage(text=message))
     except Exception as e:
         print(f"LINE送信エラー: {e}")
+
+# /daily_report から呼ぶ。作成と送信は裏で行い、呼び出し元はすぐに戻る
+def send_daily_report_in_background(line_bot_api: LineBotApi, user_id: str):
+    thread = threading.Thread(target=send_daily_report, args=(line_bot_api, user_id), daemon=True)
+    thread.start()
+    return thread
@@ -4,6 +4,9 @@ from datetime import datetime, timedelta
 from linebot import LineBotApi
 from linebot.models import TextSendMessage
 import pytz
+from intent_matcher import GREETING_KEYWORDS, scan_intents
+from user_state_store import get_user_state_store
+from line_fanout import fan_out
 
 from company_info_load import (
     get_employee_info,
@@ -16,26 +19,22 @@ from company_info_load import (
     get_google_sheets_service
 )
 
-# ユーザーごとの挨拶履歴を記録する辞書（時刻＋カテゴリ）
-recent_greeting_users = {}
-
 # JST取得関数
 def now_jst():
     return datetime.now(pytz.timezone("Asia/Tokyo"))
 
-# 最近3時間以内に同じカテゴリの挨拶があったかどうか
+# 最近3時間以内に同じカテゴリの挨拶があったかどうか（記録は user_state_store に保存）
 def has_recent_greeting(user_id, category):
-    now = now_jst()
-    record = recent_greeting_users.get(user_id)
+    _, record = get_user_state_store().get(user_id)
     if record:
         last_time, last_category = record
-        if (now - last_time).total_seconds() < 3 * 3600 and last_category == category:
+        if now_jst().timestamp() - last_time < 3 * 3600 and last_category == category:
             return True
     return False
 
 # 挨拶の時刻とカテゴリを記録
 def record_greeting_time(user_id, timestamp, category):
-    recent_greeting_users[user_id] = (timestamp, category)
+    get_user_state_store().set_greeting(user_id, timestamp.timestamp(), category)
 
 # 時間帯に応じた挨拶
 def get_time_based_greeting(user_id=None):
@@ -55,40 +54,40 @@ def get_time_based_greeting(user_id=None):
             greeting += f"、{name}さん"
     return greeting
 
-# 挨拶と認識される語を正規化
-GREETING_KEYWORDS = [
-    "おはよう", "おっはー", "おは", "おっは", "お早う", "お早うございます",
-    "こんにちは", "こんばんは", "お疲れさま", "おつかれ"
-]
-
+# 挨拶と認識される語を正規化（キーワード一覧は intent_matcher.GREETING_KEYWORDS）
 def normalize_greeting(text):
-    for word in GREETING_KEYWORDS:
-        if word in text:
-            return word[:3]  # カテゴリ例: "おは", "こん", "おつ"
-    if "お疲" in text or "おつかれ" in text:
+    scan = scan_intents(text)
+    words = scan.words("greeting")
+    if words:
+        word = min(words, key=GREETING_KEYWORDS.index)
+        return word[:3]  # カテゴリ例: "おは", "こん", "おつ"
+    if scan.has("greeting_fallback"):
         return "おつ"
     return None
 
 # 挨拶以外の処理系（省略）
 def is_attendance_related(message):
-    return any(kw in message for kw in ["遅刻", "休み", "休暇", "出社", "在宅", "早退"])
+    return scan_intents(message).has("attendance")
 
 def is_topic_changed(message):
-    return any(kw in message for kw in ["やっぱり", "ちなみに", "ところで", "別件", "変更", "違う話"])
+    return scan_intents(message).has("topic_change")
 
-# ユーザー状態のダミー関数群（本番では他モジュールと連携）
+# ユーザー状態（user_state_store に保存）
+# 1回の読み込みで {"step", "target", "fulltext"} をまとめて返す
 def get_user_status(user_id):
-    return {}  # 本番運用時には外部ステータス管理モジュールで上書きされます
+    status, _ = get_user_state_store().get(user_id)
+    return status
 
-def update_user_status(user_id, step):
-    pass
+# 状態遷移ごとに step と付随情報（メール宛先 target、長文応答 fulltext）をまとめて書き換える
+def update_user_status(user_id, step, target=None, fulltext=None):
+    get_user_state_store().set_dialog(user_id, step, target, fulltext)
 
 def reset_user_status(user_id):
-    pass
+    get_user_state_store().reset_dialog(user_id)
 
+# multicastでまとめて送る。送れなかった相手は返り値の FanoutReport.failed に入る
 def forward_message_to_others(api: LineBotApi, from_name: str, message: str, uids: list):
-    for uid in uids:
-        api.push_message(uid, TextSendMessage(text=f"{from_name}さんより: {message}"))
+    return fan_out(api, uids, TextSendMessage(text=f"{from_name}さんより: {message}"))
 
 def get_user_name_for_sheet(user_id):
     return "不明"
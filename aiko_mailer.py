@@ -1,80 +1,226 @@
 # mailer.py　愛子がメールの監視や送受信を賄う関数群
+#
+# 送信はローカルの送信箱（SQLite）に積むだけで、すぐに戻る。
+# 裏のワーカーが1つのGmailクライアントで順に送り、失敗したら間隔を倍々に空けて再送する。
+# 同じ冪等キー（LINEのWebhookイベントIDなど）のメールは2回積まれないので、再配信されても二重に送らない。
 
+import os
+import time
 import base64
+import logging
+import threading
 from email.mime.text import MIMEText
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
-from company_info_load import get_employee_info, get_google_sheets_service
+from company_info_load import get_employee_directory
+from google_clients import register_client, get_client
+from local_store import get_connection
+from metrics import timed
 
 # 認証とGmail API接続
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
 SERVICE_ACCOUNT_FILE = 'credentials.json'
 AIKO_EMAIL = 'aiko.ai@sun-name.com'
+DEFAULT_SUBJECT = "連絡のご案内"
+
+# 送信箱の設定
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+# 1回目の再送までの秒数。以降は倍々（上限 OUTBOX_BACKOFF_MAX）
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "30"))
+OUTBOX_BACKOFF_MAX = 3600.0
+OUTBOX_POLL_INTERVAL = 10.0
+# 送信中のまま止まったメールを、別のワーカーが引き継ぐまでの秒数
+OUTBOX_STALE_SECONDS = 300
+# 送信済み・失敗の記録を残す日数（冪等キーの重複判定もこの期間）
+OUTBOX_KEEP_DAYS = 7
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT UNIQUE,
+    to_email TEXT NOT NULL,
+    cc TEXT,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt_at);
+"""
+
+register_client("gmail", "gmail", "v1", SERVICE_ACCOUNT_FILE, SCOPES, subject=AIKO_EMAIL)
 
 def get_gmail_service():
-    creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    delegated_creds = creds.with_subject(AIKO_EMAIL)
-    return build('gmail', 'v1', credentials=delegated_creds)
+    return get_client("gmail")
 
 # UIDからメールアドレスを検索する補助関数
 def get_user_email_from_uid(uid):
-    sheet_service = get_google_sheets_service()
-    employees = get_employee_info(sheet_service)
-    for emp in employees:
-        if len(emp) >= 12 and emp[11] == uid:  # L列（インデックス11）と一致
-            return emp[9] if len(emp) >= 10 else None  # J列（インデックス9）にメール
-    return None
+    return get_employee_directory().email_for_uid(uid)  # J列にメール
 
 # 下書きの生成（LINE発言者と対象名からメール内容を作成）
 def draft_email_for_user(sender_uid, target_name):
-    sheet_service = get_google_sheets_service()
-    employees = get_employee_info(sheet_service)
-    sender_name = "匿名ユーザー"
-
-    for emp in employees:
-        if len(emp) >= 12 and emp[11] == sender_uid:
-            sender_name = emp[3]
-            break
+    directory = get_employee_directory()
+    sender = directory.by_uid(sender_uid)
+    sender_name = directory.name_of(sender) if sender is not None else "匿名ユーザー"
 
     body = f"{target_name}さん\n\nお疲れさまです。{sender_name}さんからご連絡があります。\n詳細は直接お伝えします。\n\n愛子より"
     return body
 
-# メール送信
-
-def send_email_with_confirmation(sender_uid, to_name, cc=None):
-    sheet_service = get_google_sheets_service()
-    employees = get_employee_info(sheet_service)
-    to_email = None
-    sender_name = "愛子"
+# === 送信箱 ===
+_outbox_wakeup = threading.Event()
+_outbox_thread = None
+_outbox_lock = threading.Lock()
+_outbox_stats = {"queued": 0, "duplicates": 0, "sent": 0, "retried": 0, "failed": 0}
 
-    # 宛先メール取得
-    for emp in employees:
-        if len(emp) >= 10 and emp[3] == to_name:
-            to_email = emp[9]  # J列
-        if len(emp) >= 12 and emp[11] == sender_uid:
-            sender_name = emp[3]
+def _outbox_db():
+    return get_connection("mail_outbox", OUTBOX_SCHEMA)
 
-    if not to_email:
-        print(f"✉️ {to_name}のメールアドレスが見つかりませんでした")
-        return
+# 送信箱に積む。同じ冪等キーのメールがすでにあれば積まずに False を返す
+def enqueue_email(to_email, subject, body, cc=None, idempotency_key=None):
+    now = time.time()
+    cursor = _outbox_db().execute(
+        "INSERT OR IGNORE INTO outbox (idempotency_key, to_email, cc, subject, body, state, next_attempt_at, created_at, updated_at)"
+        " VALUES (?, ?, ?, ?, ?, 'pending', ?, ?, ?)",
+        (idempotency_key, to_email, cc, subject, body, now, now, now)
+    )
+    queued = cursor.rowcount == 1
+    with _outbox_lock:
+        _outbox_stats["queued" if queued else "duplicates"] += 1
+    if queued:
+        start_mail_outbox()
+        _outbox_wakeup.set()
+    else:
+        print(f"✉️ 同じメールは送信済みまたは送信待ちです: {idempotency_key}")
+    return queued
 
-    body = f"{to_name}さん\n\nお疲れさまです。{sender_name}さんからご連絡があります。\n詳細は直接お伝えします。\n\n愛子より"
+# 送る時刻になったメールを1通、送信中にして取り出す（複数ワーカーで重ならないように）
+def _claim_email():
+    conn = _outbox_db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT id, to_email, cc, subject, body, attempts FROM outbox"
+            " WHERE (state = 'pending' AND next_attempt_at <= ?) OR (state = 'sending' AND updated_at <= ?)"
+            " ORDER BY next_attempt_at LIMIT 1",
+            (now, now - OUTBOX_STALE_SECONDS)
+        ).fetchone()
+        if row:
+            conn.execute("UPDATE outbox SET state = 'sending', updated_at = ? WHERE id = ?", (now, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row
 
+@timed("gmail.send")
+def _send_via_gmail(to_email, cc, subject, body):
     message = MIMEText(body)
     message['to'] = to_email
     message['from'] = AIKO_EMAIL
-    message['subject'] = "連絡のご案内"
+    message['subject'] = subject
     if cc:
         message['cc'] = cc
-
     raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    body = {'raw': raw}
+    get_gmail_service().users().messages().send(userId='me', body={'raw': raw}).execute()
+
+def _deliver(row):
+    email_id, to_email, cc, subject, body, attempts = row
+    conn = _outbox_db()
+    try:
+        _send_via_gmail(to_email, cc, subject, body)
+    except Exception as e:
+        attempts += 1
+        now = time.time()
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            conn.execute(
+                "UPDATE outbox SET state = 'failed', attempts = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                (attempts, str(e), now, email_id)
+            )
+            logging.error(f"❌ メール送信失敗（{attempts}回目・あきらめます）: {to_email}: {e}")
+            with _outbox_lock:
+                _outbox_stats["failed"] += 1
+        else:
+            delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)))
+            conn.execute(
+                "UPDATE outbox SET state = 'pending', attempts = ?, last_error = ?, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+                (attempts, str(e), now + delay, now, email_id)
+            )
+            logging.warning(f"⚠️ メール送信失敗（{attempts}回目・{delay:.0f}秒後に再送）: {to_email}: {e}")
+            with _outbox_lock:
+                _outbox_stats["retried"] += 1
+        return
+    conn.execute(
+        "UPDATE outbox SET state = 'sent', attempts = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+        (attempts + 1, time.time(), email_id)
+    )
+    print(f"✅ メール送信成功: {to_email}")
+    with _outbox_lock:
+        _outbox_stats["sent"] += 1
+
+# 送る時刻になったメールをすべて送る。送った（試した）件数を返す
+def process_outbox():
+    count = 0
+    while True:
+        row = _claim_email()
+        if row is None:
+            break
+        _deliver(row)
+        count += 1
+    _outbox_db().execute(
+        "DELETE FROM outbox WHERE state IN ('sent', 'failed') AND updated_at < ?",
+        (time.time() - OUTBOX_KEEP_DAYS * 86400,)
+    )
+    return count
+
+def _run_outbox():
+    while True:
+        try:
+            process_outbox()
+        except Exception as e:
+            logging.error(f"❌ 送信箱ワーカーエラー: {e}")
+        _outbox_wakeup.wait(OUTBOX_POLL_INTERVAL)
+        _outbox_wakeup.clear()
+
+# 起動時に呼べば、前回送れずに残ったメールも送る
+def start_mail_outbox():
+    global _outbox_thread
+    if _outbox_thread is not None:
+        return
+    with _outbox_lock:
+        if _outbox_thread is None:
+            _outbox_thread = threading.Thread(target=_run_outbox, name="mail-outbox", daemon=True)
+            _outbox_thread.start()
 
+def get_outbox_stats():
+    with _outbox_lock:
+        stats = dict(_outbox_stats)
     try:
-        service = get_gmail_service()
-        service.users().messages().send(userId='me', body=body).execute()
-        print(f"✅ メール送信成功: {to_email}")
+        stats["by_state"] = dict(_outbox_db().execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall())
     except Exception as e:
-        print(f"❌ メール送信失敗: {e}")
+        logging.error(f"❌ 送信箱の集計に失敗: {e}")
+    return stats
+
+# メール送信（送信箱に積むだけ）。宛先が見つからなければ False
+# idempotency_key には、再配信されても変わらない値（LINEのWebhookイベントIDなど）を渡す
+def send_email_with_confirmation(sender_uid, to_name, cc=None, body=None, idempotency_key=None):
+    directory = get_employee_directory()
+    sender_name = "愛子"
+
+    # 宛先メール取得（名前・呼び名・メールアドレスのどれでも可）
+    recipient = directory.lookup(to_name)
+    to_email = directory.email_of(recipient) if recipient is not None else None
+    sender = directory.by_uid(sender_uid)
+    if sender is not None:
+        sender_name = directory.name_of(sender)
+
+    if not to_email:
+        print(f"✉️ {to_name}のメールアドレスが見つかりませんでした")
+        return False
+
+    if body is None:
+        body = f"{to_name}さん\n\nお疲れさまです。{sender_name}さんからご連絡があります。\n詳細は直接お伝えします。\n\n愛子より"
+    enqueue_email(to_email, DEFAULT_SUBJECT, body, cc=cc, idempotency_key=idempotency_key)
+    return True
@@ -2,88 +2,69 @@
 
 import os
 import time
-import re
 import datetime
-import requests
 import threading
-from bs4 import BeautifulSoup
-from company_info_load import (
-    get_user_callname_from_uid,
-    load_all_user_ids,
-    get_conversation_log,
-    get_google_sheets_service
+from company_info_load import get_user_callname_from_uid
+from company_info_save import write_company_info
+from conversation_history import (
+    follow_conversation_log, add_row_listener,
+    get_user_history, get_global_history
+)
+from clients import get_openai_client, get_sheets_service
+from metrics import timed
+from intent_matcher import scan_intents
+from site_crawler import crawl_site
+from prompt_builder import (
+    get_background_snapshot, build_contextual_messages, record_prompt_usage,
+    count_tokens, fit_text
 )
-from openai_client import client
 
 # Google Sheets
 SPREADSHEET_ID4 = os.getenv('SPREADSHEET_ID4')
-sheet_service = get_google_sheets_service()
 
-user_conversation_cache = {}
-full_conversation_cache = []
+# サイト変更の要約1回に渡す変更部分の上限トークン数と、要約の最大回数
+SITE_DIFF_TOKEN_BUDGET = int(os.getenv("SITE_DIFF_TOKEN_BUDGET", "3000"))
+SITE_DIFF_MAX_BATCHES = int(os.getenv("SITE_DIFF_MAX_BATCHES", "5"))
+SITE_CHANGE_URLS_MAX_CHARS = 2000
 
-IMPORTANT_PATTERNS = [
-    "重要", "緊急", "至急", "要確認", "トラブル", "対応して", "すぐに", "大至急"
-]
+# 会話ログの差分を読みに行く間隔（秒）。書き込みは write_conversation_log から即時に反映される
+CONVERSATION_FOLLOW_INTERVAL = int(os.getenv("CONVERSATION_FOLLOW_INTERVAL", "30"))
 
 
 def is_important_message(text):
-    pattern = "|".join(map(re.escape, IMPORTANT_PATTERNS))
-    return re.search(pattern, text, re.IGNORECASE) is not None
+    return scan_intents(text).has("important")
 
 
 def clean_log_message(text):
-    patterns = [
-        "覚えてください", "覚えて", "おぼえておいて", "覚えてね",
-        "記録して", "メモして", "忘れないで", "記憶して",
-        "保存して", "記録お願い", "記録をお願い"
-    ]
-    pattern = "|".join(map(re.escape, patterns))
-    return re.sub(pattern, "", text, flags=re.IGNORECASE).strip()
+    return scan_intents(text).remove("memory_command").strip()
 
 
 def store_important_message_to_company_info(message, user_id):
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
     callname = get_user_callname_from_uid(user_id) or "不明"
-    row_data = [["", message, "", "愛子", "", "", "", now, 1, callname, "全員"]]
-    sheet_service.spreadsheets().values().append(
-        spreadsheetId=SPREADSHEET_ID4,
-        range="会社情報!A2",
-        valueInputOption="USER_ENTERED",
-        insertDataOption="INSERT_ROWS",
-        body={"values": row_data}
-    ).execute()
+    write_company_info(get_sheets_service(), ["", message, "", "愛子", "", "", "", now, 1, callname, "全員"])
 
 
-def cache_all_user_conversations():
-    logs = get_conversation_log()
-    all_user_ids = load_all_user_ids()
+# このプロセスで書き込んだ会話のうち、重要なものを会社情報に残す（1行につき1回だけ）
+def _store_if_important(row, local):
+    if local and is_important_message(row[4]):
+        store_important_message_to_company_info(clean_log_message(row[4]), row[1])
 
-    global full_conversation_cache
-    full_conversation_cache = []
 
-    for log in logs[-100:]:
-        if len(log) > 4:
-            speaker = log[3]
-            message = clean_log_message(log[4])
-            flag = " [重要]" if is_important_message(message) else ""
-            full_conversation_cache.append(f"{speaker}: {message}{flag}")
-            if is_important_message(message):
-                store_important_message_to_company_info(message, log[1])
+add_row_listener(_store_if_important)
 
-    for user_id in all_user_ids:
-        user_logs = [
-            f"{log[3]}: {clean_log_message(log[4])}{' [重要]' if is_important_message(log[4]) else ''}"
-            for log in logs if len(log) > 4 and log[1] == user_id
-        ][-20:]
-        user_conversation_cache[user_id] = "\n".join(user_logs)
 
-    print("🧠 会話キャッシュを更新しました")
+# 会話ログの増えた行だけを取り込む（初回は全件）
+def cache_all_user_conversations():
+    added = follow_conversation_log()
+    if added:
+        print(f"🧠 会話キャッシュを更新しました（{added}件追加）")
 
 
-def start_cache_thread():
-    thread = threading.Thread(target=lambda: periodic_cache_update(600), daemon=True)
+def start_cache_thread(interval=CONVERSATION_FOLLOW_INTERVAL):
+    thread = threading.Thread(target=lambda: periodic_cache_update(interval), daemon=True)
     thread.start()
+    return thread
 
 
 def periodic_cache_update(interval):
@@ -92,108 +73,115 @@ def periodic_cache_update(interval):
         time.sleep(interval)
 
 
+@timed("generate_contextual_reply")
 def generate_contextual_reply(user_id, user_message):
-    user_context = user_conversation_cache.get(user_id, "")
-    others_context = "\n".join(full_conversation_cache)
-    prompt = (
-        "あなたは社内専用のAIアシスタント愛子です。従業員には情報をすべて開示しなさい。\n"
-        "以下はこのユーザーとの直近の会話と、社内で交わされた他の会話の記録です。文脈を踏まえて、自然に応答してください。\n"
-        f"【このユーザーの履歴】\n{user_context}\n\n"
-        f"【他の人の話題や社内背景】\n{others_context}\n\n"
-        f"ユーザーの入力: {user_message}"
-    )
+    # 社内背景は一定時間ごとにだけ作り直し、プロンプトの先頭をそろえてキャッシュを効かせる
+    background = get_background_snapshot(get_global_history)
+    messages = build_contextual_messages(background, get_user_history(user_id), user_message)
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたはAIアシスタント愛子です。"},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        with timed("openai.generate_contextual_reply"):
+            response = get_openai_client().chat.completions.create(
+                model="gpt-4o",
+                messages=messages
+            )
+        record_prompt_usage(response)
         return response.choices[0].message.content.strip()
     except Exception as e:
         return f"[応答失敗]: {e}"
 
 
-def get_existing_links():
-    result = sheet_service.spreadsheets().values().get(
-        spreadsheetId=SPREADSHEET_ID4,
-        range="会社情報!F2"
-    ).execute()
-    values = result.get("values", [])
-    return values[0][0] if values else ""
-
-
-def update_links_and_log_diff(new_links_text, diff_summary):
+# 会社情報!G 列以降に、日時・要約・変更ページ数・変更ページのURLだけを追記する（サイト本文はシートに置かない）
+def record_site_changes(page_diffs, diff_summary):
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-    sheet_service.spreadsheets().values().update(
-        spreadsheetId=SPREADSHEET_ID4,
-        range="会社情報!F2",
-        valueInputOption="USER_ENTERED",
-        body={"values": [[new_links_text]]}
-    ).execute()
-    sheet_service.spreadsheets().values().append(
+    urls = "\n".join(url for url, _ in page_diffs)
+    get_sheets_service().append(
         spreadsheetId=SPREADSHEET_ID4,
         range="会社情報!G2",
         valueInputOption="USER_ENTERED",
         insertDataOption="INSERT_ROWS",
-        body={"values": [[now, diff_summary]]}
+        body={"values": [[now, diff_summary, len(page_diffs), urls[:SITE_CHANGE_URLS_MAX_CHARS]]]}
     ).execute()
 
 
 def crawl_all_pages(base_url):
     try:
-        response = requests.get(base_url)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
-        links = [a["href"] for a in soup.find_all("a", href=True) if base_url in a["href"]]
-        unique_links = sorted(set(links))
-        all_content = ""
-        for link in unique_links:
-            try:
-                page = requests.get(link)
-                page.raise_for_status()
-                page_text = BeautifulSoup(page.text, "html.parser").get_text().strip()
-                all_content += f"\n\n--- {link} ---\n{page_text}"
-            except Exception as e:
-                print(f"❌ {link} 読み込み失敗: {e}")
-                continue
-        return all_content
+        return crawl_site(base_url).combined_text()
     except Exception as e:
         return f"[巡回エラー]: {e}"
 
 
-def summarize_diff(old_text, new_text):
-    prompt = (
-        "以下はWebページの古い内容と新しい内容です。何が変更されたかを簡潔に日本語で要約してください。\n"
-        "---古い内容---\n"
-        f"{old_text[:3000]}\n"
-        "---新しい内容---\n"
-        f"{new_text[:3000]}"
+# 変更部分（hunk）を、1回の要約に渡す上限トークン数ごとにまとめる。大きすぎるhunkは切り詰める
+def batch_diff_hunks(page_diffs, budget=SITE_DIFF_TOKEN_BUDGET):
+    batches, current, used = [], [], 0
+    for url, hunks in page_diffs:
+        for hunk in hunks:
+            text = fit_text(f"--- {url} ---\n{hunk}", budget)
+            tokens = count_tokens(text)
+            if current and used + tokens > budget:
+                batches.append(current)
+                current, used = [], 0
+            current.append(text)
+            used += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _summarize(prompt):
+    response = get_openai_client().chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "あなたは変更点を要約するアシスタントです。"},
+            {"role": "user", "content": prompt}
+        ]
     )
+    return response.choices[0].message.content.strip()
+
+
+# ページごとの unified diff の変更部分だけを要約する。要約は最大 SITE_DIFF_MAX_BATCHES 回まで
+def summarize_diff(page_diffs):
+    batches = batch_diff_hunks(page_diffs)
+    skipped = sum(len(batch) for batch in batches[SITE_DIFF_MAX_BATCHES:])
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたは変更点を要約するアシスタントです。"},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return response.choices[0].message.content.strip()
+        partials = [
+            _summarize(
+                "以下はWebサイトの各ページの変更部分（unified diff。-は削除、+は追加）です。"
+                "何が変更されたかを簡潔に日本語で要約してください。\n\n" + "\n\n".join(batch)
+            )
+            for batch in batches[:SITE_DIFF_MAX_BATCHES]
+        ]
+        if len(partials) > 1:
+            summary = _summarize(
+                "以下はWebサイトの変更点を分割して要約したものです。重複を除いて簡潔にまとめ直してください。\n\n"
+                + "\n\n".join(partials)
+            )
+        else:
+            summary = partials[0] if partials else ""
     except Exception as e:
         return f"[要約失敗]: {e}"
+    if skipped:
+        summary += f"\n（ほか{skipped}か所の変更は要約していません）"
+    return summary
 
 
 def check_full_site_update():
     print("🌐 サイト全体の巡回を開始します...")
     base_url = "https://sun-name.com/"
-    new_content = crawl_all_pages(base_url)
-    old_content = get_existing_links()
-
-    if new_content.strip() != old_content.strip():
-        diff_summary = summarize_diff(old_content, new_content)
-        update_links_and_log_diff(new_content, diff_summary)
-        print("✅ 差分あり：更新・記録しました")
+    try:
+        result = crawl_site(base_url)
+    except Exception as e:
+        print(f"❌ 巡回エラー: {e}")
+        return
+
+    if result.first_run:
+        # 比べる前回の内容がないので、ページを保存するだけにする
+        print(f"📥 初回巡回：{len(result.pages)}ページを保存しました")
+        return
+    page_diffs = result.page_diffs()
+    if page_diffs:
+        diff_summary = summarize_diff(page_diffs)
+        record_site_changes(page_diffs, diff_summary)
+        print(f"✅ 差分あり：{len(page_diffs)}ページの変更を記録しました")
     else:
         print("変化なし：更新はありませんでした。")
 
@@ -0,0 +1,81 @@
+# bench_google_clients.py　Sheetsクライアント取得1回あたりのコスト比較
+#
+# 旧方式（毎回 鍵ファイル読込 + discovery.build）と google_clients の登録簿を比べる。
+# 使い捨てのサービスアカウント鍵を生成するので、本物の認証情報もネットワークも不要。
+#
+#   python benchmarks/bench_google_clients.py [--iterations 200]
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import rsa
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+
+import google_clients
+
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+
+
+def write_dummy_key(path):
+    _, private_key = rsa.newkeys(1024)
+    info = {
+        "type": "service_account",
+        "project_id": "bench",
+        "private_key_id": "bench",
+        "private_key": private_key.save_pkcs1().decode(),
+        "client_email": "bench@bench.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": "https://oauth2.googleapis.com/token",
+    }
+    with open(path, "w") as f:
+        json.dump(info, f)
+
+
+# 変更前の get_google_sheets_service と同じ処理
+def legacy_values(key_file):
+    credentials = service_account.Credentials.from_service_account_file(key_file, scopes=SCOPES)
+    service = build("sheets", "v4", credentials=credentials, static_discovery=True)
+    return service.spreadsheets().values()
+
+
+def registry_values():
+    return google_clients.SheetValuesProxy("bench_sheets")
+
+
+def measure(label, fn, iterations):
+    # どちらも「クライアントを得てリクエストを1件組み立てる」までを測る（送信はしない）
+    fn().get(spreadsheetId="bench", range="A1:B2")
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn().get(spreadsheetId="bench", range="A1:B2")
+    per_call_ms = (time.perf_counter() - start) * 1000 / iterations
+    print(f"{label:<10} {per_call_ms:9.3f} ms/回")
+    return per_call_ms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        key_file = os.path.join(tmp, "key.json")
+        write_dummy_key(key_file)
+        google_clients.register_client("bench_sheets", "sheets", "v4", key_file, SCOPES)
+
+        legacy = measure("旧方式", lambda: legacy_values(key_file), args.iterations)
+        pooled = measure("登録簿", registry_values, args.iterations)
+
+    print(f"短縮率     {legacy / pooled:9.1f} 倍")
+    print(f"内訳       {google_clients.get_client_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# bench_intent_matcher.py　キーワード判定の新旧比較
+#
+# 旧方式（関数ごとに文を走査し、正規表現も呼び出しのたびに組み立てる）と
+# intent_matcher のオートマトン1回走査を、同じ合成メッセージで比べる。
+#
+#   python benchmarks/bench_intent_matcher.py [--messages 20000]
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from intent_matcher import (
+    INTENT_MATCHER, SENSITIVE_KEYWORDS, GREETING_KEYWORDS, ATTENDANCE_KEYWORDS,
+    TOPIC_CHANGE_KEYWORDS, IMPORTANT_PATTERNS, MEMORY_COMMAND_PATTERNS
+)
+
+FILLER = "今日は工場の設備点検があり午後から打ち合わせの予定ですよろしくお願いします"
+
+
+# === 変更前の実装（そのまま移植） ===
+def legacy_contains_sensitive_info(text):
+    pattern = "|".join(map(re.escape, SENSITIVE_KEYWORDS))
+    return re.search(pattern, text, re.IGNORECASE) is not None
+
+
+def legacy_normalize_greeting(text):
+    for word in GREETING_KEYWORDS:
+        if word in text:
+            return word[:3]
+    if "お疲" in text or "おつかれ" in text:
+        return "おつ"
+    return None
+
+
+def legacy_is_attendance_related(message):
+    return any(kw in message for kw in ATTENDANCE_KEYWORDS)
+
+
+def legacy_is_topic_changed(message):
+    return any(kw in message for kw in TOPIC_CHANGE_KEYWORDS)
+
+
+def legacy_is_important_message(text):
+    pattern = "|".join(map(re.escape, IMPORTANT_PATTERNS))
+    return re.search(pattern, text, re.IGNORECASE) is not None
+
+
+def legacy_clean_log_message(text):
+    pattern = "|".join(map(re.escape, MEMORY_COMMAND_PATTERNS))
+    return re.sub(pattern, "", text, flags=re.IGNORECASE).strip()
+
+
+def legacy_all(text):
+    return (
+        legacy_contains_sensitive_info(text), legacy_normalize_greeting(text),
+        legacy_is_attendance_related(text), legacy_is_topic_changed(text),
+        legacy_is_important_message(text), legacy_clean_log_message(text),
+    )
+
+
+def automaton_all(scan):
+    return (
+        scan.has("sensitive"), scan.has("greeting") or scan.has("greeting_fallback"),
+        scan.has("attendance"), scan.has("topic_change"),
+        scan.has("important"), scan.remove("memory_command").strip(),
+    )
+
+
+def make_messages(count, seed=0):
+    rng = random.Random(seed)
+    keywords = (SENSITIVE_KEYWORDS + GREETING_KEYWORDS + ATTENDANCE_KEYWORDS
+                + TOPIC_CHANGE_KEYWORDS + IMPORTANT_PATTERNS + MEMORY_COMMAND_PATTERNS)
+    messages = []
+    for _ in range(count):
+        length = rng.randint(10, 120)
+        start = rng.randint(0, len(FILLER) - 10)
+        text = (FILLER * 4)[start:start + length]
+        for _ in range(rng.randint(0, 3)):
+            position = rng.randint(0, len(text))
+            text = text[:position] + rng.choice(keywords) + text[position:]
+        messages.append(text)
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+    messages = make_messages(args.messages)
+
+    start = time.perf_counter()
+    legacy = [legacy_all(text) for text in messages]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    automaton = [automaton_all(scan) for scan in INTENT_MATCHER.scan_many(messages)]
+    automaton_seconds = time.perf_counter() - start
+
+    mismatches = sum(
+        1 for old, new in zip(legacy, automaton)
+        if (old[0], old[1] is not None, old[2], old[3], old[4]) != new[:5]
+    )
+    print(f"メッセージ数   {len(messages)}")
+    print(f"旧方式         {legacy_seconds * 1e6 / len(messages):8.1f} µs/件")
+    print(f"オートマトン   {automaton_seconds * 1e6 / len(messages):8.1f} µs/件")
+    print(f"短縮率         {legacy_seconds / automaton_seconds:8.1f} 倍")
+    print(f"判定の不一致   {mismatches} 件")
+
+
+if __name__ == "__main__":
+    main()
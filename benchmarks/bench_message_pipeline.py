@@ -0,0 +1,130 @@
+# bench_message_pipeline.py　handle_message_logic の応答までの時間（順番に実行 vs ステージ並列）
+#
+# 分類・名前確認・会話ログ書き込み・応答生成・LINE応答を、それぞれ決まった時間だけ待つ偽物に差し替えて、
+# 旧来の順番どおりの処理と、今の handle_message_logic で「LINEへ応答するまで」の時間を比べる。
+# OpenAI・Sheets・LINEには接続しない。
+#
+#   python benchmarks/bench_message_pipeline.py [--messages 5]
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("AIKO_DATA_DIR", tempfile.mkdtemp(prefix="aiko-bench-"))
+
+import handle_message_logic as logic
+from stage_executor import get_stage_stats
+
+# 各処理にかかる時間（秒）。実運用で観測した程度の値
+DELAYS = {
+    "classify": 0.6,
+    "lookup": 0.02,
+    "write_log": 0.15,
+    "generate": 0.8,
+    "line_reply": 0.1,
+}
+USER_ID = "Ubench"
+
+
+def slow(name, value=None):
+    def fn(*args, **kwargs):
+        time.sleep(DELAYS[name])
+        return value
+    return fn
+
+
+# 応答キャッシュは使わない（毎回応答を生成したときの時間を測る）
+class NoResponseCache:
+    def get(self, scope, message):
+        return None
+
+    def put(self, scope, message, reply):
+        pass
+
+
+class FakeLineBotApi:
+    def __init__(self):
+        self.replied_at = None
+
+    def reply_message(self, reply_token, message):
+        time.sleep(DELAYS["line_reply"])
+        self.replied_at = time.perf_counter()
+
+
+def install_fakes():
+    logic.classify_conversation_category = slow("classify", "日常会話")
+    logic.get_user_callname_from_uid = slow("lookup", "ベンチさん")
+    logic.load_all_user_ids = lambda: [USER_ID]
+    logic.is_registered_user = lambda user_id: user_id == USER_ID
+    logic.get_user_status = lambda user_id: {"step": 0}
+    logic.write_conversation_log = slow("write_log")
+    logic.generate_contextual_reply = slow("generate", "了解です。")
+    logic.get_employee_info = lambda sheet_service=None: []
+    logic.contains_sensitive_info = lambda message: False
+    logic.normalize_greeting = lambda message: None
+    logic.is_attendance_related = lambda message: False
+    logic.is_topic_changed = lambda message: False
+    logic.get_response_cache = NoResponseCache
+
+
+def make_event(text):
+    return SimpleNamespace(
+        source=SimpleNamespace(user_id=USER_ID),
+        message=SimpleNamespace(text=text),
+        reply_token="bench-token",
+    )
+
+
+# 変更前と同じ順番：分類 → ログ → 登録確認 → 名前 → 応答生成 → ログ → LINE応答
+def legacy_handle(event, api):
+    user_message = event.message.text
+    category = logic.classify_conversation_category(user_message)
+    user_name = logic.get_user_callname_from_uid(USER_ID)
+    logic.write_conversation_log(None, "", USER_ID, user_name, "ユーザー", user_message, category, "テキスト", "未設定", "OK")
+    registered = USER_ID in logic.load_all_user_ids()
+    found = logic.search_employee_info_by_keywords(user_message, logic.get_employee_info())
+    reply = found or logic.generate_contextual_reply(USER_ID, user_message) if registered else ""
+    logic.write_conversation_log(None, "", USER_ID, "愛子", "愛子", reply, "通常応答", "テキスト", "AI応答", "OK")
+    api.reply_message(event.reply_token, reply)
+
+
+def measure(label, handle, messages):
+    latencies = []
+    for i in range(messages):
+        api = FakeLineBotApi()
+        start = time.perf_counter()
+        handle(make_event(f"ベンチ{i}"), api)
+        latencies.append((api.replied_at - start) * 1000)
+    average = sum(latencies) / len(latencies)
+    print(f"{label:<10} 応答まで平均 {average:7.1f} ms")
+    return average
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5)
+    args = parser.parse_args()
+
+    # 従業員検索の「見つかりませんでした」の警告で出力が埋もれないようにする
+    logging.disable(logging.WARNING)
+    install_fakes()
+    legacy = measure("順番実行", legacy_handle, args.messages)
+    pipelined = measure("ステージ", lambda event, api: logic.handle_message_logic(event, None, api), args.messages)
+    print(f"短縮 {legacy - pipelined:.1f} ms（{legacy / pipelined:.1f}倍）")
+
+    time.sleep(sum(DELAYS.values()) * 2)
+    stats = get_stage_stats()
+    # 従業員情報に当たらないメッセージなので、毎回 generate を通っているはず
+    assert stats["stages"].get("generate", {}).get("count") == args.messages, "generate ステージを通っていない"
+    for name, entry in stats["stages"].items():
+        print(f"  {name:<10} 平均 {entry['avg_ms']:7.1f} ms  ({entry['count']}回)")
+
+
+if __name__ == "__main__":
+    main()
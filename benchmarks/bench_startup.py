@@ -0,0 +1,118 @@
+# bench_startup.py　起動時間（import app にかかる時間と、最初の応答までの時間）
+#
+# 毎回新しいPythonプロセスで次を測る。
+#   ・import app にかかる時間と、python -X importtime で見た時間のかかるモジュール（上位 --top 件）
+#   ・起動してから /callback への最初のリクエストに200が返るまでの時間（署名付きの空のWebhook）
+#   ・最初の OpenAI クライアント作成にかかる時間（openai の import を含む）
+# 起動後のクライアント事前作成（CLIENT_WARMUP）は止めて、import と遅延作成の時間をそれぞれ測る。
+# 環境変数はダミーを入れるので、OpenAI・Sheets・LINEには接続しない（Sheetsの認証エラーがログに出るのは想定どおり）。
+#
+#   python benchmarks/bench_startup.py [--runs 3] [--top 15] [--repo パス]
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+CHANNEL_SECRET = "bench-secret"
+
+# 子プロセスで実行する。結果は最後の行に JSON で出す
+CHILD = r"""
+import sys, time, json, hmac, base64, hashlib
+started = time.perf_counter()
+sys.path.insert(0, REPO)
+import app
+imported = time.perf_counter()
+
+body = json.dumps({"destination": "Ubench", "events": []})
+signature = base64.b64encode(hmac.new(SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+response = app.app.test_client().post("/callback", data=body, headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+responded = time.perf_counter()
+
+heavy = [name for name in ("openai", "bs4", "googleapiclient", "tiktoken") if name in sys.modules]
+if CREATE_CLIENT:
+    try:
+        from clients import get_openai_client
+        get_openai_client()
+    except ImportError:
+        # 変更前のチェックアウト（import時にクライアントを作る）
+        from openai_client import client
+client_ready = time.perf_counter()
+
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_response_ms": (responded - started) * 1000,
+    "status": response.status_code,
+    "openai_client_ms": (client_ready - responded) * 1000,
+    "loaded_at_startup": heavy,
+}))
+"""
+
+
+def child_env():
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "bench",
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench",
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "AIKO_DATA_DIR": tempfile.mkdtemp(prefix="aiko-bench-"),
+        "CLIENT_WARMUP": "0",
+    })
+    return env
+
+
+def run_child(repo, importtime=False):
+    # importtime の表には起動時の import だけを出したいので、そのときはクライアントを作らない
+    code = f"REPO = {repo!r}\nSECRET = {CHANNEL_SECRET!r}\nCREATE_CLIENT = {not importtime!r}\n" + CHILD
+    args = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    proc = subprocess.run(args, cwd=tempfile.gettempdir(), env=child_env(), capture_output=True, text=True, timeout=120)
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        raise RuntimeError(proc.stderr[-2000:])
+    return json.loads(lines[-1]), proc.stderr
+
+
+# -X importtime の出力（"import time: 自身us | 累計us | モジュール名"）から、累計時間の大きいものを返す。
+# 深い階層まで並べると同じ時間が何度も出るので、トップレベルとその直下（字下げ1段）のモジュールだけを見る。
+# 起動時に始まるスレッドの import もトップレベルとして混ざる
+def parse_importtime(stderr, top):
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            rows.append((int(cumulative_us) / 1000, int(self_us) / 1000, name.strip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--repo", default=REPO, help="測るリポジトリ（変更前のチェックアウトとの比較用）")
+    args = parser.parse_args()
+
+    results = [run_child(args.repo)[0] for _ in range(args.runs)]
+    for key, label in (("import_ms", "import app"), ("first_response_ms", "最初の応答まで"),
+                       ("openai_client_ms", "OpenAIクライアント作成")):
+        values = sorted(result[key] for result in results)
+        print(f"{label:<22} 中央値 {values[len(values) // 2]:7.1f} ms  (最小 {values[0]:.1f} / 最大 {values[-1]:.1f})")
+    print(f"起動時に読み込まれた重いモジュール: {results[0]['loaded_at_startup'] or 'なし'}")
+    if any(result["status"] != 200 for result in results):
+        print(f"⚠️ /callback が200以外を返しました: {[result['status'] for result in results]}")
+
+    _, stderr = run_child(args.repo, importtime=True)
+    print(f"\nimport にかかった時間の大きいモジュール（python -X importtime、上位{args.top}件）")
+    print(f"{'累計ms':>9} {'自身ms':>9}  モジュール")
+    for cumulative, self_ms, name in parse_importtime(stderr, args.top):
+        print(f"{cumulative:9.1f} {self_ms:9.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
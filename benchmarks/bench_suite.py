@@ -0,0 +1,233 @@
+# bench_suite.py　主要な処理のマイクロベンチマーク（Sheets・OpenAI・LINEは benchmarks/fakes.py の偽物）
+#
+# 従業員情報と会話ログの行数を --sizes（既定 100 / 1000 / 10000）に変えて、次の処理を測る。
+#   ・handle_message_logic            … 1メッセージを受けてLINEへ応答するまで（応答キャッシュは毎回空にする）
+#   ・search_employee_info_by_keywords … 従業員情報の属性検索
+#   ・mask_sensitive_data              … 個人情報のマスク（マスク用の正規表現は作成済みの状態）
+#   ・cache_all_user_conversations     … 会話ログの初回全件取り込み
+#   ・generate_daily_report            … 時間別要約（未作成の状態から）と日報の作成
+# 偽物の待ち時間は --sheet-latency-ms / --llm-latency-ms / --line-latency-ms で変えられる（既定は0で、処理そのものの時間を測る）。
+# 結果は --output に JSON で書き出し、--compare で以前の JSON と比べられる。
+#
+#   python benchmarks/bench_suite.py [--sizes 100,1000,10000] [--iterations 30] [--output result.json] [--compare base.json]
+
+import os
+import io
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("AIKO_DATA_DIR", tempfile.mkdtemp(prefix="aiko-bench-"))
+
+import fakes
+import company_info_load
+import conversation_history
+import handle_message_logic as logic
+from company_info import search_employee_info_by_keywords
+from mask_word import mask_sensitive_data
+from aiko_self_study import cache_all_user_conversations
+from aiko_diary_report import generate_daily_report, now_jst, _summary_db
+from clients import get_sheets_service, get_line_bot_api
+from response_cache import get_response_cache
+from log_writer import flush_log_writer
+
+BENCHMARKS = ["handle_message_logic", "search_employee_info_by_keywords", "mask_sensitive_data",
+              "cache_all_user_conversations", "generate_daily_report"]
+
+
+def reset_state():
+    with company_info_load._snapshot_lock:
+        company_info_load._snapshots.clear()
+    with conversation_history._lock:
+        conversation_history._next_row = conversation_history.FIRST_DATA_ROW
+        conversation_history._user_history.clear()
+        conversation_history._global_history.clear()
+        conversation_history._pending_writes.clear()
+        conversation_history._pending_order.clear()
+    get_response_cache().clear()
+    _summary_db().execute("DELETE FROM hourly_summary")
+
+
+# 行数 rows の偽シートを用意し、キャッシュ類を空にする
+def setup(rows, args):
+    sheets = fakes.FakeSheetValues({
+        "従業員情報": fakes.make_employee_rows(rows),
+        "会話ログ": fakes.make_conversation_rows(rows, rows, now_jst().replace(tzinfo=None)),
+    }, latency=args.sheet_latency_ms / 1000)
+    fakes.install_fakes(
+        sheets,
+        fakes.FakeOpenAI(latency=args.llm_latency_ms / 1000),
+        fakes.FakeLineBotApi(latency=args.line_latency_ms / 1000),
+    )
+    reset_state()
+    return sheets
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    count = len(ordered)
+    return {
+        "iterations": count,
+        "mean_ms": round(sum(ordered) / count, 3),
+        "p50_ms": round(ordered[count // 2], 3),
+        "p95_ms": round(ordered[min(count - 1, int(count * 0.95))], 3),
+        "min_ms": round(ordered[0], 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+# before() は計測の外で毎回呼ぶ準備。--max-seconds を超えたら --iterations に届かなくても打ち切る（最低3回）
+def measure(fn, args, before=None, warmup=True):
+    if warmup:
+        if before:
+            before(-1)
+        fn(-1)
+    samples = []
+    deadline = time.perf_counter() + args.max_seconds
+    for i in range(args.iterations):
+        if before:
+            before(i)
+        started = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - started) * 1000)
+        if len(samples) >= 3 and time.perf_counter() > deadline:
+            break
+    return summarize(samples)
+
+
+def bench_handle_message_logic(rows, args):
+    setup(rows, args)
+    messages = fakes.random_chat_messages(args.iterations + 1, rows, seed=rows)
+    line_bot_api = get_line_bot_api()
+
+    def run(i):
+        event = fakes.make_text_event(fakes.employee_uid(i % rows), messages[i], index=i)
+        logic.handle_message_logic(event, get_sheets_service(), line_bot_api)
+
+    result = measure(run, args, before=lambda i: get_response_cache().clear())
+    flush_log_writer()
+    return result
+
+
+def bench_search_employee_info_by_keywords(rows, args):
+    setup(rows, args)
+    employees = company_info_load.get_employee_info()
+    attributes = ["携帯電話番号", "メールアドレス", "住所", "役職", "性格"]
+
+    def run(i):
+        # 名前は表全体に散らす（後ろの行ほど走査が長い）
+        name = fakes.employee_name((i * 7919) % rows)
+        search_employee_info_by_keywords(f"{name}さんの{attributes[i % len(attributes)]}を教えて", employees)
+
+    return measure(run, args)
+
+
+def bench_mask_sensitive_data(rows, args):
+    setup(rows, args)
+    employees = company_info_load.get_employee_info()
+
+    def run(i):
+        row = employees[(i * 7919) % rows]
+        mask_sensitive_data(f"{row[3]}さんの住所は{row[12]}、携帯は{row[10]}、メールは{row[8]}です。")
+
+    return measure(run, args)
+
+
+def bench_cache_all_user_conversations(rows, args):
+    setup(rows, args)
+
+    def run(i):
+        with contextlib.redirect_stdout(io.StringIO()):
+            cache_all_user_conversations()
+
+    return measure(run, args, before=lambda i: reset_state(), warmup=False)
+
+
+def bench_generate_daily_report(rows, args):
+    setup(rows, args)
+
+    def run(i):
+        generate_daily_report()
+
+    def before(i):
+        _summary_db().execute("DELETE FROM hourly_summary")
+
+    result = measure(run, args, before=before)
+    flush_log_writer()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(entry["benchmark"], entry["rows"]): entry for entry in json.load(f)["results"]}
+    print(f"\n{baseline_path} との比較（p50、1未満なら速くなった）")
+    for entry in results:
+        before = baseline.get((entry["benchmark"], entry["rows"]))
+        if before and before["p50_ms"]:
+            ratio = entry["p50_ms"] / before["p50_ms"]
+            print(f"  {entry['benchmark']:<34} {entry['rows']:>6}行  {before['p50_ms']:9.3f} → {entry['p50_ms']:9.3f} ms  ({ratio:.2f}倍)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100,1000,10000")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--max-seconds", type=float, default=5.0, help="1ケースあたりの計測時間の上限")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="測る処理（カンマ区切り）")
+    parser.add_argument("--sheet-latency-ms", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--line-latency-ms", type=float, default=0.0)
+    parser.add_argument("--output", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--compare", help="比べる以前の結果（--output で書き出した JSON）")
+    args = parser.parse_args()
+
+    # 検索の「見つかりませんでした」などの警告で出力が埋もれないようにする
+    logging.disable(logging.WARNING)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    selected = [name for name in args.only.split(",") if name in BENCHMARKS]
+
+    results = []
+    for rows in sizes:
+        for name in selected:
+            entry = {"benchmark": name, "rows": rows, **globals()[f"bench_{name}"](rows, args)}
+            results.append(entry)
+            print(f"{name:<34} {rows:>6}行  p50 {entry['p50_ms']:9.3f} ms  p95 {entry['p95_ms']:9.3f} ms  ({entry['iterations']}回)")
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": sizes,
+            "iterations": args.iterations,
+            "latency_ms": {"sheets": args.sheet_latency_ms, "llm": args.llm_latency_ms, "line": args.line_latency_ms},
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を {args.output} に書き出しました")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+# fakes.py　ベンチマーク用の Sheets・OpenAI・LINE の偽物（プロセス内で完結、ネットワークに出ない）
+#
+# ・FakeSheetValues: spreadsheets().values() の代わり。get / append が使える。
+#   範囲（"会話ログ!A5:J" など）のシート名と開始行を見て、メモリ上の行を返す・足す
+# ・FakeOpenAI: chat.completions.create の代わり。分類の問い合わせにはカテゴリ名を、それ以外には決まった文を返す
+# ・FakeLineBotApi: reply_message / push_message / multicast の代わり。呼び出しを数えるだけ
+# ・FakeGmail: users().messages().send() の代わり。送った件数を数えるだけ
+# ・どれも呼び出し1回ごとに latency 秒だけ待つ（実際の待ち時間を真似る）
+# ・install_fakes() で、clients / google_clients 経由でアプリ全体がこれらを使うように差し替える
+
+import re
+import time
+import random
+import threading
+from types import SimpleNamespace
+from datetime import timedelta
+
+# 名前の組み合わせ
+SURNAMES = ["佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "山本", "中村", "小林", "加藤",
+            "吉田", "山田", "佐々木", "山口", "松本", "井上", "木村", "林", "斎藤", "清水"]
+GIVEN_NAMES = ["太郎", "花子", "一郎", "美咲", "健太", "陽子", "翔太", "直子", "大輔", "由美",
+               "拓也", "恵子", "誠", "真由美", "亮", "和子", "剛", "智子", "浩二", "裕子"]
+PREFECTURES = ["愛知県名古屋市", "岐阜県岐阜市", "三重県津市", "静岡県浜松市", "東京都港区"]
+CHAT_SAMPLES = [
+    "おはようございます", "今日の会議は何時からですか", "{name}さんの携帯電話番号を教えて",
+    "工場の設備点検は終わりましたか", "覚えておいて：来週は棚卸し", "明日は午後から出張です",
+    "{name}さんのメールアドレスは？", "ありがとう、助かりました", "新しい取引先の件どうなった？",
+]
+RANGE_PATTERN = re.compile(r"^(?P<sheet>[^!]+)!(?P<column>[A-Z]+)(?P<row>\d*)")
+FIRST_DATA_ROW = 2
+
+
+# 組み合わせが一巡したら姓と名の間に1文字はさむ（「佐藤太郎」が「佐藤太郎1」の一部として見つからないように）
+MIDDLE_CHARS = "一二三四五六七八九十百千万上下左右東西南北春夏秋冬松竹梅桜菊"
+
+
+def employee_name(i):
+    surname = SURNAMES[i % len(SURNAMES)]
+    given = GIVEN_NAMES[(i // len(SURNAMES)) % len(GIVEN_NAMES)]
+    cycle = i // (len(SURNAMES) * len(GIVEN_NAMES))
+    if not cycle:
+        return surname + given
+    if cycle <= len(MIDDLE_CHARS):
+        return surname + MIDDLE_CHARS[cycle - 1] + given
+    return f"{surname}{given}{cycle}"
+
+
+def employee_uid(i):
+    return f"U{i:032x}"
+
+
+# 従業員情報!A2:Z と同じ並び（D:名前 I:メール J:個人メール K:携帯 L:UID M:住所 ...）
+def make_employee_rows(count):
+    rows = []
+    for i in range(count):
+        rows.append([
+            str(i + 1), "", "", employee_name(i), "主任" if i % 7 == 0 else "社員",
+            str(2000 + i % 25), f"19{60 + i % 40}-0{1 + i % 9}-1{i % 10}", "男" if i % 2 else "女",
+            f"staff{i}@example.co.jp", f"person{i}@example.com", f"090-{1000 + i % 9000:04d}-{i % 10000:04d}",
+            employee_uid(i), f"{PREFECTURES[i % len(PREFECTURES)]}{i % 50 + 1}丁目{i % 30 + 1}番",
+            f"{400 + i % 600:03d}-{i % 10000:04d}", f"0{5 + i % 4}0-{i % 10000:04d}-0000",
+            "犬" if i % 3 == 0 else "", "穏やか", "4人",
+        ])
+    return rows
+
+
+# 会話ログ!A2:J と同じ並び（A:日時 B:UID C:名前 D:話者 E:発言 F:カテゴリ ...）。
+# now から遡って hours 時間に均等にばらまき、古い順に並べる
+def make_conversation_rows(count, employee_count, now, hours=24):
+    rows = []
+    step = timedelta(hours=hours) / max(count, 1)
+    for i in range(count):
+        at = now - step * (count - i)
+        who = i % max(employee_count, 1)
+        message = CHAT_SAMPLES[i % len(CHAT_SAMPLES)].format(name=employee_name((who + 1) % max(employee_count, 1)))
+        speaker = employee_name(who) if i % 2 == 0 else "愛子"
+        rows.append([
+            at.strftime("%Y-%m-%dT%H:%M:%S"), employee_uid(who), employee_name(who), speaker, message,
+            "日常会話", "テキスト", "未設定", "OK",
+        ])
+    return rows
+
+
+class _Request:
+    def __init__(self, fn, latency):
+        self._fn = fn
+        self._latency = latency
+
+    def execute(self, num_retries=0):
+        if self._latency:
+            time.sleep(self._latency)
+        return self._fn()
+
+
+class FakeSheetValues:
+    def __init__(self, tables=None, latency=0.0):
+        # シート名 → 2行目以降の行のリスト
+        self.tables = tables or {}
+        self.latency = latency
+        self.calls = {"get": 0, "append": 0}
+        self.rows_appended = 0
+        self._lock = threading.Lock()
+
+    def _parse(self, sheet_range):
+        match = RANGE_PATTERN.match(sheet_range)
+        if not match:
+            raise ValueError(f"範囲を解釈できません: {sheet_range}")
+        return match.group("sheet"), int(match.group("row") or FIRST_DATA_ROW)
+
+    def get(self, spreadsheetId=None, range=None, **kwargs):
+        sheet, start_row = self._parse(range)
+
+        def run():
+            with self._lock:
+                self.calls["get"] += 1
+                rows = self.tables.get(sheet, [])
+                return {"values": [list(row) for row in rows[max(start_row - FIRST_DATA_ROW, 0):]]}
+        return _Request(run, self.latency)
+
+    def append(self, spreadsheetId=None, range=None, body=None, **kwargs):
+        sheet, _ = self._parse(range)
+
+        def run():
+            values = (body or {}).get("values", [])
+            with self._lock:
+                self.calls["append"] += 1
+                self.rows_appended += len(values)
+                self.tables.setdefault(sheet, []).extend(values)
+            return {"updates": {"updatedRows": len(values)}}
+        return _Request(run, self.latency)
+
+
+class FakeOpenAI:
+    def __init__(self, latency=0.0, reply="了解しました。確認しておきますね。", category="日常会話"):
+        self.latency = latency
+        self.reply = reply
+        self.category = category
+        self.calls = 0
+        self.prompt_chars = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model=None, messages=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        messages = messages or []
+        chars = sum(len(message.get("content") or "") for message in messages)
+        with self._lock:
+            self.calls += 1
+            self.prompt_chars += chars
+        is_classification = any("分類" in (message.get("content") or "") for message in messages if message.get("role") == "system")
+        content = self.category if is_classification else self.reply
+        usage = SimpleNamespace(
+            prompt_tokens=chars, completion_tokens=len(content), total_tokens=chars + len(content),
+            prompt_tokens_details=SimpleNamespace(cached_tokens=0),
+        )
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(index=0, finish_reason="stop", message=SimpleNamespace(role="assistant", content=content))],
+            usage=usage,
+        )
+
+
+class FakeLineBotApi:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {"reply_message": 0, "push_message": 0, "multicast": 0}
+        self.recipients = 0
+        self._lock = threading.Lock()
+
+    def _record(self, name, recipients=1):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[name] += 1
+            self.recipients += recipients
+
+    def reply_message(self, reply_token, messages, notification_disabled=False, timeout=None):
+        self._record("reply_message")
+
+    def push_message(self, to, messages, retry_key=None, notification_disabled=False, custom_aggregation_units=None, timeout=None):
+        self._record("push_message")
+
+    def multicast(self, to, messages, retry_key=None, notification_disabled=False, custom_aggregation_units=None, timeout=None):
+        self._record("multicast", len(to))
+
+
+class FakeGmail:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId=None, body=None):
+        def run():
+            with self._lock:
+                self.sent += 1
+                return {"id": f"fake-{self.sent}"}
+        return _Request(run, self.latency)
+
+
+def make_text_event(user_id, text, index=0):
+    return SimpleNamespace(
+        type="message",
+        source=SimpleNamespace(type="user", user_id=user_id),
+        message=SimpleNamespace(type="text", text=text),
+        reply_token=f"bench-token-{index}",
+        webhook_event_id=f"bench-event-{index}",
+        delivery_context=SimpleNamespace(is_redelivery=False),
+    )
+
+
+# アプリ全体を偽物につなぎ替える。company_info_load / clients を import したあとの状態を変えるので、
+# 測りたいモジュールを import する前後どちらで呼んでもよい
+def install_fakes(sheet_values, openai_client=None, line_bot_api=None, gmail=None):
+    import google_clients
+    import company_info_load  # "sheets" クライアントの登録
+    import aiko_mailer
+    from clients import get_openai_client, get_line_bot_api, get_sheets_service
+
+    google_clients.set_client_credentials("sheets", SimpleNamespace(valid=True))
+    google_clients.get_sheet_values = lambda name="sheets": sheet_values
+    get_sheets_service.reset()
+    get_openai_client.override(openai_client or FakeOpenAI())
+    get_line_bot_api.override(line_bot_api or FakeLineBotApi())
+    gmail = gmail or FakeGmail()
+    aiko_mailer.get_gmail_service = lambda: gmail
+    return company_info_load
+
+
+def random_chat_messages(count, employee_count, seed=0):
+    rng = random.Random(seed)
+    return [
+        rng.choice(CHAT_SAMPLES).format(name=employee_name(rng.randrange(max(employee_count, 1))))
+        for _ in range(count)
+    ]
@@ -0,0 +1,313 @@
+# load_test.py　署名付きのLINE Webhookを /callback に送り続ける負荷試験
+#
+# app.py を偽物（benchmarks/fakes.py の Sheets・OpenAI・LINE・Gmail）につないでこのプロセス内でHTTPサーバーとして起動し、
+# 同時接続数を --concurrency の段階ごとに上げながら、次を測る。
+#   ・スループット（リクエスト/秒、イベント/秒）
+#   ・/callback の応答時間の p50 / p95 / p99
+#   ・エラー率（200以外・通信エラー）
+#   ・頭打ちになった同時接続数（これ以上増やしてもスループットが --saturation-gain 以上伸びない段階）
+# 1つのWebhookには別々のユーザーのイベントを --events-per-body 件入れる。各ユーザーは
+# あいさつ・勤怠連絡（全員へ / 指名して）・メール送信・個人情報の問い合わせ・雑談の流れを順番どおりに送る。
+# --redelivery-rate を付けると、その割合で直前のWebhookを isRedelivery=true で送り直す。
+# --async のときは /callback が受け付けだけで返るので、スループットは裏のキューを処理し終えるまでの時間で計算する。
+# --url を付けると、このプロセスでは起動せずに指定のサーバーへ送る（--channel-secret はそのサーバーと合わせること）。
+#
+#   python benchmarks/load_test.py [--concurrency 1,2,4,8,16] [--duration 10] [--events-per-body 3] [--async]
+
+import os
+import sys
+import json
+import time
+import hmac
+import base64
+import random
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from itertools import count
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import fakes
+
+CHANNEL_SECRET = "load-test-secret"
+# ユーザーの行動。1件ずつ順番に送る（前の応答で状態が進む流れもある）
+SCENARIOS = {
+    "greeting": ["おはようございます"],
+    "attendance_all": ["電車が遅れていて遅刻します", "はい", "はい"],
+    "attendance_named": ["今日は体調不良で休みます", "はい", "いいえ", "{name}さんに伝えて"],
+    "email": ["{name}にメールを送って", "はい"],
+    "sensitive": ["{name}さんの携帯電話番号を教えて"],
+    "chat": ["今日の会議は何時からですか"],
+}
+DEFAULT_MIX = "chat:4,sensitive:2,greeting:1,attendance_all:1,attendance_named:1,email:1"
+
+_event_ids = count(1)
+
+
+def sign_body(body, secret=CHANNEL_SECRET):
+    return base64.b64encode(hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+def make_message_event(user_id, text):
+    number = next(_event_ids)
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": f"01LOADTEST{number:016d}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"{number:032x}",
+        "message": {"type": "text", "id": str(number), "text": text, "quoteToken": f"q{number}"},
+    }
+
+
+def make_webhook_body(events):
+    return json.dumps({"destination": "Uloadtestbot", "events": events}, ensure_ascii=False)
+
+
+# 1人の利用者。シナリオを1つ選んで最後まで送り、終わったら次のシナリオを選ぶ
+class VirtualUser:
+    def __init__(self, index, employee_count, mix, rng):
+        self.user_id = fakes.employee_uid(index)
+        self._employee_count = employee_count
+        self._mix = mix
+        self._rng = rng
+        self._script = []
+
+    def next_message(self):
+        if not self._script:
+            names, weights = zip(*self._mix)
+            scenario = self._rng.choices(names, weights)[0]
+            name = fakes.employee_name(self._rng.randrange(self._employee_count))
+            self._script = [text.format(name=name) for text in SCENARIOS[scenario]]
+        return self._script.pop(0)
+
+
+class LevelResult:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.latencies = []
+        self.requests = 0
+        self.events = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        # ASYNC_WEBHOOK=1 のとき、送り終えてから裏のキューが空になるまでの秒数（elapsed に含む）
+        self.drain_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, latency, events, ok):
+        with self._lock:
+            self.requests += 1
+            self.events += events
+            if ok:
+                self.latencies.append(latency)
+            else:
+                self.errors += 1
+
+    def percentile(self, q):
+        ordered = sorted(self.latencies)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+
+    def summary(self):
+        return {
+            "concurrency": self.concurrency,
+            "requests": self.requests,
+            "events": self.events,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.requests, 4) if self.requests else 0.0,
+            "requests_per_sec": round(self.requests / self.elapsed, 2) if self.elapsed else 0.0,
+            "events_per_sec": round(self.events / self.elapsed, 2) if self.elapsed else 0.0,
+            "p50_ms": round(self.percentile(0.5), 1),
+            "p95_ms": round(self.percentile(0.95), 1),
+            "p99_ms": round(self.percentile(0.99), 1),
+            "drain_seconds": round(self.drain_seconds, 2),
+        }
+
+
+# 1本の接続が受け持つユーザーは他の接続と重ならないので、同じユーザーのイベントは必ず送った順に届く
+# redelivery_rate の割合で、直前に送ったイベントを isRedelivery=true にしてもう一度送る（LINEの再配信の真似）
+def run_client(session, url, users, events_per_body, deadline, result, secret, redelivery_rate=0.0, rng=None):
+    position = 0
+    previous = None
+    while time.monotonic() < deadline:
+        if previous and rng and rng.random() < redelivery_rate:
+            events = [dict(event, deliveryContext={"isRedelivery": True}) for event in previous]
+            previous = None
+        else:
+            batch = [users[(position + i) % len(users)] for i in range(events_per_body)]
+            position += events_per_body
+            events = previous = [make_message_event(user.user_id, user.next_message()) for user in batch]
+        body = make_webhook_body(events)
+        started = time.perf_counter()
+        try:
+            response = session.post(url, data=body.encode(), timeout=60, headers={
+                "Content-Type": "application/json",
+                "X-Line-Signature": sign_body(body, secret),
+            })
+            ok = response.status_code == 200
+        except Exception:
+            ok = False
+        result.record(time.perf_counter() - started, len(events), ok)
+
+
+# 裏のワーカープールに積まれたイベントを処理し終えるまで待つ
+def wait_for_drain(pool, timeout=300):
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        stats = pool.get_stats()
+        if not stats["queue_depth"] and not stats["busy_workers"]:
+            break
+        time.sleep(0.05)
+    return time.monotonic() - started
+
+
+def run_level(url, concurrency, args, mix, rng, user_offset, pool=None):
+    import requests
+
+    result = LevelResult(concurrency)
+    users_per_client = max(args.events_per_body, args.users // concurrency)
+    threads = []
+    deadline = time.monotonic() + args.duration
+    for k in range(concurrency):
+        # 勤怠・メールの途中状態が前の段階から持ち越されないよう、段階ごとに別のユーザーを使う
+        start = (user_offset + k * users_per_client) % args.employees
+        users = [VirtualUser((start + i) % args.employees, args.employees, mix, random.Random(rng.random()))
+                 for i in range(users_per_client)]
+        session = requests.Session()
+        threads.append(threading.Thread(
+            target=run_client, args=(session, url, users, args.events_per_body, deadline, result, args.channel_secret,
+                                     args.redelivery_rate, random.Random(rng.random())),
+            daemon=True))
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 受け付けただけでは処理が終わっていないので、スループットは処理し終えるまでの時間で割る
+    if pool is not None:
+        result.drain_seconds = wait_for_drain(pool)
+    result.elapsed = time.monotonic() - started
+    return result, users_per_client * concurrency
+
+
+# 偽物につないだ app.py をこのプロセスで起動し、/callback のURLを返す
+def start_local_app(args):
+    os.environ.setdefault("AIKO_DATA_DIR", tempfile.mkdtemp(prefix="aiko-load-"))
+    os.environ["LINE_CHANNEL_SECRET"] = args.channel_secret
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "load-test")
+    os.environ["CLIENT_WARMUP"] = "0"
+    os.environ["ASYNC_WEBHOOK"] = "1" if args.async_webhook else "0"
+
+    sheets = fakes.FakeSheetValues({
+        "従業員情報": fakes.make_employee_rows(args.employees),
+        "会話ログ": [],
+    }, latency=args.sheet_latency_ms / 1000)
+    services = {
+        "openai": fakes.FakeOpenAI(latency=args.llm_latency_ms / 1000),
+        "line": fakes.FakeLineBotApi(latency=args.line_latency_ms / 1000),
+        "gmail": fakes.FakeGmail(latency=args.line_latency_ms / 1000),
+    }
+    fakes.install_fakes(sheets, services["openai"], services["line"], services["gmail"])
+
+    import app
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pool = app.webhook_pool if args.async_webhook else None
+    return f"http://127.0.0.1:{server.server_port}/callback", services, sheets, pool
+
+
+# スループットの伸びが gain 未満になった（またはエラー率が上限を超えた）最初の段階の1つ前を頭打ちとする
+def find_saturation(summaries, gain, max_error_rate):
+    best = None
+    for summary in summaries:
+        if summary["error_rate"] > max_error_rate:
+            return best, f"エラー率が {summary['error_rate']:.1%} になった同時接続 {summary['concurrency']} の手前"
+        if best and summary["events_per_sec"] < best["events_per_sec"] * (1 + gain):
+            return best, f"同時接続 {summary['concurrency']} でスループットの伸びが {gain:.0%} 未満"
+        best = summary
+    return None, "測った範囲では頭打ちにならなかった"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32")
+    parser.add_argument("--duration", type=float, default=10.0, help="1段階あたりの秒数")
+    parser.add_argument("--events-per-body", type=int, default=3)
+    parser.add_argument("--employees", type=int, default=500, help="従業員数（利用者はこの中から選ぶ）")
+    parser.add_argument("--users", type=int, default=64, help="1段階で使う利用者の数（同時接続数で分ける）")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="シナリオ:重み をカンマ区切りで")
+    parser.add_argument("--sheet-latency-ms", type=float, default=80.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=700.0)
+    parser.add_argument("--line-latency-ms", type=float, default=60.0)
+    parser.add_argument("--saturation-gain", type=float, default=0.1)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--async", dest="async_webhook", action="store_true", help="ASYNC_WEBHOOK=1 で起動する")
+    parser.add_argument("--url", help="このプロセスで起動せず、指定の /callback に送る")
+    parser.add_argument("--channel-secret", default=CHANNEL_SECRET)
+    parser.add_argument("--redelivery-rate", type=float, default=0.0, help="直前のWebhookを再配信として送り直す割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果を書き出す JSON ファイル")
+    args = parser.parse_args()
+
+    mix = [(name, float(weight)) for name, weight in (item.split(":") for item in args.mix.split(","))]
+    unknown = [name for name, _ in mix if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知のシナリオ: {unknown}（{', '.join(SCENARIOS)}）")
+    rng = random.Random(args.seed)
+
+    # アプリの print・ログで結果が埋もれないようにする（結果は元の標準出力へ書く）
+    out = sys.stdout
+    logging.disable(logging.WARNING)
+    services = sheets = pool = None
+    if args.url:
+        url = args.url
+    else:
+        sys.stdout = open(os.devnull, "w")
+        url, services, sheets, pool = start_local_app(args)
+
+    print(f"送信先 {url}  1リクエスト {args.events_per_body}イベント  各段階 {args.duration:.0f}秒"
+          f"{'  (ASYNC_WEBHOOK=1)' if args.async_webhook else ''}", file=out)
+    print(f"{'同時接続':>8} {'req/s':>8} {'event/s':>8} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} {'エラー率':>8}", file=out)
+    summaries = []
+    user_offset = 0
+    for concurrency in [int(level) for level in args.concurrency.split(",")]:
+        result, used = run_level(url, concurrency, args, mix, rng, user_offset, pool)
+        user_offset += used
+        summary = result.summary()
+        summaries.append(summary)
+        print(f"{concurrency:>8} {summary['requests_per_sec']:>8.1f} {summary['events_per_sec']:>8.1f} "
+              f"{summary['p50_ms']:>8.1f} {summary['p95_ms']:>8.1f} {summary['p99_ms']:>8.1f} {summary['error_rate']:>8.1%}"
+              f"{f'  (キュー消化 {result.drain_seconds:.1f}秒)' if pool is not None else ''}", file=out)
+        time.sleep(1)
+
+    saturated, reason = find_saturation(summaries, args.saturation_gain, args.max_error_rate)
+    if saturated:
+        print(f"頭打ち: 同時接続 {saturated['concurrency']}（{saturated['events_per_sec']:.1f} event/s, p95 {saturated['p95_ms']:.0f}ms）— {reason}", file=out)
+    else:
+        print(f"頭打ち: {reason}", file=out)
+    if services and args.redelivery_rate:
+        from webhook_dedupe import get_dedupe_stats
+        print(f"再配信で省いたイベント: {get_dedupe_stats()['suppressed']}件", file=out)
+    if services:
+        print(f"偽物への呼び出し: OpenAI {services['openai'].calls}回, LINE {services['line'].calls}, "
+              f"Gmail {services['gmail'].sent}通, Sheets {sheets.calls}", file=out)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "levels": summaries,
+                       "saturation": saturated and saturated["concurrency"], "saturation_reason": reason},
+                      f, ensure_ascii=False, indent=2)
+        print(f"結果を {args.output} に書き出しました", file=out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# smoke_checks.py　偽物（benchmarks/fakes.py）を使って、主な処理が想定どおりの道を通るかを確かめる
+#
+# ベンチマークで速さを測る前に、測っている処理が本番と同じ道を通っていることを確かめるためのもの。
+# OpenAI・Sheets・LINEには接続しない。失敗したものがあれば終了コード1で終わる。
+#
+#   python benchmarks/smoke_checks.py [--only fallback_generates_reply,...]
+
+import os
+import sys
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("AIKO_DATA_DIR", tempfile.mkdtemp(prefix="aiko-check-"))
+os.environ.setdefault("CLIENT_WARMUP", "0")
+
+import fakes
+import handle_message_logic as logic
+from clients import get_sheets_service
+from response_cache import get_response_cache
+from stage_executor import get_stage_stats
+from log_writer import flush_log_writer
+from mask_word import mask_sensitive_data, unmask_sensitive_data
+
+EMPLOYEE_ROWS = 50
+
+
+def install(rows=EMPLOYEE_ROWS):
+    sheets = fakes.FakeSheetValues({"従業員情報": fakes.make_employee_rows(rows)})
+    line_bot_api = fakes.FakeLineBotApi()
+    fakes.install_fakes(sheets, fakes.FakeOpenAI(), line_bot_api)
+    return line_bot_api
+
+
+def stage_count(name):
+    return get_stage_stats()["stages"].get(name, {}).get("count", 0)
+
+
+# 従業員情報に当たらないメッセージは、応答キャッシュを引いてから応答を生成する
+def check_fallback_generates_reply():
+    line_bot_api = install()
+    lookups = get_response_cache().get_stats()["lookups"]
+    generated = stage_count("generate")
+    event = fakes.make_text_event(fakes.employee_uid(0), "来週の工場見学の段取りを考えて", index=0)
+    logic.handle_message_logic(event, get_sheets_service(), line_bot_api)
+    flush_log_writer()
+    assert get_response_cache().get_stats()["lookups"] == lookups + 1, "応答キャッシュが引かれていない"
+    assert stage_count("generate") == generated + 1, "generate ステージが動いていない"
+    assert line_bot_api.calls["reply_message"] == 1, "LINEへ応答していない"
+
+
+# メールアドレスの直前の日本語はマスクに巻き込まず、戻すと元の文になる
+def check_mask_email_after_japanese():
+    install()
+    text = "連絡はyamada@example.co.jpまで、急ぎなら090-1234-5678へ"
+    masked, mask_map = mask_sensitive_data(text)
+    assert masked.startswith("連絡は[[MASK-"), f"メールアドレスの前まで置換されている: {masked}"
+    assert sorted(mask_map.values()) == ["090-1234-5678", "yamada@example.co.jp"], f"置換した語が違う: {mask_map}"
+    assert unmask_sensitive_data(masked, mask_map) == text, "元に戻らない"
+
+
+CHECKS = ["fallback_generates_reply", "mask_email_after_japanese"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", default=",".join(CHECKS), help="確かめる項目（カンマ区切り）")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    failed = 0
+    for name in [name for name in args.only.split(",") if name in CHECKS]:
+        try:
+            globals()[f"check_{name}"]()
+            print(f"✅ {name}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {name}: {e}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# clients.py　外部サービス（OpenAI・LINE・Google Sheets）のクライアントの共通の入口
+#
+# ・どのクライアントも初めて使うときに1つだけ作る（import時には作らない）
+# ・複数スレッドから同時に呼ばれても作るのは1回だけ
+# ・重いSDK（openai など）の import も作るときまで遅らせ、起動直後の時間を短くする
+
+import os
+import logging
+import threading
+from metrics import instrument_methods
+
+
+# factory() を初回呼び出し時に1回だけ実行し、以後は同じものを返す関数を作る
+# （factory が例外を出したり None を返したときは保存せず、次の呼び出しでまた作り直す）
+def lazy_client(factory):
+    lock = threading.Lock()
+    holder = []
+
+    def get():
+        if not holder:
+            with lock:
+                if not holder:
+                    client = factory()
+                    if client is None:
+                        return None
+                    holder.append(client)
+        return holder[0]
+
+    def reset():
+        with lock:
+            holder.clear()
+
+    # テストやベンチマーク用に、作る代わりに渡したものを使わせる
+    def override(client):
+        with lock:
+            holder[:] = [client]
+
+    get.reset = reset
+    get.override = override
+    return get
+
+
+def _build_openai_client():
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        logging.critical("❌ OPENAI_API_KEY が環境変数に設定されていません。")
+        raise ValueError("OPENAI_API_KEY is not set.")
+    from openai import OpenAI
+    try:
+        return OpenAI(api_key=api_key)
+    except Exception as e:
+        logging.critical(f"❌ OpenAIクライアントの初期化に失敗しました: {e}")
+        raise
+
+
+# 送信系のメソッドは所要時間を line.<メソッド名> に記録する（metrics.py）
+def _build_line_bot_api():
+    from linebot import LineBotApi
+    api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+    return instrument_methods(api, "line", ("reply_message", "push_message", "multicast"))
+
+
+# 認証に失敗したときは None（company_info_load.get_google_sheets_service と同じ）
+def _build_sheets_service():
+    from company_info_load import get_google_sheets_service
+    return get_google_sheets_service()
+
+
+get_openai_client = lazy_client(_build_openai_client)
+get_line_bot_api = lazy_client(_build_line_bot_api)
+# spreadsheets().values() の代わりになるプロキシ（実際の接続はスレッドごと。google_clients を参照）
+get_sheets_service = lazy_client(_build_sheets_service)
+
+
+# 起動後に裏でクライアントを作っておく（最初のメッセージで openai の import を待たないため）。
+# 作れなかったものは、実際に使うときにもう一度作る
+def warm_up_clients_in_background():
+    def run():
+        for get in (get_line_bot_api, get_openai_client):
+            try:
+                get()
+            except Exception as e:
+                logging.error(f"❌ クライアントの事前作成に失敗しました: {e}")
+
+    threading.Thread(target=run, daemon=True, name="client-warmup").start()
@@ -2,16 +2,16 @@
 
 import os
 import logging
-from functools import lru_cache
+import threading
+from collections import OrderedDict
 from company_info_load import get_google_sheets_service
-from openai_client import client  # OpenAIクライアントを共通管理
+from employee_directory import NAME_ALIASES
+from conversation_classifier import CATEGORIES, predict_category
+from clients import get_openai_client  # OpenAIクライアントを共通管理（初回利用時に作る）
+from metrics import timed
 
 # === 従業員情報検索 ===
 def search_employee_info_by_keywords(user_message, employee_info_list):
-    alias_dict = {
-        "おきく": "菊田京子", "まさみ": "政美", "かおり": "香織",
-        "こうちゃん": "孝一", "考ちゃん": "孝一", "工場長": "折戸",
-    }
     attributes = {
         "役職": 4, "入社年": 5, "生年月日": 6, "性別": 7,
         "メールアドレス": 8, "個人メールアドレス": 9, "携帯電話番号": 10,
@@ -20,7 +20,7 @@ def search_employee_info_by_keywords(user_message, employee_info_list):
     }
 
     user_message = user_message.replace("ちゃん", "さん").replace("君", "さん").replace("くん", "さん")
-    for alias, real_name in alias_dict.items():
+    for alias, real_name in NAME_ALIASES.items():
         if alias in user_message:
             user_message = user_message.replace(alias, real_name)
 
@@ -34,12 +34,43 @@ def search_employee_info_by_keywords(user_message, employee_info_list):
                     value = row[index].strip() if index < len(row) and row[index].strip() else "不明"
                     return f"{name}さんの{keyword}は {value} です。"
 
-    logging.warning(f"❗該当する従業員または属性が見つかりませんでした: '{user_message}'")
-    return "申し訳ありませんが、該当の情報が見つかりませんでした。"
+    # 見つからなければ None（呼び出し側で社内情報の検索・応答生成に回す。よくあることなので本文はログに残さない）
+    logging.debug("従業員情報のキーワード検索: 該当なし")
+    return None
 
 # === 会話分類 ===
+# ローカル分類器の確信度がこれ未満のときだけOpenAIに問い合わせる
+CATEGORY_CONFIDENCE_THRESHOLD = float(os.getenv("CATEGORY_CONFIDENCE_THRESHOLD", "0.6"))
+CATEGORY_MEMO_SIZE = 2048
+
+_category_memo = OrderedDict()
+_category_memo_lock = threading.Lock()
+
+@timed("classify_conversation_category")
 def classify_conversation_category(message):
-    categories = {"重要", "日常会話", "あいさつ", "業務情報", "その他"}
+    key = message.strip()
+    with _category_memo_lock:
+        if key in _category_memo:
+            _category_memo.move_to_end(key)
+            return _category_memo[key]
+
+    try:
+        category, confidence = predict_category(key)
+    except Exception as e:
+        logging.error(f"❌ ローカル分類失敗: {e}")
+        category, confidence = None, 0.0
+    if category is None or confidence < CATEGORY_CONFIDENCE_THRESHOLD:
+        category = classify_conversation_category_with_llm(message)
+
+    if category != "未分類":
+        with _category_memo_lock:
+            _category_memo[key] = category
+            if len(_category_memo) > CATEGORY_MEMO_SIZE:
+                _category_memo.popitem(last=False)
+    return category
+
+def classify_conversation_category_with_llm(message):
+    categories = set(CATEGORIES)
     prompt = (
         "以下の会話内容を、次のいずれかのカテゴリで1単語だけで分類してください："
         "「重要」「日常会話」「あいさつ」「業務情報」「その他」。\n\n"
@@ -47,15 +78,16 @@ def classify_conversation_category(message):
     )
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたは優秀な会話分類AIです。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=10,
-            temperature=0
-        )
+        with timed("openai.classify_conversation_category"):
+            response = get_openai_client().chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": "あなたは優秀な会話分類AIです。"},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=10,
+                temperature=0
+            )
         category = response.choices[0].message.content.strip()
         if category not in categories:
             logging.warning(f"⚠️ 不明なカテゴリ: {category}")
@@ -1,10 +1,14 @@
 # company_info_load.py
 
 import os
+import time
+import queue
 import logging
-from functools import lru_cache
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+import threading
+from concurrent.futures import Future
+from employee_directory import EmployeeDirectory
+from google_clients import register_client, get_credentials, SheetValuesProxy
+from metrics import timed, observe
 
 # 環境変数からスプレッドシートIDを取得
 SPREADSHEET_ID1 = os.getenv('SPREADSHEET_ID1')
@@ -13,91 +17,237 @@ SPREADSHEET_ID3 = os.getenv('SPREADSHEET_ID3')
 SPREADSHEET_ID4 = os.getenv('SPREADSHEET_ID4')
 SPREADSHEET_ID5 = os.getenv('SPREADSHEET_ID5')
 
-# Google Sheets 接続サービスの取得
+# === シートごとの読み込み設定 ===
+# キャッシュ名 → (スプレッドシートIDの環境変数名, 範囲, TTL秒, ログ用の表示名)
+# TTLは SHEET_CACHE_TTL_<キャッシュ名の大文字> で上書きできる
+SHEET_SOURCES = {
+    "conversation_log": ("SPREADSHEET_ID1", "会話ログ!A2:J", 60, "会話ログ"),
+    "employee": ("SPREADSHEET_ID2", "従業員情報!A2:Z", 600, "従業員情報"),
+    "partner": ("SPREADSHEET_ID3", "取引先情報!A2:Z", 1800, "取引先情報"),
+    "company": ("SPREADSHEET_ID4", "会社情報!A2:Z", 1800, "会社情報"),
+    "experience_log": ("SPREADSHEET_ID5", "経験ログ!A2:E", 300, "経験ログ"),
+}
+
+register_client(
+    "sheets", "sheets", "v4",
+    os.path.join(os.path.dirname(__file__), 'aiko-bot-log-cfbf23e039fd.json'),
+    ["https://www.googleapis.com/auth/spreadsheets"]
+)
+
+# バックグラウンド更新スレッドの巡回間隔（秒）
+SNAPSHOT_REFRESH_INTERVAL = int(os.getenv("SHEET_CACHE_REFRESH_INTERVAL", "30"))
+
+# キャッシュ名 → {"values": 行リスト, "fetched_at": 取得時刻, "version": 内容が変わるたびに+1}
+_snapshots = {}
+_snapshot_stats = {name: {"hits": 0, "misses": 0, "stale": 0, "refreshes": 0, "errors": 0} for name in SHEET_SOURCES}
+_snapshot_lock = threading.Lock()
+_refreshing = set()
+# 期限切れのシートを読み直す係（1本のスレッドで、Sheetsクライアントと接続を使い回す）
+_refresh_queue = queue.Queue()
+_refresh_worker = None
+# 初回読み込み中のシート → 結果を待つための Future（同じシートを同時に何本も読まない）
+_loading = {}
+_refresh_thread = None
+_employee_directory = EmployeeDirectory([])
+
+# Google Sheets 接続サービスの取得（認証情報とクライアントはプロセス内で使い回す）
 def get_google_sheets_service():
     try:
-        json_path = os.path.join(os.path.dirname(__file__), 'aiko-bot-log-cfbf23e039fd.json')
-        credentials = service_account.Credentials.from_service_account_file(
-            json_path,
-            scopes=["https://www.googleapis.com/auth/spreadsheets"]
-        )
-        service = build("sheets", "v4", credentials=credentials)
-        return service.spreadsheets().values()
+        get_credentials("sheets")
+        return SheetValuesProxy("sheets")
     except Exception as e:
         logging.error(f"❌ Google Sheets認証エラー: {e}")
         return None
 
-def get_conversation_log(sheet_values):
-    try:
-        result = sheet_values.get(spreadsheetId=SPREADSHEET_ID1, range="会話ログ!A2:J").execute()
-        return result.get("values", [])
-    except Exception as e:
-        logging.error(f"❌ 会話ログの取得に失敗: {e}")
-        return []
+def get_sheet_ttl(name):
+    default_ttl = SHEET_SOURCES[name][2]
+    return int(os.getenv(f"SHEET_CACHE_TTL_{name.upper()}", default_ttl))
 
-@lru_cache(maxsize=1)
-def get_employee_info(sheet_values):
-    try:
-        result = sheet_values.get(spreadsheetId=SPREADSHEET_ID2, range="従業員情報!A2:Z").execute()
-        return result.get("values", [])
-    except Exception as e:
-        logging.error(f"❌ 従業員情報の取得に失敗: {e}")
-        return []
+# シートを1回読み込む（キャッシュを通さない）
+def _fetch_sheet(name, sheet_values=None):
+    env_key, sheet_range, _, _ = SHEET_SOURCES[name]
+    sheet_values = sheet_values or get_google_sheets_service()
+    if not sheet_values:
+        raise RuntimeError("シートサービスの取得に失敗しました")
+    with timed(f"sheets.fetch.{name}"):
+        result = sheet_values.get(spreadsheetId=os.getenv(env_key), range=sheet_range).execute()
+    return result.get("values", [])
 
-@lru_cache(maxsize=1)
-def get_partner_info(sheet_values):
+# シートを読み直してスナップショットを差し替える（失敗時は古い値を残して None を返す）
+def refresh_sheet_snapshot(name, sheet_values=None):
+    label = SHEET_SOURCES[name][3]
     try:
-        result = sheet_values.get(spreadsheetId=SPREADSHEET_ID3, range="取引先情報!A2:Z").execute()
-        return result.get("values", [])
+        values = _fetch_sheet(name, sheet_values)
     except Exception as e:
-        logging.error(f"❌ 取引先情報の取得に失敗: {e}")
-        return []
+        logging.error(f"❌ {label}の取得に失敗: {e}")
+        with _snapshot_lock:
+            _snapshot_stats[name]["errors"] += 1
+        return None
+
+    with _snapshot_lock:
+        previous = _snapshots.get(name)
+        version = 1
+        if previous and previous["values"] == values:
+            # 内容が同じなら同じリストを使い回し、索引などの作り直しを避ける
+            values = previous["values"]
+            version = previous["version"]
+        elif previous:
+            version = previous["version"] + 1
+        _snapshots[name] = {"values": values, "fetched_at": time.monotonic(), "version": version}
+        _snapshot_stats[name]["refreshes"] += 1
+    return values
+
+def _run_refresh_worker():
+    while True:
+        name = _refresh_queue.get()
+        try:
+            refresh_sheet_snapshot(name)
+        except Exception as e:
+            logging.error(f"❌ シート更新スレッドエラー: {e}")
+        finally:
+            with _snapshot_lock:
+                _refreshing.discard(name)
+
+def _refresh_in_background(name):
+    global _refresh_worker
+    with _snapshot_lock:
+        if name in _refreshing:
+            return
+        _refreshing.add(name)
+        if _refresh_worker is None:
+            _refresh_worker = threading.Thread(target=_run_refresh_worker, name="sheet-refresh", daemon=True)
+            _refresh_worker.start()
+    _refresh_queue.put(name)
 
-@lru_cache(maxsize=1)
-def get_company_info(sheet_values):
+# 初回の読み込み。最初に来た呼び出しだけが読み、同時に来たほかの呼び出しはその結果を待つ
+def _load_first_snapshot(name, sheet_values=None):
+    with _snapshot_lock:
+        entry = _snapshots.get(name)
+        if entry is not None:
+            return entry["values"]
+        future = _loading.get(name)
+        loader = future is None
+        if loader:
+            future = _loading[name] = Future()
+    if not loader:
+        return future.result()
     try:
-        result = sheet_values.get(spreadsheetId=SPREADSHEET_ID4, range="会社情報!A2:Z").execute()
-        return result.get("values", [])
-    except Exception as e:
-        logging.error(f"❌ 会社情報の取得に失敗: {e}")
-        return []
+        values = refresh_sheet_snapshot(name, sheet_values)
+        future.set_result(values if values is not None else [])
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _snapshot_lock:
+            _loading.pop(name, None)
+    return future.result()
 
-def get_experience_log(sheet_values):
+# スナップショットを返す。期限切れなら古い値をそのまま返し、裏で読み直す
+# （get_* の所要時間は sheets.get.<キャッシュ名>、実際にSheetsを読んだ時間は sheets.fetch.<キャッシュ名> に記録）
+def get_sheet_snapshot(name, sheet_values=None):
+    started = time.perf_counter()
     try:
-        result = sheet_values.get(spreadsheetId=SPREADSHEET_ID5, range="経験ログ!A2:E").execute()
-        return result.get("values", [])
-    except Exception as e:
-        logging.error(f"❌ 経験ログの取得に失敗: {e}")
-        return []
+        return _get_sheet_snapshot(name, sheet_values)
+    finally:
+        observe(f"sheets.get.{name}", time.perf_counter() - started)
+
+def _get_sheet_snapshot(name, sheet_values=None):
+    with _snapshot_lock:
+        entry = _snapshots.get(name)
+        if entry is None:
+            _snapshot_stats[name]["misses"] += 1
+        elif time.monotonic() - entry["fetched_at"] < get_sheet_ttl(name):
+            _snapshot_stats[name]["hits"] += 1
+            return entry["values"]
+        else:
+            _snapshot_stats[name]["stale"] += 1
+
+    if entry is None:
+        return _load_first_snapshot(name, sheet_values)
+
+    _refresh_in_background(name)
+    return entry["values"]
+
+# スナップショットのバージョン（内容が変わるたびに増える。未取得なら0）
+def get_snapshot_version(name):
+    with _snapshot_lock:
+        entry = _snapshots.get(name)
+        return entry["version"] if entry else 0
+
+# 明示的な無効化。name省略時は全シート。古い値は残し、次の参照を待たずに裏で読み直す
+def invalidate_sheet_cache(name=None):
+    names = [name] if name else list(SHEET_SOURCES)
+    with _snapshot_lock:
+        for key in names:
+            if key in _snapshots:
+                _snapshots[key]["fetched_at"] = float("-inf")
+    for key in names:
+        _refresh_in_background(key)
+
+def get_cache_stats():
+    now = time.monotonic()
+    with _snapshot_lock:
+        stats = {}
+        for name, counters in _snapshot_stats.items():
+            entry = _snapshots.get(name)
+            stats[name] = dict(counters)
+            stats[name]["rows"] = len(entry["values"]) if entry else 0
+            stats[name]["version"] = entry["version"] if entry else 0
+            stats[name]["age"] = round(now - entry["fetched_at"], 1) if entry else None
+        return stats
+
+# TTLの8割を過ぎたシートを先回りで読み直し、メッセージ処理中にSheetsを読まずに済むようにする
+def _periodic_snapshot_refresh(interval):
+    while True:
+        for name in SHEET_SOURCES:
+            with _snapshot_lock:
+                entry = _snapshots.get(name)
+            if entry is None or time.monotonic() - entry["fetched_at"] >= get_sheet_ttl(name) * 0.8:
+                refresh_sheet_snapshot(name)
+        time.sleep(interval)
+
+def start_snapshot_refresh_thread(interval=SNAPSHOT_REFRESH_INTERVAL):
+    global _refresh_thread
+    if _refresh_thread and _refresh_thread.is_alive():
+        return _refresh_thread
+    _refresh_thread = threading.Thread(target=lambda: _periodic_snapshot_refresh(interval), daemon=True)
+    _refresh_thread.start()
+    return _refresh_thread
+
+def get_conversation_log(sheet_values=None):
+    return get_sheet_snapshot("conversation_log", sheet_values)
+
+def get_employee_info(sheet_values=None):
+    return get_sheet_snapshot("employee", sheet_values)
+
+def get_partner_info(sheet_values=None):
+    return get_sheet_snapshot("partner", sheet_values)
+
+def get_company_info(sheet_values=None):
+    return get_sheet_snapshot("company", sheet_values)
+
+def get_experience_log(sheet_values=None):
+    return get_sheet_snapshot("experience_log", sheet_values)
+
+# 従業員スナップショットから作った索引。スナップショットが変わったときだけ作り直す
+def get_employee_directory():
+    global _employee_directory
+    rows = get_employee_info()
+    directory = _employee_directory
+    if directory.rows is not rows:
+        directory = EmployeeDirectory(rows, get_snapshot_version("employee"))
+        _employee_directory = directory
+    return directory
 
 def load_all_user_ids():
-    sheet = get_google_sheets_service()
-    if not sheet:
-        logging.error("❌ シートサービスの取得に失敗しました")
-        return []
-    result = sheet.get(spreadsheetId=SPREADSHEET_ID2, range="従業員情報!L2:L").execute()
-    values = result.get("values", [])
-    return [row[0].strip() for row in values if row and row[0].strip().startswith("U")]
+    return get_employee_directory().all_uids()
+
+# 登録ユーザーか（UIDの索引を引くだけで、一覧は作らない）
+def is_registered_user(user_id):
+    return get_employee_directory().by_uid(user_id) is not None
 
 def get_user_callname_from_uid(user_id):
     greetings_only = ["こんばんは", "こんばんわ", "こんにちわ", "こんにちは", "おはよう", "はろはろ","ハロー","おっはー","やっはろー","ばんわ","こんちわ"]
     if user_id.strip() in greetings_only:
         return ""
-
-    sheet = get_google_sheets_service()
-    if not sheet:
-        logging.error("❌ Google Sheetsサービス取得に失敗しました")
-        return "不明"
-    try:
-        result = sheet.get(
-            spreadsheetId=SPREADSHEET_ID2,
-            range="従業員情報!D2:L"
-        ).execute()
-        values = result.get("values", [])
-        for row in values:
-            if len(row) >= 9 and row[8].strip() == user_id:
-                name = row[0].strip() if row[0].strip() else "不明"
-                return name.replace("さん", "")
-    except Exception as e:
-        logging.error(f"❌ UIDの読み込みに失敗しました: {e}")
-    return "不明"
+    return get_employee_directory().callname(user_id)
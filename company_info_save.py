@@ -1,69 +1,47 @@
-import os
 import logging
+from company_info_load import invalidate_sheet_cache
+from log_writer import register_sheet_target, enqueue_row
+from conversation_history import record_conversation_row
+
+# 書き込みは log_writer のキューに積み、まとめてappendする（sheet_service 引数は互換のために残している）
+register_sheet_target("conversation_log", "SPREADSHEET_ID1", "会話ログ!A:J", "会話ログ")
+register_sheet_target("employee", "SPREADSHEET_ID2", "従業員情報!A:Z", "従業員情報",
+                      after_flush=lambda: invalidate_sheet_cache("employee"))
+register_sheet_target("partner", "SPREADSHEET_ID3", "取引先情報!A:Z", "取引先情報",
+                      after_flush=lambda: invalidate_sheet_cache("partner"))
+register_sheet_target("company", "SPREADSHEET_ID4", "会社情報!A:Z", "会社情報",
+                      after_flush=lambda: invalidate_sheet_cache("company"))
+register_sheet_target("aiko_experience_log", "SPREADSHEET_ID5", "愛子の経験ログ!A:E", "愛子の経験ログ")
 
 # === 会話ログ書き込み関数 ===
 def write_conversation_log(sheet_service, timestamp, user_id, user_name, speaker, message, category, message_type, topics, status):
     try:
         row = [timestamp, user_id, user_name, speaker, message, category, message_type, topics, status]
-        body = {"values": [row]}
-        sheet_service.append(
-            spreadsheetId=os.getenv("SPREADSHEET_ID1"),
-            range="会話ログ!A:J",
-            valueInputOption="USER_ENTERED",
-            insertDataOption="INSERT_ROWS",
-            body=body
-        ).execute()
+        enqueue_row("conversation_log", row)
+        record_conversation_row(row)
     except Exception as e:
         logging.error(f"❌ 会話ログ書き込みエラー: {e}")
 
 def write_employee_info(sheet_service, values):
     try:
-        body = {"values": [values]}
-        sheet_service.append(
-            spreadsheetId=os.getenv("SPREADSHEET_ID2"),
-            range="従業員情報!A:Z",
-            valueInputOption="USER_ENTERED",
-            insertDataOption="INSERT_ROWS",
-            body=body
-        ).execute()
+        enqueue_row("employee", values)
     except Exception as e:
         logging.error(f"❌ 従業員情報書き込みエラー: {e}")
 
 def write_partner_info(sheet_service, values):
     try:
-        body = {"values": [values]}
-        sheet_service.append(
-            spreadsheetId=os.getenv("SPREADSHEET_ID3"),
-            range="取引先情報!A:Z",
-            valueInputOption="USER_ENTERED",
-            insertDataOption="INSERT_ROWS",
-            body=body
-        ).execute()
+        enqueue_row("partner", values)
     except Exception as e:
         logging.error(f"❌ 取引先情報書き込みエラー: {e}")
 
 def write_company_info(sheet_service, values):
     try:
-        body = {"values": [values]}
-        sheet_service.append(
-            spreadsheetId=os.getenv("SPREADSHEET_ID4"),
-            range="会社情報!A:Z",
-            valueInputOption="USER_ENTERED",
-            insertDataOption="INSERT_ROWS",
-            body=body
-        ).execute()
+        enqueue_row("company", values)
     except Exception as e:
         logging.error(f"❌ 会社情報書き込みエラー: {e}")
 
 def write_aiko_experience_log(sheet_service, values):
     try:
-        body = {"values": [values]}
-        sheet_service.append(
-            spreadsheetId=os.getenv("SPREADSHEET_ID5"),
-            range="愛子の経験ログ!A:E",
-            valueInputOption="USER_ENTERED",
-            insertDataOption="INSERT_ROWS",
-            body=body
-        ).execute()
+        enqueue_row("aiko_experience_log", values)
     except Exception as e:
         logging.error(f"❌ 愛子の経験ログ書き込みエラー: {e}")
@@ -0,0 +1,120 @@
+# conversation_classifier.py　会話カテゴリのローカル分類器（文字n-gram TF-IDF + ロジスティック回帰）
+#
+# 会話ログのカテゴリ列（F列）に付いているラベルで学習し、ファイルに保存しておく。
+# 再学習:  python conversation_classifier.py train
+
+import os
+import sys
+import time
+import pickle
+import logging
+import argparse
+import threading
+from local_store import DATA_DIR
+
+CATEGORIES = ("重要", "日常会話", "あいさつ", "業務情報", "その他")
+CATEGORY_MODEL_PATH = os.getenv("CATEGORY_MODEL_PATH", os.path.join(DATA_DIR, "category_model.pkl"))
+# 保存済みモデルの更新を確認する間隔（秒）。再学習したモデルを再起動なしで拾う
+MODEL_RELOAD_INTERVAL = 60
+
+# 会話ログの列インデックス
+SPEAKER_COL = 3
+MESSAGE_COL = 4
+CATEGORY_COL = 5
+
+_model = None
+_model_mtime = None
+_last_checked = 0.0
+_model_lock = threading.Lock()
+
+
+# 会話ログからユーザー発言と既知カテゴリの組を取り出す
+def extract_training_data(logs):
+    texts, labels = [], []
+    for row in logs:
+        if len(row) <= CATEGORY_COL:
+            continue
+        if row[SPEAKER_COL] != "ユーザー" or row[CATEGORY_COL] not in CATEGORIES:
+            continue
+        text = row[MESSAGE_COL].strip()
+        if text:
+            texts.append(text)
+            labels.append(row[CATEGORY_COL])
+    return texts, labels
+
+
+def train_category_model(logs=None, path=CATEGORY_MODEL_PATH, min_samples=20):
+    from sklearn.pipeline import make_pipeline
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+
+    if logs is None:
+        from company_info_load import refresh_sheet_snapshot
+        logs = refresh_sheet_snapshot("conversation_log") or []
+    texts, labels = extract_training_data(logs)
+    if len(texts) < min_samples or len(set(labels)) < 2:
+        raise ValueError(f"学習データが足りません（{len(texts)}件, {len(set(labels))}カテゴリ）")
+
+    model = make_pipeline(
+        TfidfVectorizer(analyzer="char_wb", ngram_range=(1, 3), sublinear_tf=True, min_df=1),
+        LogisticRegression(max_iter=1000, class_weight="balanced"),
+    )
+    model.fit(texts, labels)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(model, f)
+    os.replace(tmp_path, path)
+    return {"samples": len(texts), "categories": sorted(set(labels)), "path": path}
+
+
+def _load_model():
+    global _model, _model_mtime, _last_checked
+    now = time.monotonic()
+    if now - _last_checked < MODEL_RELOAD_INTERVAL:
+        return _model
+    with _model_lock:
+        _last_checked = now
+        try:
+            mtime = os.path.getmtime(CATEGORY_MODEL_PATH)
+        except OSError:
+            return _model
+        if mtime != _model_mtime:
+            try:
+                with open(CATEGORY_MODEL_PATH, "rb") as f:
+                    _model = pickle.load(f)
+                _model_mtime = mtime
+                logging.info("🧠 カテゴリ分類モデルを読み込みました")
+            except Exception as e:
+                logging.error(f"❌ カテゴリ分類モデルの読み込みに失敗: {e}")
+        return _model
+
+
+# (カテゴリ, 確信度) を返す。モデルが無ければ (None, 0.0)
+def predict_category(message):
+    model = _load_model()
+    if model is None or not message:
+        return None, 0.0
+    probabilities = model.predict_proba([message])[0]
+    best = probabilities.argmax()
+    return str(model.classes_[best]), float(probabilities[best])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会話カテゴリ分類モデルの学習")
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("--path", default=CATEGORY_MODEL_PATH)
+    parser.add_argument("--min-samples", type=int, default=20)
+    args = parser.parse_args()
+
+    try:
+        result = train_category_model(path=args.path, min_samples=args.min_samples)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print(f"✅ {result['samples']}件で学習しました {result['categories']} → {result['path']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# conversation_history.py　会話ログの差分読み込みと、ユーザーごとの直近履歴
+#
+# ・最後に読んだ行を覚えておき、会話ログは新しく増えた行だけを読む
+# ・ユーザーごとに直近 USER_HISTORY_SIZE 件、全体で直近 GLOBAL_HISTORY_SIZE 件だけを保持する
+# ・write_conversation_log から書き込みと同時に反映するので、シートへの反映を待たずに文脈に入る
+
+import os
+import logging
+import threading
+from collections import deque, Counter, OrderedDict
+from intent_matcher import INTENT_MATCHER
+
+USER_HISTORY_SIZE = 20
+GLOBAL_HISTORY_SIZE = 100
+MAX_TRACKED_USERS = 1000
+# 書き込み済みでまだシートで見ていない行の記録の上限
+MAX_PENDING_WRITES = 2000
+CONVERSATION_SHEET = "会話ログ"
+FIRST_DATA_ROW = 2
+
+_lock = threading.Lock()
+_user_history = OrderedDict()
+_global_history = deque(maxlen=GLOBAL_HISTORY_SIZE)
+_pending_writes = Counter()
+_pending_order = deque()
+_next_row = FIRST_DATA_ROW
+_listeners = []
+_stats = {"rows_read": 0, "rows_written_through": 0, "fetches": 0}
+
+
+# 新しい行を受け取る関数を登録する。fn(row, local) の local は「このプロセスが書いた行」
+def add_row_listener(fn):
+    _listeners.append(fn)
+
+
+def _row_key(row):
+    return tuple(str(cell) for cell in row[:5])
+
+
+def format_history_line(row, scan=None):
+    scan = scan or INTENT_MATCHER.scan(row[4])
+    message = scan.remove("memory_command").strip()
+    flag = " [重要]" if scan.has("important") else ""
+    return f"{row[3]}: {message}{flag}"
+
+
+def _append_line(row, line):
+    user_id = row[1]
+    history = _user_history.get(user_id)
+    if history is None:
+        history = _user_history[user_id] = deque(maxlen=USER_HISTORY_SIZE)
+        if len(_user_history) > MAX_TRACKED_USERS:
+            _user_history.popitem(last=False)
+    else:
+        _user_history.move_to_end(user_id)
+    history.append(line)
+    _global_history.append(line)
+
+
+def _notify(rows, local):
+    for row in rows:
+        for fn in _listeners:
+            try:
+                fn(row, local)
+            except Exception as e:
+                logging.error(f"❌ 会話ログ通知エラー: {e}")
+
+
+# write_conversation_log からの書き込みと同時の反映
+def record_conversation_row(row):
+    if len(row) <= 4:
+        return
+    line = format_history_line(row)
+    with _lock:
+        _append_line(row, line)
+        key = _row_key(row)
+        _pending_writes[key] += 1
+        _pending_order.append(key)
+        while len(_pending_order) > MAX_PENDING_WRITES:
+            old = _pending_order.popleft()
+            if _pending_writes.get(old):
+                _pending_writes[old] -= 1
+                if not _pending_writes[old]:
+                    del _pending_writes[old]
+        _stats["rows_written_through"] += 1
+    _notify([row], True)
+
+
+# シートに増えた行だけを読み、まだ反映していない行を取り込む。取り込んだ行数を返す
+def follow_conversation_log(sheet_values=None):
+    global _next_row
+    from company_info_load import get_google_sheets_service
+
+    sheet_values = sheet_values or get_google_sheets_service()
+    if not sheet_values:
+        logging.error("❌ シートサービスの取得に失敗しました")
+        return 0
+    start_row = _next_row
+    try:
+        result = sheet_values.get(
+            spreadsheetId=os.getenv("SPREADSHEET_ID1"),
+            range=f"{CONVERSATION_SHEET}!A{start_row}:J"
+        ).execute()
+    except Exception as e:
+        logging.error(f"❌ 会話ログの差分取得に失敗: {e}")
+        return 0
+    values = result.get("values", [])
+
+    rows = [row for row in values if len(row) > 4]
+    scans = INTENT_MATCHER.scan_many([row[4] for row in rows])
+    new_rows = []
+    with _lock:
+        if _next_row != start_row:
+            # 別スレッドが先に同じ範囲を取り込んだ
+            return 0
+        _next_row = start_row + len(values)
+        _stats["fetches"] += 1
+        _stats["rows_read"] += len(values)
+        for row, scan in zip(rows, scans):
+            key = _row_key(row)
+            if _pending_writes.get(key):
+                # このプロセスが書き込んだ行は反映済み
+                _pending_writes[key] -= 1
+                if not _pending_writes[key]:
+                    del _pending_writes[key]
+                continue
+            _append_line(row, format_history_line(row, scan))
+            new_rows.append(row)
+    # 初回の全件読み込み分は通知しない（過去の行を改めて処理しないため）
+    if start_row != FIRST_DATA_ROW:
+        _notify(new_rows, False)
+    return len(new_rows)
+
+
+def get_user_history(user_id, limit=USER_HISTORY_SIZE):
+    with _lock:
+        history = _user_history.get(user_id)
+        return list(history)[-limit:] if history else []
+
+
+def get_global_history(limit=GLOBAL_HISTORY_SIZE):
+    with _lock:
+        return list(_global_history)[-limit:]
+
+
+def get_history_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats.update({
+            "next_row": _next_row,
+            "users": len(_user_history),
+            "global_lines": len(_global_history),
+            "pending_writes": sum(_pending_writes.values()),
+        })
+        return stats
@@ -0,0 +1,111 @@
+# employee_directory.py　従業員情報シートの行をUID・名前・呼び名・メールで引ける索引
+
+# 呼び名 → 本名（の一部）
+NAME_ALIASES = {
+    "おきく": "菊田京子", "まさみ": "政美", "かおり": "香織",
+    "こうちゃん": "孝一", "考ちゃん": "孝一", "工場長": "折戸",
+}
+
+# 従業員情報!A:Z の列インデックス
+NAME_COL = 3         # D列: 名前
+WORK_EMAIL_COL = 8   # I列: メールアドレス
+EMAIL_COL = 9        # J列: 個人メールアドレス（メール送信先）
+UID_COL = 11         # L列: LINEのUID
+ADDRESS_COL = 12     # M列: 住所
+
+
+def _cell(row, index):
+    return row[index].strip() if index < len(row) and row[index] else ""
+
+
+def _normalize_name(name):
+    return name.replace("さん", "").replace(" ", "").replace("　", "").strip()
+
+
+class EmployeeDirectory:
+    def __init__(self, rows, version=0):
+        self.rows = rows
+        self.version = version
+        self._by_uid = {}
+        self._by_name = {}
+        self._by_email = {}
+
+        for row in rows:
+            uid = _cell(row, UID_COL)
+            if uid:
+                self._by_uid.setdefault(uid, row)
+            name = _normalize_name(_cell(row, NAME_COL))
+            if name:
+                self._by_name.setdefault(name, row)
+            for col in (WORK_EMAIL_COL, EMAIL_COL):
+                email = _cell(row, col).lower()
+                if email:
+                    self._by_email.setdefault(email, row)
+
+        # 呼び名とその本名（名字なしの名前など）を、本名を含む従業員に結びつける（見つからない呼び名は登録しない）
+        for alias, real_name in NAME_ALIASES.items():
+            row = self._by_name.get(real_name) or next(
+                (r for n, r in self._by_name.items() if real_name in n), None)
+            if row is not None:
+                self._by_name.setdefault(alias, row)
+                self._by_name.setdefault(real_name, row)
+
+        # 文中検索で試す名前の長さ（長い順）
+        self._name_lengths = sorted({len(n) for n in self._by_name}, reverse=True)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def by_uid(self, uid):
+        return self._by_uid.get((uid or "").strip())
+
+    def by_name(self, name):
+        return self._by_name.get(_normalize_name(name or ""))
+
+    def by_email(self, email):
+        return self._by_email.get((email or "").strip().lower())
+
+    # 名前・呼び名・メールアドレスのどれでも引く
+    def lookup(self, key):
+        return self.by_name(key) or self.by_email(key) or self.by_uid(key)
+
+    def all_uids(self):
+        return [uid for uid in self._by_uid if uid.startswith("U")]
+
+    def callname(self, uid, default="不明"):
+        row = self.by_uid(uid)
+        if row is None:
+            return default
+        return _cell(row, NAME_COL).replace("さん", "") or default
+
+    def name_of(self, row):
+        return _cell(row, NAME_COL)
+
+    def uid_of(self, row):
+        return _cell(row, UID_COL)
+
+    def email_of(self, row):
+        return _cell(row, EMAIL_COL) or None
+
+    def email_for_uid(self, uid):
+        row = self.by_uid(uid)
+        return self.email_of(row) if row is not None else None
+
+    # 文中に出てくる従業員（名前・呼び名）を出現順に重複なしで返す
+    # 各位置で登録済みの長さだけ辞書を引くので、行数ではなく文の長さに比例する
+    def find_in_text(self, text):
+        text = _normalize_name(text or "")
+        found = []
+        seen = set()
+        i = 0
+        while i < len(text):
+            for length in self._name_lengths:
+                row = self._by_name.get(text[i:i + length])
+                if row is not None:
+                    if id(row) not in seen:
+                        seen.add(id(row))
+                        found.append(row)
+                    i += length - 1
+                    break
+            i += 1
+        return found
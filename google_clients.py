@@ -0,0 +1,153 @@
+# google_clients.py　Google API（Sheets / Gmail）クライアントをプロセス内で使い回すための登録簿
+#
+# ・サービスアカウントの鍵ファイルは1回だけ読み、認証情報（更新済みトークン）を全スレッドで共有
+# ・ディスカバリ文書は同梱の静的ファイルを1回だけ読み込む（ネットワークに取りに行かない）
+# ・httplib2.Http はスレッドセーフではないため、HTTP接続はスレッドごとに持ち、keep-aliveで使い回す
+
+import os
+import json
+import threading
+
+HTTP_TIMEOUT = int(os.getenv("GOOGLE_HTTP_TIMEOUT", "30"))
+
+# リポジトリ内に discovery/<api>.<version>.json があればそれを優先する
+DISCOVERY_DIR = os.path.join(os.path.dirname(__file__), "discovery")
+
+# クライアント名 → {"api", "version", "key_file", "scopes", "subject"}
+_client_specs = {}
+# (鍵ファイル, スコープ, 委任先) → 認証情報
+_credentials = {}
+# (api, version) → パース済みのディスカバリ文書
+_discovery_docs = {}
+_registry_lock = threading.Lock()
+_local = threading.local()
+# 認証情報を差し替えるたびに増やす。スレッドごとのクライアントは、作ったときの値と違えば作り直す
+_credentials_generation = 0
+_client_stats = {"credentials_loaded": 0, "discovery_loaded": 0, "clients_built": 0, "client_reused": 0}
+
+
+def register_client(name, api, version, key_file, scopes, subject=None):
+    with _registry_lock:
+        _client_specs[name] = {
+            "api": api, "version": version, "key_file": key_file,
+            "scopes": tuple(scopes), "subject": subject,
+        }
+
+
+# テストやベンチマーク用に、鍵ファイルの代わりに認証情報を直接登録する
+def set_client_credentials(name, credentials):
+    global _credentials_generation
+    spec = _client_specs[name]
+    with _registry_lock:
+        _credentials[(spec["key_file"], spec["scopes"], spec["subject"])] = credentials
+        _credentials_generation += 1
+    reset_thread_clients()
+
+
+def get_credentials(name):
+    spec = _client_specs[name]
+    key = (spec["key_file"], spec["scopes"], spec["subject"])
+    with _registry_lock:
+        creds = _credentials.get(key)
+        if creds is None:
+            from google.oauth2 import service_account
+            creds = service_account.Credentials.from_service_account_file(
+                spec["key_file"], scopes=list(spec["scopes"]))
+            if spec["subject"]:
+                creds = creds.with_subject(spec["subject"])
+            _credentials[key] = creds
+            _client_stats["credentials_loaded"] += 1
+        return creds
+
+
+def load_discovery_document(api, version):
+    key = (api, version)
+    with _registry_lock:
+        doc = _discovery_docs.get(key)
+        if doc is not None:
+            return doc
+        local_path = os.path.join(DISCOVERY_DIR, f"{api}.{version}.json")
+        if os.path.exists(local_path):
+            with open(local_path, encoding="utf-8") as f:
+                content = f.read()
+        else:
+            from googleapiclient.discovery_cache import get_static_doc
+            content = get_static_doc(api, version)
+        if content is None:
+            raise RuntimeError(f"{api} {version} のディスカバリ文書が見つかりません")
+        doc = json.loads(content)
+        _discovery_docs[key] = doc
+        _client_stats["discovery_loaded"] += 1
+        return doc
+
+
+def _build_client(name):
+    import httplib2
+    import google_auth_httplib2
+    from googleapiclient.discovery import build_from_document
+
+    spec = _client_specs[name]
+    creds = get_credentials(name)
+    doc = load_discovery_document(spec["api"], spec["version"])
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+    service = build_from_document(doc, http=http)
+    with _registry_lock:
+        _client_stats["clients_built"] += 1
+    return service
+
+
+# このスレッドのクライアントが古い認証情報で作られていれば捨てる
+def _check_generation():
+    if getattr(_local, "generation", None) != _credentials_generation:
+        reset_thread_clients()
+
+
+# 呼び出し元スレッド専用のクライアントを返す（スレッドごとに1回だけ組み立てる）
+def get_client(name):
+    _check_generation()
+    clients = getattr(_local, "clients", None)
+    if clients is None:
+        clients = _local.clients = {}
+    service = clients.get(name)
+    if service is None:
+        service = clients[name] = _build_client(name)
+    else:
+        with _registry_lock:
+            _client_stats["client_reused"] += 1
+    return service
+
+
+# spreadsheets().values() も組み立てのたびにディスカバリ文書から作られるため、スレッドごとに保持する
+def get_sheet_values(name="sheets"):
+    _check_generation()
+    resources = getattr(_local, "values", None)
+    if resources is None:
+        resources = _local.values = {}
+    values = resources.get(name)
+    if values is None:
+        values = resources[name] = get_client(name).spreadsheets().values()
+    else:
+        with _registry_lock:
+            _client_stats["client_reused"] += 1
+    return values
+
+
+def reset_thread_clients():
+    _local.clients = {}
+    _local.values = {}
+    _local.generation = _credentials_generation
+
+
+def get_client_stats():
+    with _registry_lock:
+        return dict(_client_stats)
+
+
+# spreadsheets().values() の代わりに渡すオブジェクト。
+# モジュール変数として持っていても、実際の呼び出しはそのスレッドのクライアントで行う
+class SheetValuesProxy:
+    def __init__(self, name="sheets"):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_sheet_values(self._name), attr)
@@ -1,4 +1,7 @@
 # handle_message_logic.py  LINEメッセージを受け取ったときのメイン処理
+#
+# 応答を待たせるのは「登録ユーザーか」の確認と応答の生成だけ。
+# カテゴリ分類と名前・登録の確認は並行して走らせ、会話ログの書き込みはLINEへ応答したあとに回す。
 
 from linebot.models import TextSendMessage
 from aiko_greeting import (
@@ -10,9 +13,8 @@ from company_info import (
     search_employee_info_by_keywords, classify_conversation_category
 )
 from company_info_load import (
-    get_employee_info, get_partner_info, get_company_info,
-    get_conversation_log, get_experience_log, load_all_user_ids,
-    get_user_callname_from_uid
+    get_employee_info, get_employee_directory, load_all_user_ids,
+    is_registered_user, get_user_callname_from_uid
 )
 from company_info_save import write_conversation_log
 from aiko_mailer import (
@@ -23,26 +25,64 @@ from mask_word import (
     unmask_sensitive_data, rephrase_with_masked_text
 )
 from aiko_self_study import generate_contextual_reply
-from openai_client import client  # OpenAIクライアント共通化
+from search_index import search_company_sources
+from stage_executor import StagePipeline
+from response_cache import SHARED_SCOPE, get_response_cache
 
 MAX_HITS = 10
 DEFAULT_USER_NAME = "不明"
+ATTENDANCE_NOTICE = "出社予定・遅刻連絡がありました。"
+# 応答生成に失敗したときの返り値（キャッシュしない）
+FAILED_REPLY_PREFIXES = ("[応答失敗]", "[マスク応答失敗]")
+
+# 名前・登録・会話状態をまとめて調べる（どれも従業員スナップショットとローカルの状態だけで済む）
+def lookup_user(user_id):
+    user_name = get_user_callname_from_uid(user_id) or DEFAULT_USER_NAME
+    registered = is_registered_user(user_id)
+    status = get_user_status(user_id) or {}
+    return user_name, registered, status
+
+def log_user_message(pipeline, sheet_service, timestamp, user_id, user_name, user_message):
+    category = pipeline.result("classify") or "未分類"
+    write_conversation_log(sheet_service, timestamp, user_id, user_name, "ユーザー", user_message, category, "テキスト", "未設定", "OK")
+
+# 勤怠連絡の転送（応答のあとに実行）。送れなかった相手がいれば本人に知らせる
+def forward_attendance(line_bot_api, user_id, callname, recipients):
+    report = forward_message_to_others(line_bot_api, callname, ATTENDANCE_NOTICE, recipients)
+    if report.failed:
+        directory = get_employee_directory()
+        names = "、".join(directory.name_of(directory.by_uid(uid)) if directory.by_uid(uid) else uid for uid in report.failed)
+        line_bot_api.push_message(user_id, TextSendMessage(text=f"{names}には送れませんでした。"))
 
 def handle_message_logic(event, sheet_service, line_bot_api):
     user_id = event.source.user_id
     user_message = event.message.text.strip()
-    user_name = get_user_callname_from_uid(user_id) or DEFAULT_USER_NAME
+    received_at = now_jst().isoformat()
 
-    # ユーザー発言を記録
-    category = classify_conversation_category(user_message) or "未分類"
-    write_conversation_log(sheet_service, now_jst().isoformat(), user_id, user_name, "ユーザー", user_message, category, "テキスト", "未設定", "OK")
+    pipeline = StagePipeline("handle_message", user_id)
+    pipeline.start("classify", classify_conversation_category, user_message)
+    pipeline.start("lookup", lookup_user, user_id)
+    try:
+        respond(pipeline, event, sheet_service, line_bot_api, user_id, user_message, received_at)
+    finally:
+        pipeline.finish()
+
+def respond(pipeline, event, sheet_service, line_bot_api, user_id, user_message, received_at):
+    user_name, registered, status = pipeline.result("lookup")
+    # ユーザー発言の記録（カテゴリ分類の完了を待つので応答のあと）
+    pipeline.defer("log_user", log_user_message, pipeline, sheet_service, received_at, user_id, user_name, user_message)
+
+    def reply(text, category, topics, log_text=None, result="OK"):
+        pipeline.run("line_reply", line_bot_api.reply_message, event.reply_token, TextSendMessage(text=text))
+        pipeline.mark_replied()
+        pipeline.defer(
+            "log_reply", write_conversation_log, sheet_service, now_jst().isoformat(), user_id,
+            "愛子", "愛子", log_text or text, category, "テキスト", topics, result
+        )
 
     # 登録ユーザー確認
-    registered_uids = load_all_user_ids()
-    if user_id not in registered_uids:
-        reply = "申し訳ありません。このサービスは社内専用です。"
-        write_conversation_log(sheet_service, now_jst().isoformat(), user_id, "愛子", "愛子", reply, "権限エラー", "テキスト", "認証", "NG")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+    if not registered:
+        reply("申し訳ありません。このサービスは社内専用です。", "権限エラー", "認証", result="NG")
         return
 
     callname = user_name
@@ -50,90 +90,132 @@ def handle_message_logic(event, sheet_service, line_bot_api):
     if greet_key and not has_recent_greeting(user_id, greet_key):
         greeting = get_time_based_greeting(user_id)
         record_greeting_time(user_id, now_jst(), greet_key)
-        reply = f"{greeting}{callname}"
-        write_conversation_log(sheet_service, now_jst().isoformat(), user_id, "愛子", "愛子", reply, "挨拶", "テキスト", "挨拶", "OK")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+        reply(f"{greeting}{callname}", "挨拶", "挨拶")
         return
 
     # メール表示
     if "最新メール" in user_message or "メール見せて" in user_message:
-        email_text = fetch_latest_email() or "最新のメールは見つかりませんでした。"
-        write_conversation_log(sheet_service, now_jst().isoformat(), user_id, "愛子", "愛子", email_text, "メール表示", "テキスト", "社内メール", "OK")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=email_text[:100]))
+        email_text = pipeline.run("fetch_email", fetch_latest_email) or "最新のメールは見つかりませんでした。"
+        reply(email_text[:100], "メール表示", "社内メール", log_text=email_text)
         return
 
     # メール作成指示
     if "にメールを送って" in user_message:
         target = user_message.replace("にメールを送って", "").strip()
-        draft_body = draft_email_for_user(user_id, target)
-        update_user_status(user_id, 100)
-        update_user_status(user_id + "_target", target)
-        reply = f"この内容で{target}にメールを送りますか？"
-        write_conversation_log(sheet_service, now_jst().isoformat(), user_id, "愛子", "愛子", reply, "メール確認", "テキスト", target, "OK")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+        draft_body = pipeline.run("draft_email", draft_email_for_user, user_id, target)
+        update_user_status(user_id, 100, target=target)
+        reply(f"この内容で{target}にメールを送りますか？", "メール確認", target)
         return
 
-    # メール送信確認
-    status = get_user_status(user_id) or {}
+    # メール送信確認（メールは送信箱に積むだけ。同じWebhookイベントが再配信されても二重に送らない）
     step = status.get("step", 0)
+    mail_key = f"line:{event.webhook_event_id}" if getattr(event, "webhook_event_id", None) else None
     if step == 100:
-        target = get_user_status(user_id + "_target")
+        target = status.get("target")
         user_email = get_user_email_from_uid(user_id)
         if user_message == "はい":
-            send_email_with_confirmation(sender_uid=user_id, to_name=target, cc=user_email)
-            reply = f"{target}にメールを送信しました。"
+            queued = send_email_with_confirmation(sender_uid=user_id, to_name=target, cc=user_email, idempotency_key=mail_key)
+            text = f"{target}にメールを送信しました。"
         else:
-            send_email_with_confirmation(sender_uid=user_id, to_name=target, cc=None)
-            reply = "メールはあなたにだけ送信しました。内容を確認してください。"
+            queued = send_email_with_confirmation(sender_uid=user_id, to_name=target, cc=None, idempotency_key=mail_key)
+            text = "メールはあなたにだけ送信しました。内容を確認してください。"
+        if not queued:
+            text = f"{target}のメールアドレスが見つかりませんでした。"
         reset_user_status(user_id)
-        reset_user_status(user_id + "_target")
-        write_conversation_log(sheet_service, now_jst().isoformat(), user_id, "愛子", "愛子", reply, "メール送信", "テキスト", target, "OK")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+        reply(text, "メール送信", target)
         return
 
     # 長文応答メール送信
     if step == 200:
-        fulltext = get_user_status(user_id + "_fulltext")
+        fulltext = status.get("fulltext")
         if user_message == "はい":
             user_email = get_user_email_from_uid(user_id)
-            send_email_with_confirmation(sender_uid=user_id, to_name=user_email, cc=None, body=fulltext)
-            reply = "メールで送信しました。ご確認ください。"
+            if send_email_with_confirmation(sender_uid=user_id, to_name=user_email, cc=None, body=fulltext, idempotency_key=mail_key):
+                text = "メールで送信しました。ご確認ください。"
+            else:
+                text = "メールアドレスが登録されていないため送信できませんでした。"
         else:
-            reply = "了解しました。必要があればまた聞いてください。"
+            text = "了解しました。必要があればまた聞いてください。"
+        reset_user_status(user_id)
+        reply(text, "メール送信確認", "AI応答")
+        return
+
+    # 勤怠連絡（誰に伝えるかを順に聞く）
+    if step == 0 and is_attendance_related(user_message):
+        update_user_status(user_id, 1)
+        reply("わかりました。どなたかにお伝えしますか？", "勤怠連絡", "勤怠")
+        return
+
+    if step == 1:
+        if user_message == "はい":
+            update_user_status(user_id, 2)
+            reply("全員でいいですか？", "勤怠連絡", "勤怠")
+            return
+        elif user_message == "いいえ":
+            reset_user_status(user_id)
+            reply("了解しました。お気をつけて。", "勤怠連絡", "勤怠")
+            return
+        elif is_topic_changed(user_message):
+            reset_user_status(user_id)
+
+    elif step == 2:
+        if user_message == "はい":
+            recipients = [uid for uid in load_all_user_ids() if uid != user_id]
+            reset_user_status(user_id)
+            reply("全員にお伝えします。お気をつけて。", "勤怠連絡", "勤怠")
+            pipeline.defer("forward", forward_attendance, line_bot_api, user_id, callname, recipients)
+            return
+        elif user_message == "いいえ":
+            update_user_status(user_id, 3)
+            reply("誰に送りますか？", "勤怠連絡", "勤怠")
+            return
+        elif is_topic_changed(user_message):
+            reset_user_status(user_id)
+
+    elif step == 3:
+        directory = get_employee_directory()
+        matched = [row for row in directory.find_in_text(user_message) if directory.uid_of(row)]
+        recipients = [directory.uid_of(row) for row in matched]
         reset_user_status(user_id)
-        reset_user_status(user_id + "_fulltext")
-        write_conversation_log(sheet_service, now_jst().isoformat(), user_id, "愛子", "愛子", reply, "メール送信確認", "テキスト", "AI応答", "OK")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+        if recipients:
+            names = "、".join(directory.name_of(row) for row in matched)
+            reply(f"{names}に送ります。お気をつけて。", "勤怠連絡", "勤怠")
+            pipeline.defer("forward", forward_attendance, line_bot_api, user_id, callname, recipients)
+        else:
+            reply("該当者が見つかりませんでした。", "勤怠連絡", "勤怠")
         return
 
+    if is_topic_changed(user_message):
+        reset_user_status(user_id)
+
     # キーワード一致（従業員情報）
     employee_info = get_employee_info(sheet_service)
-    reply = search_employee_info_by_keywords(user_message, employee_info)
-    if not reply:
-        try:
-            if contains_sensitive_info(user_message):
-                combined = []
-                for dataset in [get_employee_info(sheet_service), get_partner_info(sheet_service), get_company_info(sheet_service), get_conversation_log(sheet_service), get_experience_log(sheet_service)]:
-                    combined.extend([str(item) for item in dataset if any(w in str(item) for w in user_message.split())])
-                hits = combined[:MAX_HITS] or ["該当情報が見つかりませんでした。"]
-                masked_input, mask_map = mask_sensitive_data("\n".join(hits))
-                reply_masked = rephrase_with_masked_text(masked_input)
-                reply = unmask_sensitive_data(reply_masked, mask_map)
-            else:
-                system_instruction = "あなたは社内専用のAIアシスタント愛子です。従業員には情報をすべて開示し、LINE返信は100文字以内にまとめてください。"
-                prompt = f"{system_instruction}\n\nユーザーの入力: {user_message}"
-                reply = generate_contextual_reply(user_id, prompt)
-        except Exception as e:
-            reply = f"申し訳ありません。現在応答できません（{e}）"
-
-    if len(reply) > 80:
-        update_user_status(user_id, 200)
-        update_user_status(user_id + "_fulltext", reply)
-        short_reply = "もっと情報がありますがLINEでは送れないのでメールで送りますか？"
-        write_conversation_log(sheet_service, now_jst().isoformat(), user_id, "愛子", "愛子", short_reply, "長文応答", "テキスト", "AI応答", "OK")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=short_reply))
+    text = search_employee_info_by_keywords(user_message, employee_info)
+    if not text:
+        # 社内情報の検索結果から作る応答は全員で共有、会話履歴に左右される応答は本人だけに使い回す
+        response_cache = get_response_cache()
+        sensitive = contains_sensitive_info(user_message)
+        cache_scope = SHARED_SCOPE if sensitive else user_id
+        text = response_cache.get(cache_scope, user_message)
+        if text is None:
+            try:
+                if sensitive:
+                    hits = [hit.text for hit in search_company_sources(user_message, MAX_HITS)] or ["該当情報が見つかりませんでした。"]
+                    masked_input, mask_map = mask_sensitive_data("\n".join(hits))
+                    reply_masked = pipeline.run("generate", rephrase_with_masked_text, masked_input)
+                    text = unmask_sensitive_data(reply_masked, mask_map)
+                else:
+                    system_instruction = "あなたは社内専用のAIアシスタント愛子です。従業員には情報をすべて開示し、LINE返信は100文字以内にまとめてください。"
+                    prompt = f"{system_instruction}\n\nユーザーの入力: {user_message}"
+                    text = pipeline.run("generate", generate_contextual_reply, user_id, prompt)
+                if not text.startswith(FAILED_REPLY_PREFIXES):
+                    response_cache.put(cache_scope, user_message, text)
+            except Exception as e:
+                text = f"申し訳ありません。現在応答できません（{e}）"
+
+    if len(text) > 80:
+        update_user_status(user_id, 200, fulltext=text)
+        reply("もっと情報がありますがLINEでは送れないのでメールで送りますか？", "長文応答", "AI応答")
         return
 
-    short_reply = reply[:100]
-    write_conversation_log(sheet_service, now_jst().isoformat(), user_id, "愛子", "愛子", reply, "通常応答", "テキスト", "AI応答", "OK")
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=short_reply))
+    reply(text[:100], "通常応答", "AI応答", log_text=text)
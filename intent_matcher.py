@@ -0,0 +1,182 @@
+# intent_matcher.py　キーワード一覧をまとめたAho-Corasickオートマトン
+#
+# 個人情報・挨拶・勤怠・話題転換・重要・記録指示のキーワードを1つのオートマトンにまとめ、
+# 文を1回なめるだけで、どの意図に当たったか（フラグ）と一致位置をまとめて返す。
+
+import threading
+from collections import deque, OrderedDict
+
+# 個人情報らしいワード（OpenAI経由禁止）
+SENSITIVE_KEYWORDS = [
+    "誕生日", "生年月日", "入社", "入社年", "住所", "電話", "家族", "名前", "氏名",
+    "読み", "ふりがな", "携帯", "出身", "血液型", "メール", "メールアドレス",
+    "年齢", "生まれ", "個人", "趣味", "特技", "身長", "体重"
+]
+
+# 挨拶と認識される語（先に書いたものほど優先）
+GREETING_KEYWORDS = [
+    "おはよう", "おっはー", "おは", "おっは", "お早う", "お早うございます",
+    "こんにちは", "こんばんは", "お疲れさま", "おつかれ"
+]
+# 上の一覧に当たらなかったときの「お疲れ」系
+GREETING_FALLBACK_KEYWORDS = ["お疲", "おつかれ"]
+
+ATTENDANCE_KEYWORDS = ["遅刻", "休み", "休暇", "出社", "在宅", "早退"]
+TOPIC_CHANGE_KEYWORDS = ["やっぱり", "ちなみに", "ところで", "別件", "変更", "違う話"]
+
+IMPORTANT_PATTERNS = [
+    "重要", "緊急", "至急", "要確認", "トラブル", "対応して", "すぐに", "大至急"
+]
+
+# 「覚えて」などの記録指示（会話ログから取り除く）
+MEMORY_COMMAND_PATTERNS = [
+    "覚えてください", "覚えて", "おぼえておいて", "覚えてね",
+    "記録して", "メモして", "忘れないで", "記憶して",
+    "保存して", "記録お願い", "記録をお願い"
+]
+
+INTENT_KEYWORDS = {
+    "sensitive": SENSITIVE_KEYWORDS,
+    "greeting": GREETING_KEYWORDS,
+    "greeting_fallback": GREETING_FALLBACK_KEYWORDS,
+    "attendance": ATTENDANCE_KEYWORDS,
+    "topic_change": TOPIC_CHANGE_KEYWORDS,
+    "important": IMPORTANT_PATTERNS,
+    "memory_command": MEMORY_COMMAND_PATTERNS,
+}
+
+SCAN_MEMO_SIZE = 256
+
+
+# 英字だけ小文字にそろえる（長さが変わる文字はそのまま）
+def fold_case(text):
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+    return "".join(ch.lower() if len(ch.lower()) == 1 else ch for ch in text)
+
+
+class IntentScan:
+    def __init__(self, text, matches):
+        self.text = text
+        # [(開始, 終了, 意図, キーワード), ...] 開始位置順
+        self.matches = matches
+        self.flags = {intent for _, _, intent, _ in matches}
+
+    def has(self, intent):
+        return intent in self.flags
+
+    def words(self, intent):
+        return [word for _, _, name, word in self.matches if name == intent]
+
+    # 左から順に、重ならない一致を選ぶ（同じ位置なら長いほう）
+    def spans(self, intent):
+        candidates = sorted(
+            ((start, end) for start, end, name, _ in self.matches if name == intent),
+            key=lambda span: (span[0], -span[1])
+        )
+        spans = []
+        last_end = 0
+        for start, end in candidates:
+            if start >= last_end:
+                spans.append((start, end))
+                last_end = end
+        return spans
+
+    # 意図に当たった部分を取り除いた文
+    def remove(self, intent):
+        spans = self.spans(intent)
+        if not spans:
+            return self.text
+        parts = []
+        position = 0
+        for start, end in spans:
+            parts.append(self.text[position:start])
+            position = end
+        parts.append(self.text[position:])
+        return "".join(parts)
+
+
+class IntentMatcher:
+    def __init__(self, intents):
+        self._goto = [{}]
+        self._fail = [0]
+        # ノード → [(キーワード長, 意図, キーワード), ...]
+        self._output = [[]]
+
+        for intent, words in intents.items():
+            for word in words:
+                node = 0
+                for ch in fold_case(word):
+                    next_node = self._goto[node].get(ch)
+                    if next_node is None:
+                        next_node = len(self._goto)
+                        self._goto[node][ch] = next_node
+                        self._goto.append({})
+                        self._fail.append(0)
+                        self._output.append([])
+                    node = next_node
+                self._output[node].append((len(fold_case(word)), intent, word))
+
+        # 幅優先で失敗遷移を張り、失敗先の出力を引き継ぐ
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+        self._memo = OrderedDict()
+        self._memo_lock = threading.Lock()
+
+    def scan(self, text):
+        text = text or ""
+        with self._memo_lock:
+            cached = self._memo.get(text)
+            if cached is not None:
+                self._memo.move_to_end(text)
+                return cached
+
+        result = self._scan_text(text)
+        with self._memo_lock:
+            self._memo[text] = result
+            if len(self._memo) > SCAN_MEMO_SIZE:
+                self._memo.popitem(last=False)
+        return result
+
+    def _scan_text(self, text):
+        goto, fail, output = self._goto, self._fail, self._output
+        root = goto[0]
+        matches = []
+        node = 0
+        for i, ch in enumerate(fold_case(text)):
+            if node == 0:
+                # キーワードの先頭になりえない文字は辞書を1回引くだけで読み飛ばす
+                node = root.get(ch, 0)
+                if node == 0:
+                    continue
+            else:
+                while node and ch not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(ch, 0)
+            if output[node]:
+                for length, intent, word in output[node]:
+                    matches.append((i - length + 1, i + 1, intent, word))
+        matches.sort(key=lambda match: (match[0], match[1]))
+        return IntentScan(text, matches)
+
+    # ログシートなど大量の文をまとめて調べる（1件ごとの文をメモには残さない）
+    def scan_many(self, texts):
+        return [self._scan_text(text or "") for text in texts]
+
+
+INTENT_MATCHER = IntentMatcher(INTENT_KEYWORDS)
+
+
+def scan_intents(text):
+    return INTENT_MATCHER.scan(text)
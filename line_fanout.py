@@ -0,0 +1,181 @@
+# line_fanout.py　複数人へのLINE一斉送信（multicast）
+#
+# ・宛先を MULTICAST_LIMIT（LINEの上限500人）ずつに分け、multicast を並列に送る
+# ・429（送信しすぎ）が返ったら全部の送信をいったん止め、指数バックオフで再送する。
+#   再送には同じ retry_key を付けるので、LINE側で二重送信にならない
+# ・429以外の4xxで送れなかったまとまりは、1人ずつ push_message で送り直して、送れなかった相手を特定する。
+#   push にもまとまりの retry_key と相手のUIDから決まる retry_key を付け、再送しても二重に届かないようにする
+# ・再送するのは LineBotApiError（429・5xx）と通信エラーだけ。それ以外の例外（プログラムの誤りなど）は再送しない
+# ・api は multicast / push_message を持つものなら何でもよい（ローカルの偽LINE APIでも試せる。失敗は LineBotApiError で返す）
+
+import os
+import time
+import uuid
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from linebot.exceptions import LineBotApiError
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout as RequestsTimeout
+
+MULTICAST_LIMIT = 500
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "4"))
+FANOUT_MAX_RETRIES = int(os.getenv("FANOUT_MAX_RETRIES", "4"))
+# 1回目の再送までの秒数。以降は倍々（上限 FANOUT_BACKOFF_MAX）にゆらぎを加える
+FANOUT_BACKOFF_BASE = float(os.getenv("FANOUT_BACKOFF_BASE", "1.0"))
+FANOUT_BACKOFF_MAX = 30.0
+# 再送してよい通信エラー
+NETWORK_ERRORS = (RequestsConnectionError, RequestsTimeout, ConnectionError, TimeoutError)
+
+
+class FanoutReport:
+    def __init__(self, recipients):
+        self.recipients = recipients
+        self.sent = []
+        # uid → エラー内容
+        self.failed = {}
+        self.multicast_calls = 0
+        self.push_calls = 0
+        self.retries = 0
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def summary(self):
+        return (f"{len(self.sent)}/{len(self.recipients)}人に送信"
+                f"（multicast {self.multicast_calls}回, push {self.push_calls}回, 再送 {self.retries}回, {self.elapsed:.2f}秒）")
+
+
+def chunk_recipients(uids, size=MULTICAST_LIMIT):
+    # 重複を除き、順番は保つ
+    unique = list(dict.fromkeys(uid for uid in uids if uid))
+    return [unique[i:i + size] for i in range(0, len(unique), size)]
+
+
+def _status_code(error):
+    return getattr(error, "status_code", None)
+
+
+def _is_retryable(error):
+    if isinstance(error, LineBotApiError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, NETWORK_ERRORS)
+
+
+# 1人ずつ送り直すときの retry_key（同じ送信・同じ相手なら何度作っても同じ値）
+def push_retry_key(retry_key, uid):
+    return str(uuid.uuid5(uuid.UUID(retry_key), uid))
+
+
+def _describe(error):
+    try:
+        return str(error)
+    except Exception:
+        return f"{error.__class__.__name__}(status={_status_code(error)})"
+
+
+def _retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class FanoutDispatcher:
+    def __init__(self, api, concurrency=FANOUT_CONCURRENCY, max_retries=FANOUT_MAX_RETRIES,
+                 backoff_base=FANOUT_BACKOFF_BASE, sleep=time.sleep):
+        self._api = api
+        self._concurrency = concurrency
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # 429を受けたら、この時刻まではどのまとまりも送らない
+        self._resume_at = 0.0
+
+    def _wait_rate_limit(self):
+        with self._lock:
+            delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            self._sleep(delay)
+
+    def _back_off(self, attempt, error):
+        delay = _retry_after(error) or min(FANOUT_BACKOFF_MAX, self._backoff_base * (2 ** attempt))
+        delay *= 1 + random.random() * 0.2
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+    # 429と5xx・通信エラーは再送、それ以外はそのまま例外を返す
+    def _call_with_retry(self, report, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._wait_rate_limit()
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                status = _status_code(e)
+                # 再送した retry_key が409なら、前の送信がLINEに届いている
+                if attempt and status == 409 and isinstance(e, LineBotApiError) and kwargs.get("retry_key"):
+                    return None
+                if not _is_retryable(e) or attempt >= self._max_retries:
+                    raise
+                if status == 429:
+                    logging.warning(f"⚠️ LINEの送信制限(429)のため待機します（{attempt + 1}回目）")
+                self._back_off(attempt, e)
+                with self._lock:
+                    report.retries += 1
+                attempt += 1
+
+    def _send_chunk(self, report, chunk, messages):
+        retry_key = str(uuid.uuid4())
+        try:
+            with self._lock:
+                report.multicast_calls += 1
+            self._call_with_retry(report, self._api.multicast, chunk, messages, retry_key=retry_key)
+            with self._lock:
+                report.sent.extend(chunk)
+            return
+        except Exception as e:
+            status = _status_code(e)
+            if not isinstance(e, LineBotApiError) or _is_retryable(e) or len(chunk) == 1:
+                with self._lock:
+                    for uid in chunk:
+                        report.failed[uid] = _describe(e)
+                return
+            logging.warning(f"⚠️ multicast失敗（{status}）のため1人ずつ送り直します: {len(chunk)}人")
+
+        for uid in chunk:
+            try:
+                with self._lock:
+                    report.push_calls += 1
+                self._call_with_retry(report, self._api.push_message, uid, messages,
+                                      retry_key=push_retry_key(retry_key, uid))
+                with self._lock:
+                    report.sent.append(uid)
+            except Exception as e:
+                with self._lock:
+                    report.failed[uid] = _describe(e)
+
+    def send(self, uids, messages):
+        chunks = chunk_recipients(uids)
+        report = FanoutReport([uid for chunk in chunks for uid in chunk])
+        started = time.monotonic()
+        if len(chunks) == 1:
+            self._send_chunk(report, chunks[0], messages)
+        elif chunks:
+            with ThreadPoolExecutor(max_workers=min(self._concurrency, len(chunks))) as executor:
+                for future in [executor.submit(self._send_chunk, report, chunk, messages) for chunk in chunks]:
+                    future.result()
+        report.elapsed = time.monotonic() - started
+        if report.failed:
+            sample = dict(list(report.failed.items())[:10])
+            logging.error(f"❌ 一斉送信で{len(report.failed)}人に送れませんでした: {sample}")
+        logging.info(f"📣 {report.summary()}")
+        return report
+
+
+def fan_out(api, uids, messages):
+    return FanoutDispatcher(api).send(uids, messages)
@@ -0,0 +1,33 @@
+# local_store.py　ローカルに置くSQLiteファイルの共通処理
+#
+# 同じファイルを複数のgunicornワーカーから開いても壊れないよう、WALモードで開く。
+# 接続はスレッドごとに1本を使い回す。
+
+import os
+import sqlite3
+import threading
+
+DATA_DIR = os.getenv("AIKO_DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
+
+_local = threading.local()
+
+
+def get_db_path(name):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return os.path.join(DATA_DIR, f"{name}.sqlite3")
+
+
+# schema は初回接続時に1回だけ流すCREATE文（複数文可）
+def get_connection(name, schema=""):
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(name)
+    if conn is None:
+        conn = sqlite3.connect(get_db_path(name), timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if schema:
+            conn.executescript(schema)
+        connections[name] = conn
+    return conn
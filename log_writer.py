@@ -0,0 +1,273 @@
+# log_writer.py　スプレッドシートへの追記をまとめて行う書き込み係
+#
+# ・write_* はメモリ上のキューに行を積むだけで、すぐに戻る
+# ・件数（LOG_BATCH_SIZE）か経過時間（LOG_FLUSH_INTERVAL秒）のどちらかで、シートごとに複数行を1回でappendする
+# ・Sheetsが失敗・遅延しているあいだは行をローカルのSQLite（spool）に退避し、復旧後に順番どおり書き戻す
+# ・書き戻す行は期限付きで「取り出し中」にし、appendが成功してから消す。途中でプロセスが落ちても、
+#   期限（LOG_SPOOL_LEASE_SECONDS）が過ぎれば別のワーカーが書き戻す（失うより二重に書くほうを選ぶ）
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from local_store import get_connection
+from metrics import timed
+
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "50"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "2"))
+# 1回のappendがこれより遅ければ「遅延中」とみなし、しばらく直接spoolに書く
+LOG_SLOW_APPEND_SECONDS = float(os.getenv("LOG_SLOW_APPEND_SECONDS", "5"))
+# 失敗・遅延のあと、Sheetsへの書き戻しを再開するまでの待ち時間（秒）
+LOG_RETRY_INTERVAL = float(os.getenv("LOG_RETRY_INTERVAL", "30"))
+# メモリに積める最大行数。超えた分はspoolに書く
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "5000"))
+# 書き戻し中の行を他のワーカーに渡さない時間（秒）
+LOG_SPOOL_LEASE_SECONDS = float(os.getenv("LOG_SPOOL_LEASE_SECONDS", "300"))
+
+SPOOL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    target TEXT NOT NULL,
+    row_json TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    claimed_by TEXT,
+    lease_until REAL
+);
+"""
+# 取り出し中の印がない古いspoolファイルに足す列
+SPOOL_LEASE_COLUMNS = (("claimed_by", "TEXT"), ("lease_until", "REAL"))
+
+# 書き込み先名 → {"env_key", "range", "label", "after_flush"}
+_targets = {}
+_queue = deque()
+_cond = threading.Condition()
+_thread = None
+_spool_checked = False
+# 書き込み（キューの取り出しからappendまで）は1つずつ行う。裏のスレッド・atexit・明示的な呼び出しが重なっても行の順番が崩れないように
+_flush_lock = threading.Lock()
+# キューが空のときに spool を見に行く次の時刻（空のたびにSQLiteを読まないため、LOG_RETRY_INTERVAL 秒に1回まで）
+_next_idle_spool_check = 0.0
+_sheets_down_until = 0.0
+_stats = {"enqueued": 0, "appends": 0, "rows_written": 0, "spooled": 0, "replayed": 0, "errors": 0}
+
+
+# after_flush は書き込み成功後に呼ぶ関数（スナップショットの無効化など）
+def register_sheet_target(name, env_key, sheet_range, label, after_flush=None):
+    _targets[name] = {"env_key": env_key, "range": sheet_range, "label": label, "after_flush": after_flush}
+
+
+def _spool():
+    global _spool_checked
+    conn = get_connection("log_spool", SPOOL_SCHEMA)
+    if not _spool_checked:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(spool)")}
+        for name, column_type in SPOOL_LEASE_COLUMNS:
+            if name not in columns:
+                try:
+                    conn.execute(f"ALTER TABLE spool ADD COLUMN {name} {column_type}")
+                except Exception as e:
+                    # 他のワーカーが先に足した場合
+                    logging.info(f"spoolの列追加をスキップ: {e}")
+        _spool_checked = True
+    return conn
+
+
+def _spool_rows(items):
+    conn = _spool()
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO spool (target, row_json, created_at) VALUES (?, ?, ?)",
+        [(target, json.dumps(row, ensure_ascii=False), created_at) for target, row, created_at in items]
+    )
+    conn.execute("COMMIT")
+    with _cond:
+        _stats["spooled"] += len(items)
+
+
+# write_* の呼び出し元が待つのはこの関数の時間だけ（sheets.write.<書き込み先> に記録）
+def enqueue_row(target, row):
+    with timed(f"sheets.write.{target}"):
+        _enqueue_row(target, row)
+
+
+def _enqueue_row(target, row):
+    if target not in _targets:
+        raise KeyError(f"未登録の書き込み先: {target}")
+    _ensure_thread()
+    item = (target, row, time.time())
+    with _cond:
+        _stats["enqueued"] += 1
+        if len(_queue) < LOG_QUEUE_MAX:
+            _queue.append(item)
+            if len(_queue) >= LOG_BATCH_SIZE:
+                _cond.notify()
+            return
+    _spool_rows([item])
+
+
+def _group_by_target(items):
+    grouped = {}
+    for target, row, _ in items:
+        grouped.setdefault(target, []).append(row)
+    return grouped
+
+
+# 1つの書き込み先へ複数行をまとめて追記する。遅すぎた場合も成功として扱うが、しばらくspoolに切り替える
+def _append_rows(target, rows):
+    global _sheets_down_until
+    from company_info_load import get_google_sheets_service
+
+    spec = _targets[target]
+    sheet_service = get_google_sheets_service()
+    if not sheet_service:
+        raise RuntimeError("シートサービスの取得に失敗しました")
+    started = time.monotonic()
+    with timed(f"sheets.append.{target}"):
+        sheet_service.append(
+            spreadsheetId=os.getenv(spec["env_key"]),
+            range=spec["range"],
+            valueInputOption="USER_ENTERED",
+            insertDataOption="INSERT_ROWS",
+            body={"values": rows}
+        ).execute()
+    elapsed = time.monotonic() - started
+    with _cond:
+        _stats["appends"] += 1
+        _stats["rows_written"] += len(rows)
+        if elapsed > LOG_SLOW_APPEND_SECONDS:
+            logging.warning(f"⚠️ {spec['label']}の書き込みが遅延しています（{elapsed:.1f}秒）。しばらくローカルに退避します")
+            _sheets_down_until = time.monotonic() + LOG_RETRY_INTERVAL
+    if spec["after_flush"]:
+        try:
+            spec["after_flush"]()
+        except Exception as e:
+            logging.error(f"❌ 書き込み後処理エラー: {e}")
+
+
+# spoolの行を古い順に書き戻す。途中で失敗したらそこで止める
+# 複数ワーカーが同じspoolを共有するので、取り出す行には自分の印と期限を付けて他のワーカーと重複しないようにし、
+# appendが成功した分だけ消す。まだ登録されていない書き込み先の行は、登録されるまでspoolに残す
+def _replay_spool():
+    conn = _spool()
+    owner = f"{os.getpid()}:{threading.get_ident()}"
+    while True:
+        targets = list(_targets)
+        if not targets:
+            return True
+        now = time.time()
+        placeholders = ",".join("?" * len(targets))
+        conn.execute("BEGIN IMMEDIATE")
+        records = conn.execute(
+            f"SELECT id, target, row_json FROM spool WHERE target IN ({placeholders})"
+            " AND (lease_until IS NULL OR lease_until < ?) ORDER BY id LIMIT ?",
+            (*targets, now, LOG_BATCH_SIZE * 10)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE spool SET claimed_by = ?, lease_until = ? WHERE id = ?",
+            [(owner, now + LOG_SPOOL_LEASE_SECONDS, record[0]) for record in records]
+        )
+        conn.execute("COMMIT")
+        if not records:
+            return True
+
+        grouped = {}
+        for record in records:
+            grouped.setdefault(record[1], []).append(record)
+        try:
+            for target, entries in list(grouped.items()):
+                _append_rows(target, [json.loads(entry[2]) for entry in entries])
+                conn.executemany(
+                    "DELETE FROM spool WHERE id = ? AND claimed_by = ?", [(entry[0], owner) for entry in entries]
+                )
+                with _cond:
+                    _stats["replayed"] += len(entries)
+                del grouped[target]
+        except Exception:
+            # 書けなかった行は取り出し中の印を外し、次の書き戻しで拾えるようにする
+            conn.executemany(
+                "UPDATE spool SET claimed_by = NULL, lease_until = NULL WHERE id = ? AND claimed_by = ?",
+                [(entry[0], owner) for entries in grouped.values() for entry in entries]
+            )
+            raise
+        if time.monotonic() < _sheets_down_until:
+            return False
+
+
+def _has_spooled_rows():
+    return _spool().execute("SELECT 1 FROM spool LIMIT 1").fetchone() is not None
+
+
+def flush_log_writer():
+    with _flush_lock:
+        _flush()
+
+
+def _flush():
+    global _sheets_down_until, _next_idle_spool_check
+    with _cond:
+        items = list(_queue)
+        _queue.clear()
+
+    if time.monotonic() < _sheets_down_until:
+        if items:
+            _spool_rows(items)
+        return
+
+    if not items:
+        # 積まれた行がなければ、ときどき spool（他のワーカーや前回の起動の残り）を確かめるだけ
+        if time.monotonic() < _next_idle_spool_check:
+            return
+        _next_idle_spool_check = time.monotonic() + LOG_RETRY_INTERVAL
+
+    try:
+        # 順番を保つため、退避済みの行を先に書き戻す
+        if _has_spooled_rows() and not _replay_spool():
+            if items:
+                _spool_rows(items)
+            return
+        for target, rows in _group_by_target(items).items():
+            _append_rows(target, rows)
+            items = [item for item in items if item[0] != target]
+    except Exception as e:
+        logging.error(f"❌ シート書き込みエラー（ローカルに退避します）: {e}")
+        with _cond:
+            _stats["errors"] += 1
+            _sheets_down_until = time.monotonic() + LOG_RETRY_INTERVAL
+        if items:
+            _spool_rows(items)
+
+
+def _run():
+    while True:
+        with _cond:
+            _cond.wait_for(lambda: len(_queue) >= LOG_BATCH_SIZE, timeout=LOG_FLUSH_INTERVAL)
+        try:
+            flush_log_writer()
+        except Exception as e:
+            logging.error(f"❌ ログ書き込みスレッドエラー: {e}")
+
+
+def _ensure_thread():
+    global _thread
+    if _thread is not None:
+        return
+    with _cond:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name="log-writer", daemon=True)
+            _thread.start()
+            atexit.register(flush_log_writer)
+
+
+def get_log_writer_stats():
+    with _cond:
+        stats = dict(_stats)
+        stats["queued"] = len(_queue)
+        stats["sheets_down"] = time.monotonic() < _sheets_down_until
+    try:
+        stats["spool_rows"] = _spool().execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+    except Exception:
+        stats["spool_rows"] = None
+    return stats
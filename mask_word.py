@@ -2,50 +2,140 @@
 
 import re
 import uuid
-from openai import OpenAI
-import os
+import threading
+from intent_matcher import SENSITIVE_KEYWORDS, scan_intents
+from company_info_load import get_employee_directory
+from employee_directory import ADDRESS_COL
+from clients import get_openai_client
+from metrics import timed
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 個人情報が含まれるか判定（キーワード一覧は intent_matcher.SENSITIVE_KEYWORDS）
+def contains_sensitive_info(text):
+    return scan_intents(text).has("sensitive")
 
-# 個人情報らしいワード（OpenAI経由禁止）
-SENSITIVE_KEYWORDS = [
-    "誕生日", "生年月日", "入社", "入社年", "住所", "電話", "家族", "名前", "氏名",
-    "読み", "ふりがな", "携帯", "出身", "血液型", "メール", "メールアドレス",
-    "年齢", "生まれ", "個人", "趣味", "特技", "身長", "体重"
-]
+# === マスキング ===
+# 構造を持つ個人情報（メール・電話番号・郵便番号）は正規表現で、
+# キーワードと従業員情報の住所は文字列そのままで、1本の正規表現にまとめて1回で置換する
+# メールアドレスはASCIIだけで組み立てる（\w だと「メールはyamada@...」の「メールは」まで巻き込む）
+EMAIL_PATTERN = r"[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+"
+PHONE_PATTERN = r"(?<!\d)(?:\+81[-\s]?|0)\d{1,4}[-\s]?\d{1,4}[-\s]?\d{3,4}(?!\d)"
+POSTAL_PATTERN = r"〒\s?\d{3}-?\d{4}|(?<![\d-])\d{3}-\d{4}(?![\d-])"
+# 住所などシートの値をそのまま使う場合の最小文字数（短すぎる値で普通の語を潰さないため）
+MIN_LITERAL_LENGTH = 4
 
-# 個人情報が含まれるか判定
-def contains_sensitive_info(text):
-    pattern = "|".join(map(re.escape, SENSITIVE_KEYWORDS))
-    return re.search(pattern, text, re.IGNORECASE) is not None
+MASK_TOKEN_PREFIX = "[[MASK-"
+MASK_TOKEN_PATTERN = re.compile(r"\[\[MASK-[0-9a-f]{6}\]\]")
+MASK_TOKEN_LENGTH = len("[[MASK-000000]]")
+
+_mask_pattern = None
+_mask_pattern_source = None
+_mask_pattern_lock = threading.Lock()
 
-# テキストをダミーに置換（マスキング）
+def _build_mask_pattern(directory):
+    literals = set(SENSITIVE_KEYWORDS)
+    for row in directory.rows:
+        address = row[ADDRESS_COL].strip() if len(row) > ADDRESS_COL else ""
+        if len(address) >= MIN_LITERAL_LENGTH:
+            literals.add(address)
+    # 長い語を先に置き、「メールアドレス」が「メール」に負けないようにする
+    literal_pattern = "|".join(map(re.escape, sorted(literals, key=len, reverse=True)))
+    return re.compile(f"{EMAIL_PATTERN}|{PHONE_PATTERN}|{POSTAL_PATTERN}|{literal_pattern}")
+
+# 従業員情報が変わったときだけ正規表現を作り直す
+def get_mask_pattern():
+    global _mask_pattern, _mask_pattern_source
+    directory = get_employee_directory()
+    if _mask_pattern is None or _mask_pattern_source is not directory:
+        with _mask_pattern_lock:
+            if _mask_pattern is None or _mask_pattern_source is not directory:
+                _mask_pattern = _build_mask_pattern(directory)
+                _mask_pattern_source = directory
+    return _mask_pattern
+
+# テキストをダミーに置換（マスキング）。置換と mask_map の作成を1回の走査で行う
 def mask_sensitive_data(text):
     mask_map = {}
-    masked_text = text
-    for word in set(re.findall('|'.join(SENSITIVE_KEYWORDS), text)):
-        mask = f"[[MASK-{uuid.uuid4().hex[:6]}]]"
-        mask_map[mask] = word
-        masked_text = masked_text.replace(word, mask)
+    masks = {}
+
+    def replace(match):
+        word = match.group(0)
+        mask = masks.get(word)
+        if mask is None:
+            mask = f"{MASK_TOKEN_PREFIX}{uuid.uuid4().hex[:6]}]]"
+            while mask in mask_map:
+                mask = f"{MASK_TOKEN_PREFIX}{uuid.uuid4().hex[:6]}]]"
+            masks[word] = mask
+            mask_map[mask] = word
+        return mask
+
+    masked_text = get_mask_pattern().sub(replace, text)
     return masked_text, mask_map
 
-# ダミーを元の語に戻す（アンマスキング）
+# ダミーを元の語に戻す（アンマスキング）。1回の走査で全部戻す
 def unmask_sensitive_data(text, mask_map):
-    for mask, original in mask_map.items():
-        text = text.replace(mask, original)
-    return text
+    if not mask_map:
+        return text
+    return MASK_TOKEN_PATTERN.sub(lambda match: mask_map.get(match.group(0), match.group(0)), text)
+
+# 末尾がダミーの書きかけ（"[[MAS" など）になりうるか
+def _is_partial_mask_token(tail):
+    if len(tail) >= MASK_TOKEN_LENGTH:
+        return False
+    head = tail[:len(MASK_TOKEN_PREFIX)]
+    if not MASK_TOKEN_PREFIX.startswith(head):
+        return False
+    rest = tail[len(MASK_TOKEN_PREFIX):]
+    hex_part = rest[:6]
+    if any(ch not in "0123456789abcdef" for ch in hex_part):
+        return False
+    return "]]".startswith(rest[6:])
+
+# ストリーミング応答を少しずつ戻す。ダミーが途中で切れている間はその部分だけ持ち越す
+class StreamingUnmasker:
+    def __init__(self, mask_map):
+        self.mask_map = mask_map
+        self._pending = ""
+
+    def feed(self, chunk):
+        text = self._pending + chunk
+        cut = len(text)
+        start = max(0, len(text) - MASK_TOKEN_LENGTH + 1)
+        position = text.find("[", start)
+        while position != -1:
+            if _is_partial_mask_token(text[position:]):
+                cut = position
+                break
+            position = text.find("[", position + 1)
+        self._pending = text[cut:]
+        return unmask_sensitive_data(text[:cut], self.mask_map)
+
+    def finish(self):
+        text, self._pending = self._pending, ""
+        return unmask_sensitive_data(text, self.mask_map)
+
+def unmask_stream(chunks, mask_map):
+    unmasker = StreamingUnmasker(mask_map)
+    for chunk in chunks:
+        text = unmasker.feed(chunk)
+        if text:
+            yield text
+    rest = unmasker.finish()
+    if rest:
+        yield rest
 
 # OpenAIで自然な日本語に整形（マスク付き）
+@timed("rephrase_with_masked_text")
 def rephrase_with_masked_text(masked_input):
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたはサンネームで自然な日本語に直すAIアシスタント愛子です。以下は社内情報の候補です。自然な日本語でまとめてください。ただし個人情報はマスク済みです。"},
-                {"role": "user", "content": masked_input}
-            ],
-            temperature=0.7
-        )
+        with timed("openai.rephrase_with_masked_text"):
+            response = get_openai_client().chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": "あなたはサンネームで自然な日本語に直すAIアシスタント愛子です。以下は社内情報の候補です。自然な日本語でまとめてください。ただし個人情報はマスク済みです。"},
+                    {"role": "user", "content": masked_input}
+                ],
+                temperature=0.7
+            )
         return response.choices[0].message.content.strip()
     except Exception as e:
         return f"[マスク応答失敗]: {e}"
@@ -0,0 +1,183 @@
+# metrics.py　外部呼び出し・処理段階の所要時間の記録と Prometheus 形式での出力
+#
+# ・処理名（operation）ごとに固定のバケットを持つヒストグラムへ所要時間を足していく
+#   （1回の記録はバケット位置の二分探索と数個の加算だけ。値そのものは保存しない）
+# ・p50 / p95 / p99 はバケットの中を直線補間して求める（Prometheus の histogram_quantile と同じ考え方）
+# ・例外で抜けた呼び出しはエラーとして数える
+# ・使い方:
+#     with timed("sheets.fetch.employee"):
+#         ...
+#     @timed("gmail.send")
+#     def send(...): ...
+
+import time
+import bisect
+import threading
+from functools import wraps
+
+# バケットの上限（秒）。これを超えたものは +Inf に入る
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = "aiko_operation"
+
+_histograms = {}
+_registry_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # 最後の要素は +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, error=False):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if error:
+                self.errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.count, self.errors, self.total
+
+    # バケットの数から分位点を推定する。+Inf に入った分は最後のバケットの上限を返す
+    def quantile(self, q, counts=None, count=None):
+        if counts is None:
+            counts, count, _, _ = self.snapshot()
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+def get_histogram(operation):
+    histogram = _histograms.get(operation)
+    if histogram is None:
+        with _registry_lock:
+            histogram = _histograms.get(operation)
+            if histogram is None:
+                histogram = _histograms[operation] = Histogram()
+    return histogram
+
+
+def observe(operation, seconds, error=False):
+    get_histogram(operation).observe(seconds, error)
+
+
+# with 文でもデコレータでも使える計測
+class timed:
+    def __init__(self, operation):
+        self.operation = operation
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.operation, time.perf_counter() - self._started, exc_type is not None)
+        return False
+
+    def __call__(self, fn):
+        operation = self.operation
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            error = True
+            try:
+                result = fn(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                observe(operation, time.perf_counter() - started, error)
+        return wrapper
+
+
+# インスタンスのメソッドを計測付きに差し替える（LineBotApi など、呼び出し元が多いクライアント用）
+def instrument_methods(obj, prefix, names):
+    for name in names:
+        method = getattr(obj, name, None)
+        if method is not None:
+            setattr(obj, name, timed(f"{prefix}.{name}")(method))
+    return obj
+
+
+def reset_metrics():
+    with _registry_lock:
+        _histograms.clear()
+
+
+def _sorted_histograms():
+    with _registry_lock:
+        return sorted(_histograms.items())
+
+
+def get_metrics_summary():
+    summary = {}
+    for operation, histogram in _sorted_histograms():
+        counts, count, errors, total = histogram.snapshot()
+        summary[operation] = {
+            "count": count,
+            "errors": errors,
+            "error_rate": round(errors / count, 4) if count else 0.0,
+            "avg_ms": round(total / count * 1000, 1) if count else 0.0,
+            **{f"p{int(q * 100)}_ms": round(histogram.quantile(q, counts, count) * 1000, 1) for q in QUANTILES},
+        }
+    return summary
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Prometheus のテキスト形式（text/plain; version=0.0.4）
+def render_prometheus():
+    duration = f"{METRIC_PREFIX}_duration_seconds"
+    lines = [
+        f"# HELP {duration} 外部呼び出し・処理段階の所要時間",
+        f"# TYPE {duration} histogram",
+    ]
+    quantile_lines = [
+        f"# HELP {duration}_quantile バケットから推定した所要時間の分位点",
+        f"# TYPE {duration}_quantile gauge",
+    ]
+    error_lines = [
+        f"# HELP {METRIC_PREFIX}_errors_total 例外で終わった呼び出しの数",
+        f"# TYPE {METRIC_PREFIX}_errors_total counter",
+    ]
+    rate_lines = [
+        f"# HELP {METRIC_PREFIX}_error_ratio 呼び出しのうち例外で終わった割合",
+        f"# TYPE {METRIC_PREFIX}_error_ratio gauge",
+    ]
+    for operation, histogram in _sorted_histograms():
+        counts, count, errors, total = histogram.snapshot()
+        label = operation.replace("\\", "\\\\").replace('"', '\\"')
+        cumulative = 0
+        for upper, bucket_count in zip(histogram.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append(f'{duration}_bucket{{operation="{label}",le="{upper}"}} {cumulative}')
+        lines.append(f'{duration}_sum{{operation="{label}"}} {_format_value(total)}')
+        lines.append(f'{duration}_count{{operation="{label}"}} {count}')
+        for q in QUANTILES:
+            value = histogram.quantile(q, counts, count)
+            quantile_lines.append(f'{duration}_quantile{{operation="{label}",quantile="{q}"}} {_format_value(value)}')
+        error_lines.append(f'{METRIC_PREFIX}_errors_total{{operation="{label}"}} {errors}')
+        rate_lines.append(f'{METRIC_PREFIX}_error_ratio{{operation="{label}"}} {_format_value(errors / count if count else 0.0)}')
+    return "\n".join(lines + quantile_lines + error_lines + rate_lines) + "\n"
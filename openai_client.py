@@ -1,17 +1,13 @@
 # openai_client.py
-import os
-import logging
-from openai import OpenAI
+#
+# OpenAIクライアントは clients.get_openai_client() で初回利用時に作る。
+# 以前の `from openai_client import client` も動くよう、client 属性は参照されたときに作って返す
+# （import時にクライアントを作らないよう、新しいコードでは get_openai_client を使うこと）
 
-# OpenAI APIキーの取得と検証
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    logging.critical("❌ OPENAI_API_KEY が環境変数に設定されていません。")
-    raise ValueError("OPENAI_API_KEY is not set.")
+from clients import get_openai_client
 
-# OpenAI クライアントの初期化
-try:
-    client = OpenAI(api_key=api_key)
-except Exception as e:
-    logging.critical(f"❌ OpenAIクライアントの初期化に失敗しました: {e}")
-    raise
+
+def __getattr__(name):
+    if name == "client":
+        return get_openai_client()
+    raise AttributeError(name)
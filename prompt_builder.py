@@ -0,0 +1,148 @@
+# prompt_builder.py　generate_contextual_reply 用のプロンプト組み立て
+#
+# ・セクションごとにトークン数の上限を設け、超えた分は古い行から落とす
+# ・変わりにくいものから順に並べる（固定の指示 → 社内背景のスナップショット → ユーザー履歴 → 新しい入力）。
+#   社内背景は BACKGROUND_REFRESH_SECONDS の間は同じ内容を使い続けるので、
+#   OpenAI側のプロンプト先頭キャッシュが効く
+# ・呼び出しごとのプロンプトトークン数とキャッシュされたトークン数を記録する
+
+import os
+import time
+import logging
+import threading
+
+SYSTEM_INSTRUCTION = (
+    "あなたは社内専用のAIアシスタント愛子です。従業員には情報をすべて開示しなさい。\n"
+    "以下の社内背景と、このユーザーとの直近の会話を踏まえて、自然に応答してください。"
+)
+
+PROMPT_BUDGET_BACKGROUND = int(os.getenv("PROMPT_BUDGET_BACKGROUND", "1500"))
+PROMPT_BUDGET_HISTORY = int(os.getenv("PROMPT_BUDGET_HISTORY", "800"))
+PROMPT_BUDGET_MESSAGE = int(os.getenv("PROMPT_BUDGET_MESSAGE", "600"))
+BACKGROUND_REFRESH_SECONDS = int(os.getenv("PROMPT_BACKGROUND_REFRESH", "300"))
+
+_encoder = None
+_encoder_checked = False
+_background = {"text": "", "built_at": float("-inf")}
+_background_lock = threading.Lock()
+_usage_lock = threading.Lock()
+_usage_stats = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+
+def _get_encoder():
+    global _encoder, _encoder_checked
+    if not _encoder_checked:
+        try:
+            import tiktoken
+            _encoder = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoder = None
+        _encoder_checked = True
+    return _encoder
+
+
+# tiktoken があれば正確に、なければ概算（日本語は1文字≒1トークン、英数字は4文字≒1トークン）で数える
+def count_tokens(text):
+    encoder = _get_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text))
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+# 新しい行を優先して、上限に収まるだけ残す（行の順番は保つ）
+def fit_lines(lines, budget):
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        tokens = count_tokens(line) + 1
+        if used + tokens > budget:
+            break
+        kept.append(line)
+        used += tokens
+    kept.reverse()
+    return kept
+
+
+def fit_text(text, budget):
+    if count_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+# 社内背景：他の人の発言だけを重複なしで並べ、[重要] などの付記は外す
+def _build_background(global_lines):
+    lines = []
+    seen = set()
+    for line in global_lines:
+        if not line.startswith("ユーザー: "):
+            continue
+        text = line[len("ユーザー: "):].replace(" [重要]", "").strip()
+        if text and text not in seen:
+            seen.add(text)
+            lines.append(f"・{text}")
+    return "\n".join(fit_lines(lines, PROMPT_BUDGET_BACKGROUND))
+
+
+# BACKGROUND_REFRESH_SECONDS ごとにだけ作り直す（その間はプロンプトの先頭が変わらない）
+def get_background_snapshot(load_global_lines):
+    now = time.monotonic()
+    with _background_lock:
+        if now - _background["built_at"] >= BACKGROUND_REFRESH_SECONDS:
+            _background["text"] = _build_background(load_global_lines())
+            _background["built_at"] = now
+        return _background["text"]
+
+
+def build_contextual_messages(background, history_lines, user_message):
+    system_content = f"{SYSTEM_INSTRUCTION}\n\n【社内背景】\n{background or 'なし'}"
+    history = "\n".join(fit_lines(history_lines, PROMPT_BUDGET_HISTORY))
+    user_content = (
+        f"【このユーザーの履歴】\n{history or 'なし'}\n\n"
+        f"ユーザーの入力: {fit_text(user_message, PROMPT_BUDGET_MESSAGE)}"
+    )
+    return [
+        {"role": "system", "content": system_content},
+        {"role": "user", "content": user_content},
+    ]
+
+
+def _cached_tokens(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None and isinstance(getattr(usage, "model_extra", None), dict):
+        details = usage.model_extra.get("prompt_tokens_details")
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+# APIの応答から、プロンプトトークン数とキャッシュされたトークン数を記録して返す
+def record_prompt_usage(response, label="contextual_reply"):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    record = {
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "cached_tokens": _cached_tokens(usage),
+        "completion_tokens": usage.completion_tokens or 0,
+    }
+    with _usage_lock:
+        _usage_stats["calls"] += 1
+        for key, value in record.items():
+            _usage_stats[key] += value
+    logging.info(f"🧮 {label}: prompt={record['prompt_tokens']} cached={record['cached_tokens']} completion={record['completion_tokens']}")
+    return record
+
+
+def get_prompt_usage_stats():
+    with _usage_lock:
+        stats = dict(_usage_stats)
+    stats["cache_hit_ratio"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else 0.0
+    return stats
@@ -0,0 +1,181 @@
+# response_cache.py　よくある質問への応答キャッシュ
+#
+# ・正規化した質問文で完全一致を引き、外れたら同じ範囲の質問と文字n-gram TF-IDFのコサイン類似度で近いものを探す
+# ・範囲（scope）は、誰に聞かれても同じ答えになるもの（社内情報の検索結果）は共有、
+#   会話履歴に左右される応答はユーザーごと。別のユーザーの個別の応答は返さない
+# ・TTLで期限切れ、件数上限を超えたら最後に使われたのが古いものから捨てる
+# ・従業員・取引先・会社のスナップショットが更新されたら全件捨てる
+
+import os
+import time
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from intent_matcher import scan_intents
+
+SHARED_SCOPE = "_shared"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "500"))
+# これ以上似ていれば同じ質問とみなす
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.8"))
+# このスナップショットが変わったら応答を作り直す
+SNAPSHOT_DEPENDENCIES = ("employee", "partner", "company")
+
+
+# 全角半角・大文字小文字・空白・記号の違いを吸収する
+def normalize_question(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(ch for ch in text if ch.isalnum())
+
+
+def _snapshot_versions():
+    from company_info_load import get_snapshot_version
+    return tuple(get_snapshot_version(name) for name in SNAPSHOT_DEPENDENCIES)
+
+
+# 質問に出てくる個人情報ワードと従業員名
+def _question_subjects(message):
+    subjects = set(scan_intents(message).words("sensitive"))
+    try:
+        from company_info_load import get_employee_directory
+        directory = get_employee_directory()
+        subjects.update(directory.name_of(row) for row in directory.find_in_text(message))
+    except Exception as e:
+        logging.error(f"❌ 応答キャッシュの従業員名確認に失敗: {e}")
+    return frozenset(subjects)
+
+
+class ResponseCache:
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_SIZE,
+                 similarity=RESPONSE_CACHE_SIMILARITY, versions=_snapshot_versions):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._similarity = similarity
+        self._versions = versions
+        self._lock = threading.Lock()
+        # (scope, 正規化した質問) → (応答, 期限, 個人情報ワードと従業員名)
+        self._entries = OrderedDict()
+        # scope → (質問の一覧, vectorizer, 行列)。中身が変わったら消して次の検索で作り直す
+        self._indexes = {}
+        self._current_versions = None
+        self._stats = {"lookups": 0, "exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    def _check_versions(self):
+        versions = self._versions()
+        if versions != self._current_versions:
+            if self._entries:
+                self._stats["invalidations"] += 1
+                logging.info("🔄 スナップショット更新のため応答キャッシュを破棄しました")
+            self._entries.clear()
+            self._indexes.clear()
+            self._current_versions = versions
+
+    def _drop(self, key):
+        del self._entries[key]
+        self._indexes.pop(key[0], None)
+
+    def _scope_index(self, scope, now):
+        index = self._indexes.get(scope)
+        if index is None:
+            questions = [question for (entry_scope, question), entry in self._entries.items()
+                         if entry_scope == scope and entry[1] > now]
+            if not questions:
+                return None
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            vectorizer = TfidfVectorizer(analyzer="char", ngram_range=(1, 3), sublinear_tf=True)
+            index = self._indexes[scope] = (questions, vectorizer, vectorizer.fit_transform(questions))
+        return index
+
+    # 完全一致 → 類似の順に探す。見つからなければ None
+    def get(self, scope, message):
+        question = normalize_question(message)
+        if not question:
+            return None
+        subjects = _question_subjects(message)
+        now = time.time()
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._check_versions()
+            key = (scope, question)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["exact_hits"] += 1
+                return entry[0]
+
+            similar_key = self._find_similar(scope, question, subjects, now)
+            if similar_key is not None:
+                self._entries.move_to_end(similar_key)
+                self._stats["similar_hits"] += 1
+                return self._entries[similar_key][0]
+            self._stats["misses"] += 1
+            return None
+
+    def _find_similar(self, scope, question, subjects, now):
+        index = self._scope_index(scope, now)
+        if index is None:
+            return None
+        questions, vectorizer, matrix = index
+        # TF-IDFは行ごとにL2正規化されているので、内積がそのままコサイン類似度。
+        # 語彙にないn-gramは変換で消えてしまうので、語彙に含まれる割合（の平方根）を掛けて、
+        # 余計な語が付いた質問（「会社の住所と電話番号は？」など）を似ているとみなさない
+        grams = set(vectorizer.build_analyzer()(question))
+        coverage = sum(1 for gram in grams if gram in vectorizer.vocabulary_) / len(grams)
+        scores = (matrix @ vectorizer.transform([question]).T).toarray().ravel() * coverage ** 0.5
+        best = int(scores.argmax())
+        if scores[best] < self._similarity:
+            return None
+        key = (scope, questions[best])
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        # 「工場長の携帯」と「工場長の住所」、「田中さんの携帯」と「山田さんの携帯」のように、
+        # 聞いている個人情報の項目や人が違えば別の質問
+        if subjects != entry[2]:
+            return None
+        return key
+
+    def put(self, scope, message, reply):
+        question = normalize_question(message)
+        if not question or not reply:
+            return
+        subjects = _question_subjects(message)
+        with self._lock:
+            self._check_versions()
+            key = (scope, question)
+            self._entries[key] = (reply, time.time() + self._ttl, subjects)
+            self._entries.move_to_end(key)
+            self._indexes.pop(scope, None)
+            while len(self._entries) > self._max_entries:
+                self._drop(next(iter(self._entries)))
+            self._stats["stores"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._indexes.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        hits = stats["exact_hits"] + stats["similar_hits"]
+        stats["hit_rate"] = round(hits / stats["lookups"], 3) if stats["lookups"] else 0.0
+        return stats
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache()
+    return _response_cache
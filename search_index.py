@@ -0,0 +1,195 @@
+# search_index.py　社内シート（従業員・取引先・会社・会話ログ・経験ログ）の全文検索
+#
+# 日本語は空白で区切れないので、文字バイグラムの転置インデックスを作り、BM25で順位付けする。
+# シートのスナップショットが差し替わったときは、増えた行・消えた行だけを索引に反映する。
+
+import math
+import threading
+import unicodedata
+from collections import Counter
+from company_info_load import (
+    get_employee_info, get_partner_info, get_company_info,
+    get_conversation_log, get_experience_log
+)
+
+# 検索対象 → スナップショット取得関数
+SEARCH_SOURCES = {
+    "employee": get_employee_info,
+    "partner": get_partner_info,
+    "company": get_company_info,
+    "conversation_log": get_conversation_log,
+    "experience_log": get_experience_log,
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def normalize_text(text):
+    return unicodedata.normalize("NFKC", str(text)).lower()
+
+
+# 空白・記号をまたがない文字バイグラム（1文字だけの塊はその1文字）
+def char_bigrams(text):
+    terms = []
+    chunk = []
+    for ch in normalize_text(text) + " ":
+        if ch.isalnum():
+            chunk.append(ch)
+            continue
+        if len(chunk) == 1:
+            terms.append(chunk[0])
+        else:
+            terms.extend(chunk[i] + chunk[i + 1] for i in range(len(chunk) - 1))
+        chunk = []
+    return terms
+
+
+class SearchHit:
+    def __init__(self, source, row, score, highlights):
+        self.source = source
+        self.row = row
+        self.score = score
+        # [(列インデックス, [(開始, 終了), ...]), ...]。位置は元のセル文字列の文字位置（終了は含まない）
+        self.highlights = highlights
+
+    # 行そのもの（マスクしてプロンプトに渡すのはこちら。一致箇所の印は入れない）
+    @property
+    def text(self):
+        return str(self.row)
+
+    def __repr__(self):
+        return f"SearchHit({self.source}, score={self.score:.2f}, {self.highlights})"
+
+
+# セルの中で検索語に一致した範囲を、元の文字列の位置で返す（重なる・隣り合う範囲はまとめる）
+def highlight_spans(value, terms):
+    # 1文字ずつ正規化して、正規化後の位置 → 元の位置 の対応を作る（NFKCで長さが変わる文字があっても位置がずれない）
+    normalized = []
+    origin = []
+    for i, ch in enumerate(value):
+        for norm_ch in normalize_text(ch):
+            normalized.append(norm_ch)
+            origin.append(i)
+    normalized = "".join(normalized)
+    marked = [False] * len(value)
+    for term in terms:
+        start = normalized.find(term)
+        while start != -1:
+            for j in range(start, start + len(term)):
+                marked[origin[j]] = True
+            start = normalized.find(term, start + 1)
+    spans = []
+    for i, hit in enumerate(marked):
+        if not hit:
+            continue
+        if spans and spans[-1][1] == i:
+            spans[-1] = (spans[-1][0], i + 1)
+        else:
+            spans.append((i, i + 1))
+    return spans
+
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}          # 文書ID → (検索対象, 行)
+        self._doc_terms = {}     # 文書ID → Counter(語)
+        self._postings = {}      # 語 → {文書ID: 出現回数}
+        self._doc_length = {}    # 文書ID → 語数
+        self._row_docs = {}      # 検索対象 → {行のタプル: [文書ID, ...]}
+        self._total_length = 0
+        self._next_id = 0
+        self._synced_rows = {}   # 検索対象 → 最後に反映したスナップショット（リストそのもの）
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _add(self, source, row):
+        doc_id = self._next_id
+        self._next_id += 1
+        terms = Counter(term for cell in row for term in char_bigrams(cell))
+        self._docs[doc_id] = (source, row)
+        self._doc_terms[doc_id] = terms
+        self._doc_length[doc_id] = sum(terms.values())
+        self._total_length += self._doc_length[doc_id]
+        for term, count in terms.items():
+            self._postings.setdefault(term, {})[doc_id] = count
+        self._row_docs.setdefault(source, {}).setdefault(tuple(row), []).append(doc_id)
+
+    def _remove(self, source, row_key):
+        doc_ids = self._row_docs[source][row_key]
+        doc_id = doc_ids.pop()
+        if not doc_ids:
+            del self._row_docs[source][row_key]
+        terms = self._doc_terms.pop(doc_id)
+        del self._docs[doc_id]
+        self._total_length -= self._doc_length.pop(doc_id)
+        for term in terms:
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+
+    # スナップショットとの差分（増えた行・消えた行）だけを反映する
+    def sync_source(self, source, rows):
+        with self._lock:
+            if self._synced_rows.get(source) is rows:
+                return 0
+            wanted = Counter(tuple(row) for row in rows if row)
+            current = Counter({row_key: len(ids) for row_key, ids in self._row_docs.get(source, {}).items()})
+            changed = 0
+            for row_key, count in (current - wanted).items():
+                for _ in range(count):
+                    self._remove(source, row_key)
+                    changed += 1
+            for row_key, count in (wanted - current).items():
+                for _ in range(count):
+                    self._add(source, list(row_key))
+                    changed += 1
+            self._synced_rows[source] = rows
+            return changed
+
+    def search(self, query, limit=10):
+        query_terms = list(dict.fromkeys(char_bigrams(query)))
+        with self._lock:
+            doc_count = len(self._docs)
+            if not doc_count or not query_terms:
+                return []
+            avg_length = self._total_length / doc_count
+            scores = {}
+            for term in query_terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    length = self._doc_length[doc_id]
+                    norm = tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * norm
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+            results = [(self._docs[doc_id], score) for doc_id, score in ranked]
+
+        hits = []
+        for (source, row), score in results:
+            highlights = []
+            for index, cell in enumerate(row):
+                spans = highlight_spans(str(cell), query_terms)
+                if spans:
+                    highlights.append((index, spans))
+            hits.append(SearchHit(source, row, score, highlights))
+        return hits
+
+
+_search_index = SearchIndex()
+
+
+def get_search_index():
+    for source, loader in SEARCH_SOURCES.items():
+        _search_index.sync_source(source, loader())
+    return _search_index
+
+
+# 5つのシートを横断して、関連の高い行から limit 件を返す
+def search_company_sources(query, limit=10):
+    return get_search_index().search(query, limit)
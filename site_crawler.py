@@ -0,0 +1,262 @@
+# site_crawler.py　会社サイトの巡回（並列・条件付きGET）
+#
+# ・1つの requests.Session（接続プール・keep-alive）を全ページで使い回す
+# ・同時取得数は CRAWL_CONCURRENCY まで。同じホストへは同時 CRAWL_PER_HOST 本、間隔 CRAWL_HOST_DELAY 秒以上あける
+# ・前回の ETag / Last-Modified を付けて取得し、304なら保存済みの本文をそのまま使う（解析もしない）
+# ・200でも本文のハッシュが前回と同じなら解析を省く
+# ・ページごとの状態（ETag・Last-Modified・ハッシュ・リンク）はローカルのSQLiteに保存する。
+#   本文はハッシュをキーにした別表に置き、同じ内容は1つだけ持つ
+# ・本文が変わったページは前回の本文との unified diff を返す（変わった部分だけを要約に回すため）
+# ・requests / BeautifulSoup は巡回するときに import する（アプリの起動を遅くしないため）
+
+import os
+import time
+import difflib
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from local_store import get_connection
+
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "4"))
+CRAWL_PER_HOST = int(os.getenv("CRAWL_PER_HOST", "2"))
+CRAWL_HOST_DELAY = float(os.getenv("CRAWL_HOST_DELAY", "0.5"))
+# (接続, 読み込み) のタイムアウト秒
+CRAWL_TIMEOUT = (float(os.getenv("CRAWL_CONNECT_TIMEOUT", "5")), float(os.getenv("CRAWL_READ_TIMEOUT", "20")))
+CRAWL_USER_AGENT = os.getenv("CRAWL_USER_AGENT", "aiko-bot-site-monitor/1.0")
+
+PAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS site_pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    links TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS site_content (
+    content_hash TEXT PRIMARY KEY,
+    text TEXT NOT NULL
+);
+"""
+# unified diff の前後に付ける文脈の行数
+DIFF_CONTEXT_LINES = 1
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_crawl_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=CRAWL_CONCURRENCY, pool_maxsize=CRAWL_CONCURRENCY)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers["User-Agent"] = CRAWL_USER_AGENT
+                _session = session
+    return _session
+
+
+# ホストごとの同時接続数とリクエスト間隔を守る
+class HostLimiter:
+    def __init__(self, per_host=CRAWL_PER_HOST, delay=CRAWL_HOST_DELAY):
+        self._per_host = per_host
+        self._delay = delay
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_allowed = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._semaphores[host] = threading.BoundedSemaphore(self._per_host)
+            return semaphore
+
+    def fetch(self, url, fn):
+        host = urlsplit(url).netloc
+        with self._semaphore(host):
+            with self._lock:
+                now = time.monotonic()
+                start_at = max(now, self._next_allowed.get(host, now))
+                self._next_allowed[host] = start_at + self._delay
+            if start_at > now:
+                time.sleep(start_at - now)
+            return fn()
+
+
+class PageResult:
+    def __init__(self, url, status, text="", links=None, etag=None, last_modified=None, content_hash=None,
+                 error=None, previous_text=None):
+        self.url = url
+        # "fetched"（本文が変わった）/ "not_modified"（304）/ "unchanged"（200だがハッシュが同じ）/ "failed"
+        self.status = status
+        self.text = text
+        self.links = links or []
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+        self.error = error
+        # 本文が変わったときの前回の本文（新しいページなら None）
+        self.previous_text = previous_text
+
+    @property
+    def changed(self):
+        return self.status == "fetched"
+
+    # 前回からの変更部分（hunk）のリスト。変わっていなければ空
+    def diff_hunks(self):
+        if not self.changed:
+            return []
+        return diff_hunks(self.previous_text or "", self.text)
+
+
+def _page_db():
+    return get_connection("site_pages", PAGE_SCHEMA)
+
+
+def load_stored_pages():
+    rows = _page_db().execute(
+        "SELECT p.url, p.etag, p.last_modified, p.content_hash, c.text, p.links"
+        " FROM site_pages p LEFT JOIN site_content c ON c.content_hash = p.content_hash"
+    ).fetchall()
+    return {
+        url: {"etag": etag, "last_modified": last_modified, "content_hash": content_hash,
+              "text": text or "", "links": links.split("\n") if links else []}
+        for url, etag, last_modified, content_hash, text, links in rows
+    }
+
+
+# removed_urls はリンクがなくなったページ。本文はどのページからも参照されなくなったら消す
+def save_pages(results, removed_urls=()):
+    now = time.time()
+    saved = [result for result in results if result.status != "failed"]
+    conn = _page_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT OR IGNORE INTO site_content (content_hash, text) VALUES (?, ?)",
+            [(result.content_hash, result.text) for result in saved if result.changed]
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO site_pages (url, etag, last_modified, content_hash, links, fetched_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            [(result.url, result.etag, result.last_modified, result.content_hash, "\n".join(result.links), now)
+             for result in saved]
+        )
+        conn.executemany("DELETE FROM site_pages WHERE url = ?", [(url,) for url in removed_urls])
+        conn.execute("DELETE FROM site_content WHERE content_hash NOT IN (SELECT content_hash FROM site_pages WHERE content_hash IS NOT NULL)")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+# 行単位の unified diff を hunk（@@ で始まるまとまり）ごとに分ける
+def diff_hunks(old_text, new_text, context=DIFF_CONTEXT_LINES):
+    hunks = []
+    for line in difflib.unified_diff(old_text.splitlines(), new_text.splitlines(), n=context, lineterm=""):
+        if line.startswith("@@"):
+            hunks.append([line])
+        elif hunks:
+            hunks[-1].append(line)
+    return ["\n".join(hunk) for hunk in hunks]
+
+
+def extract_links(soup, base_url):
+    return sorted({a["href"] for a in soup.find_all("a", href=True) if base_url in a["href"]})
+
+
+def fetch_page(url, stored=None, limiter=None, base_url=None):
+    stored = stored or {}
+    headers = {}
+    if stored.get("etag"):
+        headers["If-None-Match"] = stored["etag"]
+    if stored.get("last_modified"):
+        headers["If-Modified-Since"] = stored["last_modified"]
+
+    def request():
+        return get_crawl_session().get(url, headers=headers, timeout=CRAWL_TIMEOUT)
+
+    try:
+        response = limiter.fetch(url, request) if limiter else request()
+        if response.status_code == 304 and stored:
+            return PageResult(url, "not_modified", stored["text"], stored["links"],
+                              stored.get("etag"), stored.get("last_modified"), stored.get("content_hash"))
+        response.raise_for_status()
+    except Exception as e:
+        # 取れなかったページは前回の本文のまま扱う（一時的な失敗を「変更」とみなさない）
+        return PageResult(url, "failed", stored.get("text", ""), stored.get("links"), error=str(e))
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    if stored and content_hash == stored.get("content_hash"):
+        return PageResult(url, "unchanged", stored["text"], stored["links"], etag, last_modified, content_hash)
+
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(response.text, "html.parser")
+    links = extract_links(soup, base_url) if base_url else []
+    return PageResult(url, "fetched", soup.get_text().strip(), links, etag, last_modified, content_hash,
+                      previous_text=stored.get("text"))
+
+
+class CrawlResult:
+    def __init__(self, base_url, pages, removed=None, first_run=False):
+        self.base_url = base_url
+        # url → PageResult（トップページからのリンク先、URL順）
+        self.pages = pages
+        # url → 前回の本文（リンクがなくなったページ）
+        self.removed = removed or {}
+        # 保存済みのページがない状態からの巡回（全ページが「新規」になる）
+        self.first_run = first_run
+        self.stats = {"pages": len(pages), "fetched": 0, "not_modified": 0, "unchanged": 0, "failed": 0}
+        for page in pages.values():
+            self.stats[page.status] += 1
+        self.stats["removed"] = len(self.removed)
+
+    # [(url, [hunk, ...]), ...] 変更・追加・削除のあったページだけ
+    def page_diffs(self):
+        diffs = [(url, page.diff_hunks()) for url, page in self.pages.items()]
+        diffs += [(url, diff_hunks(text, "")) for url, text in self.removed.items()]
+        return [(url, hunks) for url, hunks in diffs if hunks]
+
+    def combined_text(self):
+        return "".join(f"\n\n--- {url} ---\n{page.text}" for url, page in self.pages.items() if page.text)
+
+
+# トップページからサイト内リンクを集め、リンク先を並列に取得する
+def crawl_site(base_url):
+    stored = load_stored_pages()
+    limiter = HostLimiter()
+    started = time.monotonic()
+
+    top = fetch_page(base_url, stored.get(base_url), limiter, base_url)
+    if top.status == "failed" and not top.links:
+        raise RuntimeError(top.error)
+    links = top.links
+
+    with ThreadPoolExecutor(max_workers=CRAWL_CONCURRENCY) as executor:
+        futures = {link: executor.submit(fetch_page, link, stored.get(link), limiter)
+                   for link in links if link != base_url}
+        # トップページ自身へのリンクは取得済みの結果を使う（保存済みのリンク一覧を上書きしないため）
+        pages = {link: top if link == base_url else futures[link].result() for link in links}
+
+    for page in pages.values():
+        if page.status == "failed":
+            print(f"❌ {page.url} 読み込み失敗: {page.error}")
+    # トップページを取れなかったときはリンク一覧が古いので、消えたページの判定はしない
+    removed = {} if top.status == "failed" else {
+        url: entry["text"] for url, entry in stored.items() if url != base_url and url not in pages
+    }
+    save_pages([top] + [page for page in pages.values() if page is not top], removed)
+
+    result = CrawlResult(base_url, pages, removed, first_run=not stored)
+    logging.info(f"🌐 巡回完了 {time.monotonic() - started:.1f}秒 {result.stats}")
+    return result
@@ -0,0 +1,168 @@
+# stage_executor.py　メッセージ処理を段階（ステージ）に分けて並列に動かす
+#
+# ・start(): 応答に必要な処理と並行して裏で動かす（カテゴリ分類・名前と登録の確認など）
+# ・run():   その場で実行して時間だけ測る（認証判定・応答生成など、応答を待たせる処理）
+# ・defer(): LINEへの応答を返したあとに回す（会話ログの書き込みなど）
+# ・後回しの処理は登録順に1本の裏処理で実行し、同じユーザーなら前のメッセージの分が終わってから始める
+#   （会話ログの並びが入れ替わらないように）。後回しの処理は応答用とは別のスレッドプールで動かし、
+#   前のメッセージの分を待つ間はスレッドを使わない（終わったときに続きを積む）。
+#   ログ書き込みなどが溜まっても、次のメッセージの応答用のステージが待たされないようにするため
+# ・ステージごとの所要時間と、応答までの時間・全部を順番にやった場合の時間を記録する
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from metrics import observe
+
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", "8"))
+DEFERRED_WORKERS = int(os.getenv("DEFERRED_WORKERS", "4"))
+
+_executor = None
+_deferred_executor = None
+_executor_lock = threading.Lock()
+# ユーザー → 最後に積んだ後回し処理
+_tails = {}
+_stats_lock = threading.Lock()
+_stage_stats = {}
+_pipeline_stats = {"messages": 0, "reply_ms_total": 0.0, "serial_ms_total": 0.0, "deferred_failed": 0}
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="stage")
+    return _executor
+
+
+def _get_deferred_executor():
+    global _deferred_executor
+    if _deferred_executor is None:
+        with _executor_lock:
+            if _deferred_executor is None:
+                _deferred_executor = ThreadPoolExecutor(max_workers=DEFERRED_WORKERS, thread_name_prefix="deferred")
+    return _deferred_executor
+
+
+def _record_stage(name, elapsed_ms):
+    with _stats_lock:
+        entry = _stage_stats.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        entry["count"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+
+class StagePipeline:
+    def __init__(self, name="handle_message", user_key=None):
+        self.name = name
+        self.user_key = user_key
+        self.timings = {}
+        self._futures = {}
+        self._deferred = []
+        self._started = time.monotonic()
+        self._reply_ms = None
+
+    def _timed(self, name, fn, args, kwargs):
+        started = time.monotonic()
+        error = True
+        try:
+            result = fn(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            elapsed = time.monotonic() - started
+            self.timings[name] = elapsed * 1000
+            _record_stage(name, elapsed * 1000)
+            observe(f"stage.{name}", elapsed, error)
+
+    def start(self, name, fn, *args, **kwargs):
+        self._futures[name] = _get_executor().submit(self._timed, name, fn, args, kwargs)
+        return self._futures[name]
+
+    def run(self, name, fn, *args, **kwargs):
+        return self._timed(name, fn, args, kwargs)
+
+    def result(self, name):
+        return self._futures[name].result()
+
+    def defer(self, name, fn, *args, **kwargs):
+        self._deferred.append((name, fn, args, kwargs))
+
+    # LINEへ応答した時点で呼ぶ。ここまでの時間が利用者から見た待ち時間
+    def mark_replied(self):
+        if self._reply_ms is None:
+            elapsed = time.monotonic() - self._started
+            self._reply_ms = elapsed * 1000
+            observe(f"{self.name}.reply", elapsed)
+
+    def _run_deferred(self, done):
+        try:
+            for name, fn, args, kwargs in self._deferred:
+                try:
+                    self._timed(name, fn, args, kwargs)
+                except Exception as e:
+                    logging.error(f"❌ 後回し処理 {name} に失敗: {e}")
+                    with _stats_lock:
+                        _pipeline_stats["deferred_failed"] += 1
+            for future in self._futures.values():
+                future.exception()
+            self._report()
+        finally:
+            done.set_result(None)
+
+    # 後回しの処理を裏に回して、すぐに戻る。同じユーザーの前の分が残っていれば、それが終わったときに積む
+    def finish(self):
+        self.mark_replied()
+        done = Future()
+        with _executor_lock:
+            previous = _tails.get(self.user_key)
+            if self.user_key is not None:
+                _tails[self.user_key] = done
+        done.add_done_callback(self._forget_tail)
+
+        def submit(_=None):
+            _get_deferred_executor().submit(self._run_deferred, done)
+        if previous is None:
+            submit()
+        else:
+            previous.add_done_callback(submit)
+        return done
+
+    def _forget_tail(self, future):
+        with _executor_lock:
+            if _tails.get(self.user_key) is future:
+                del _tails[self.user_key]
+
+    def _report(self):
+        serial_ms = sum(self.timings.values())
+        reply_ms = self._reply_ms or 0.0
+        with _stats_lock:
+            _pipeline_stats["messages"] += 1
+            _pipeline_stats["reply_ms_total"] += reply_ms
+            _pipeline_stats["serial_ms_total"] += serial_ms
+        breakdown = " ".join(f"{name}={elapsed:.0f}ms" for name, elapsed in self.timings.items())
+        logging.info(f"⏱️ {self.name}: 応答まで {reply_ms:.0f}ms（順番に実行した場合 {serial_ms:.0f}ms） {breakdown}")
+
+
+def get_stage_stats():
+    with _stats_lock:
+        messages = _pipeline_stats["messages"]
+        stats = {
+            "messages": messages,
+            "deferred_failed": _pipeline_stats["deferred_failed"],
+            "avg_reply_ms": round(_pipeline_stats["reply_ms_total"] / messages, 1) if messages else 0.0,
+            "avg_serial_ms": round(_pipeline_stats["serial_ms_total"] / messages, 1) if messages else 0.0,
+            "stages": {
+                name: {
+                    "count": entry["count"],
+                    "avg_ms": round(entry["total_ms"] / entry["count"], 1),
+                    "max_ms": round(entry["max_ms"], 1),
+                }
+                for name, entry in _stage_stats.items()
+            },
+        }
+    stats["avg_saved_ms"] = round(stats["avg_serial_ms"] - stats["avg_reply_ms"], 1)
+    return stats
@@ -0,0 +1,153 @@
+# user_state_store.py　ユーザーごとの会話状態（ステップ・メール宛先・長文応答）と最終挨拶の保存先
+#
+# ・1回の読み込みで step / target / fulltext をまとめて返す
+# ・会話状態は USER_STATE_TTL 秒で期限切れになる
+# ・既定はSQLite（複数のgunicornワーカーで同じ状態を見る）。USER_STATE_BACKEND=memory で
+#   プロセス内の上限付きLRUに切り替えられる（ワーカー1つのとき用）
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from local_store import get_connection
+
+USER_STATE_BACKEND = os.getenv("USER_STATE_BACKEND", "sqlite")
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "1800"))
+# 挨拶の記録はこれだけ残せば「最近挨拶したか」の判定に足りる
+GREETING_TTL = 3 * 3600
+USER_STATE_MAX_USERS = int(os.getenv("USER_STATE_MAX_USERS", "10000"))
+# SQLiteの期限切れ行を掃除する間隔（秒）
+PURGE_INTERVAL = 600
+
+EMPTY_DIALOG = {"step": 0, "target": None, "fulltext": None}
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id TEXT PRIMARY KEY,
+    step INTEGER NOT NULL DEFAULT 0,
+    target TEXT,
+    fulltext TEXT,
+    dialog_expires_at REAL NOT NULL DEFAULT 0,
+    greeting_at REAL,
+    greeting_category TEXT
+);
+"""
+
+
+class SQLiteUserStateStore:
+    def __init__(self, name="user_state"):
+        self._name = name
+        self._last_purge = 0.0
+
+    def _conn(self):
+        return get_connection(self._name, STATE_SCHEMA)
+
+    def get(self, user_id):
+        row = self._conn().execute(
+            "SELECT step, target, fulltext, dialog_expires_at, greeting_at, greeting_category"
+            " FROM user_state WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        now = time.time()
+        if row is None:
+            return dict(EMPTY_DIALOG), None
+        step, target, fulltext, expires_at, greeting_at, greeting_category = row
+        dialog = {"step": step, "target": target, "fulltext": fulltext} if expires_at > now else dict(EMPTY_DIALOG)
+        greeting = (greeting_at, greeting_category) if greeting_at and now - greeting_at < GREETING_TTL else None
+        return dialog, greeting
+
+    def set_dialog(self, user_id, step, target, fulltext):
+        self._conn().execute(
+            "INSERT INTO user_state (user_id, step, target, fulltext, dialog_expires_at) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(user_id) DO UPDATE SET step = excluded.step, target = excluded.target,"
+            " fulltext = excluded.fulltext, dialog_expires_at = excluded.dialog_expires_at",
+            (user_id, step, target, fulltext, time.time() + USER_STATE_TTL)
+        )
+        self._maybe_purge()
+
+    def reset_dialog(self, user_id):
+        self._conn().execute(
+            "UPDATE user_state SET step = 0, target = NULL, fulltext = NULL, dialog_expires_at = 0 WHERE user_id = ?",
+            (user_id,)
+        )
+
+    def set_greeting(self, user_id, timestamp, category):
+        self._conn().execute(
+            "INSERT INTO user_state (user_id, greeting_at, greeting_category) VALUES (?, ?, ?)"
+            " ON CONFLICT(user_id) DO UPDATE SET greeting_at = excluded.greeting_at,"
+            " greeting_category = excluded.greeting_category",
+            (user_id, timestamp, category)
+        )
+        self._maybe_purge()
+
+    # 会話状態も挨拶も期限切れの行を消す
+    def _maybe_purge(self):
+        now = time.time()
+        if now - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        self._conn().execute(
+            "DELETE FROM user_state WHERE dialog_expires_at <= ? AND (greeting_at IS NULL OR greeting_at <= ?)",
+            (now, now - GREETING_TTL)
+        )
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM user_state").fetchone()[0]
+
+
+class MemoryUserStateStore:
+    def __init__(self, max_users=USER_STATE_MAX_USERS):
+        self._max_users = max_users
+        self._lock = threading.Lock()
+        # user_id → [step, target, fulltext, dialog_expires_at, greeting_at, greeting_category]
+        self._entries = OrderedDict()
+
+    def _entry(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._entries[user_id] = [0, None, None, 0.0, None, None]
+            if len(self._entries) > self._max_users:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(user_id)
+        return entry
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return dict(EMPTY_DIALOG), None
+            self._entries.move_to_end(user_id)
+            step, target, fulltext, expires_at, greeting_at, greeting_category = entry
+        dialog = {"step": step, "target": target, "fulltext": fulltext} if expires_at > now else dict(EMPTY_DIALOG)
+        greeting = (greeting_at, greeting_category) if greeting_at and now - greeting_at < GREETING_TTL else None
+        return dialog, greeting
+
+    def set_dialog(self, user_id, step, target, fulltext):
+        with self._lock:
+            self._entry(user_id)[:4] = [step, target, fulltext, time.time() + USER_STATE_TTL]
+
+    def reset_dialog(self, user_id):
+        with self._lock:
+            if user_id in self._entries:
+                self._entries[user_id][:4] = [0, None, None, 0.0]
+
+    def set_greeting(self, user_id, timestamp, category):
+        with self._lock:
+            self._entry(user_id)[4:] = [timestamp, category]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_user_state_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = MemoryUserStateStore() if USER_STATE_BACKEND == "memory" else SQLiteUserStateStore()
+    return _store
@@ -0,0 +1,155 @@
+# webhook_dedupe.py　LINE Webhookの再配信（同じイベントの2回目以降）を処理しないための記録
+#
+# ・イベントID（webhookEventId）を処理前にローカルのSQLiteへ「処理中」として登録し、登録できたときだけ処理する。
+#   登録は1文の INSERT ... ON CONFLICT で行うので、複数のワーカー・スレッドが同時に受けても処理するのは1つだけ
+# ・処理が終わったら「処理済み」にする。例外で終わったら登録を消し、LINEの再配信で処理し直せるようにする
+# ・「処理中」のまま WEBHOOK_DEDUPE_STALE_SECONDS を過ぎたもの（途中でプロセスが落ちたなど）は取り直せる
+# ・記録は WEBHOOK_DEDUPE_TTL 秒で期限切れ。件数は WEBHOOK_DEDUPE_MAX_ENTRIES までに抑える（古い順に消す）
+# ・deliveryContext.isRedelivery は集計に使う（再配信でも初めて見るIDなら、最初の配信が届かなかったとみなして処理する）
+
+import os
+import time
+import logging
+import threading
+from local_store import get_connection
+
+WEBHOOK_DEDUPE = os.getenv("WEBHOOK_DEDUPE", "1") == "1"
+WEBHOOK_DEDUPE_TTL = int(os.getenv("WEBHOOK_DEDUPE_TTL", "86400"))
+WEBHOOK_DEDUPE_STALE_SECONDS = int(os.getenv("WEBHOOK_DEDUPE_STALE_SECONDS", "300"))
+WEBHOOK_DEDUPE_MAX_ENTRIES = int(os.getenv("WEBHOOK_DEDUPE_MAX_ENTRIES", "50000"))
+# 期限切れの記録を消しに行く間隔（秒）
+DEDUPE_PRUNE_INTERVAL = 60
+
+DEDUPE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    event_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS webhook_events_updated ON webhook_events (updated_at);
+CREATE TABLE IF NOT EXISTS dedupe_counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+_lock = threading.Lock()
+_last_prune = 0.0
+_stats = {"checked": 0, "processed": 0, "suppressed": 0, "redeliveries": 0, "redeliveries_processed": 0,
+          "released": 0, "without_event_id": 0, "pruned": 0}
+
+
+def _dedupe_db():
+    return get_connection("webhook_dedupe", DEDUPE_SCHEMA)
+
+
+def get_event_id(event):
+    return getattr(event, "webhook_event_id", None)
+
+
+def is_redelivery(event):
+    context = getattr(event, "delivery_context", None)
+    return bool(getattr(context, "is_redelivery", False))
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+# 期限切れと上限超過の記録を消す（DEDUPE_PRUNE_INTERVAL 秒に1回まで）
+def _prune_if_due(conn, now):
+    global _last_prune
+    with _lock:
+        if now - _last_prune < DEDUPE_PRUNE_INTERVAL:
+            return
+        _last_prune = now
+    removed = conn.execute(
+        "DELETE FROM webhook_events WHERE (state = 'done' AND updated_at < ?) OR updated_at < ?",
+        (now - WEBHOOK_DEDUPE_TTL, now - max(WEBHOOK_DEDUPE_TTL, WEBHOOK_DEDUPE_STALE_SECONDS))
+    ).rowcount
+    excess = conn.execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0] - WEBHOOK_DEDUPE_MAX_ENTRIES
+    if excess > 0:
+        removed += conn.execute(
+            "DELETE FROM webhook_events WHERE event_id IN"
+            " (SELECT event_id FROM webhook_events ORDER BY updated_at LIMIT ?)", (excess,)
+        ).rowcount
+    if removed:
+        _count("pruned", removed)
+
+
+# 処理してよければ True（このイベントを「処理中」として登録した）。すでに処理中・処理済みなら False
+def claim_event(event):
+    if not WEBHOOK_DEDUPE:
+        return True
+    event_id = get_event_id(event)
+    redelivered = is_redelivery(event)
+    _count("checked")
+    if redelivered:
+        _count("redeliveries")
+    if not event_id:
+        _count("without_event_id")
+        return True
+
+    now = time.time()
+    conn = _dedupe_db()
+    try:
+        claimed = conn.execute(
+            "INSERT INTO webhook_events (event_id, state, updated_at) VALUES (?, 'processing', ?)"
+            " ON CONFLICT(event_id) DO UPDATE SET state = 'processing', updated_at = excluded.updated_at"
+            " WHERE (webhook_events.state = 'done' AND webhook_events.updated_at < ?)"
+            " OR (webhook_events.state = 'processing' AND webhook_events.updated_at < ?)",
+            (event_id, now, now - WEBHOOK_DEDUPE_TTL, now - WEBHOOK_DEDUPE_STALE_SECONDS)
+        ).rowcount == 1
+        _prune_if_due(conn, now)
+    except Exception as e:
+        # 記録できないときは処理する（重複より取りこぼしを避ける）
+        logging.error(f"❌ Webhook重複チェックに失敗: {e}")
+        return True
+
+    if not claimed:
+        _count("suppressed")
+        try:
+            conn.execute(
+                "INSERT INTO dedupe_counters (name, value) VALUES ('suppressed', 1)"
+                " ON CONFLICT(name) DO UPDATE SET value = value + 1"
+            )
+        except Exception as e:
+            # 集計に失敗しても、省略した判断はそのまま
+            logging.error(f"❌ Webhook重複件数の記録に失敗: {e}")
+        logging.info(f"🔁 再配信のため処理を省略: {event_id}（isRedelivery={redelivered}）")
+        return False
+    _count("processed")
+    if redelivered:
+        _count("redeliveries_processed")
+    return True
+
+
+def mark_event_done(event):
+    event_id = get_event_id(event)
+    if WEBHOOK_DEDUPE and event_id:
+        _dedupe_db().execute(
+            "UPDATE webhook_events SET state = 'done', updated_at = ? WHERE event_id = ?", (time.time(), event_id)
+        )
+
+
+# 処理に失敗したイベントの登録を消し、再配信で処理し直せるようにする
+def release_event(event):
+    event_id = get_event_id(event)
+    if WEBHOOK_DEDUPE and event_id:
+        _dedupe_db().execute("DELETE FROM webhook_events WHERE event_id = ? AND state = 'processing'", (event_id,))
+        _count("released")
+
+
+def get_dedupe_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats["enabled"] = WEBHOOK_DEDUPE
+    stats["ttl"] = WEBHOOK_DEDUPE_TTL
+    if WEBHOOK_DEDUPE:
+        conn = _dedupe_db()
+        stats["entries"] = conn.execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0]
+        row = conn.execute("SELECT value FROM dedupe_counters WHERE name = 'suppressed'").fetchone()
+        # 同じファイルを使う全ワーカーの合計
+        stats["suppressed_all_workers"] = row[0] if row else 0
+    return stats
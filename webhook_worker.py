@@ -0,0 +1,256 @@
+# webhook_worker.py　LINE Webhookのイベントを裏で処理するワーカープール
+#
+# ・/callback は署名を確認してイベントを積むだけにして、すぐに200を返す
+# ・同じユーザーのイベントは受け取った順に1件ずつ、別のユーザーのイベントは並列に処理する
+# ・積める件数には上限があり、1つのWebhookのイベントは全部積むか1件も積まないかのどちらか。
+#   あふれたときは呼び出し側が503を返し、LINEの再配信を待つ（その場で処理すると同じユーザーの順番が崩れるため）
+# ・同期処理（dispatch_events）でも、1つのWebhookに入った複数ユーザーのイベントはユーザーごとにまとめて並列に処理する
+#   （同じユーザーのイベントは届いた順に1件ずつ。同時に動かすユーザー数は WEBHOOK_DISPATCH_CONCURRENCY まで）
+# ・どの経路でも dispatch_event_once を通し、再配信されたイベントは処理しない（webhook_dedupe.py）
+
+import os
+import time
+import inspect
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from linebot.models import MessageEvent
+from metrics import observe
+from webhook_dedupe import claim_event, mark_event_done, release_event
+
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "500"))
+WEBHOOK_DISPATCH_CONCURRENCY = int(os.getenv("WEBHOOK_DISPATCH_CONCURRENCY", "8"))
+
+_dispatch_executor = None
+_dispatch_lock = threading.Lock()
+_dispatch_stats = {"bodies": 0, "events": 0, "failed": 0, "duplicates": 0, "parallel_bodies": 0, "max_users_per_body": 0,
+                   "event_ms_total": 0.0, "body_ms_total": 0.0}
+
+
+# WebhookHandler.handle と同じ規則でイベントに対応する関数を選んで呼び出す
+def dispatch_event(handler, event, destination=None):
+    func = None
+    key = None
+    if isinstance(event, MessageEvent):
+        key = f"{event.__class__.__name__}_{event.message.__class__.__name__}"
+        func = handler._handlers.get(key)
+    if func is None:
+        key = event.__class__.__name__
+        func = handler._handlers.get(key)
+    if func is None:
+        func = handler._default
+    if func is None:
+        logging.info(f"ハンドラ未登録のイベント: {key}")
+        return
+
+    arg_spec = inspect.getfullargspec(func)
+    if arg_spec.varargs is not None or len(arg_spec.args) == 2:
+        func(event, destination)
+    elif len(arg_spec.args) == 1:
+        func(event)
+    else:
+        func()
+
+
+# 同じイベントを2回処理しない。処理したら True、再配信などで省いたら False
+def dispatch_event_once(handler, event, destination=None):
+    if not claim_event(event):
+        return False
+    try:
+        dispatch_event(handler, event, destination)
+    except Exception:
+        release_event(event)
+        raise
+    mark_event_done(event)
+    return True
+
+
+def event_user_key(event):
+    source = getattr(event, "source", None)
+    return getattr(source, "user_id", None) or getattr(source, "group_id", None) or getattr(source, "room_id", None) or "_anonymous"
+
+
+def _get_dispatch_executor():
+    global _dispatch_executor
+    if _dispatch_executor is None:
+        with _dispatch_lock:
+            if _dispatch_executor is None:
+                _dispatch_executor = ThreadPoolExecutor(max_workers=WEBHOOK_DISPATCH_CONCURRENCY,
+                                                        thread_name_prefix="webhook-dispatch")
+    return _dispatch_executor
+
+
+def _event_id(event):
+    return getattr(event, "webhook_event_id", None) or "-"
+
+
+# 1人分のイベントを届いた順に処理する。失敗しても残りのイベントは処理する
+def _dispatch_user_events(handler, events, destination):
+    timings = []
+    for event in events:
+        started = time.monotonic()
+        error = None
+        processed = False
+        try:
+            processed = dispatch_event_once(handler, event, destination)
+        except Exception as e:
+            logging.error(f"❌ Webhookイベント処理エラー（{_event_id(event)}）: {e}")
+            error = e
+        elapsed = time.monotonic() - started
+        if processed or error is not None:
+            observe("webhook.event", elapsed, error is not None)
+        timings.append({
+            "event_id": _event_id(event),
+            "user": event_user_key(event),
+            "type": event.__class__.__name__,
+            "ms": round(elapsed * 1000, 1),
+            "duplicate": not processed and error is None,
+            "error": error,
+        })
+    return timings
+
+
+# 1つのWebhookのイベントをユーザーごとに並列に処理し、全部終わってから戻る。
+# イベントごとの所要時間を受け取った順に返す。失敗したイベントがあれば、全部処理したあとで最初の例外を投げ直す
+def dispatch_events(handler, events, destination=None):
+    started = time.monotonic()
+    groups = {}
+    for event in events:
+        groups.setdefault(event_user_key(event), []).append(event)
+
+    if len(groups) <= 1 or WEBHOOK_DISPATCH_CONCURRENCY <= 1:
+        results = [_dispatch_user_events(handler, group, destination) for group in groups.values()]
+    else:
+        futures = [_get_dispatch_executor().submit(_dispatch_user_events, handler, group, destination)
+                   for group in groups.values()]
+        results = [future.result() for future in futures]
+
+    by_event = {id(event): timing for group, timings in zip(groups.values(), results)
+                for event, timing in zip(group, timings)}
+    timings = [by_event[id(event)] for event in events]
+    elapsed_ms = (time.monotonic() - started) * 1000
+    failed = [timing for timing in timings if timing["error"] is not None]
+    with _dispatch_lock:
+        _dispatch_stats["bodies"] += 1
+        _dispatch_stats["events"] += len(timings)
+        _dispatch_stats["failed"] += len(failed)
+        _dispatch_stats["duplicates"] += sum(timing["duplicate"] for timing in timings)
+        _dispatch_stats["parallel_bodies"] += len(groups) > 1
+        _dispatch_stats["max_users_per_body"] = max(_dispatch_stats["max_users_per_body"], len(groups))
+        _dispatch_stats["event_ms_total"] += sum(timing["ms"] for timing in timings)
+        _dispatch_stats["body_ms_total"] += elapsed_ms
+    if len(timings) > 1:
+        breakdown = " ".join(f"{timing['user'][-6:]}:{timing['ms']:.0f}ms" for timing in timings)
+        logging.info(f"⏱️ Webhook {len(timings)}件（{len(groups)}人）を {elapsed_ms:.0f}ms で処理 {breakdown}")
+    if failed:
+        raise failed[0]["error"]
+    return timings
+
+
+def get_dispatch_stats():
+    with _dispatch_lock:
+        stats = dict(_dispatch_stats)
+    event_ms_total = stats.pop("event_ms_total")
+    body_ms_total = stats.pop("body_ms_total")
+    stats["concurrency"] = WEBHOOK_DISPATCH_CONCURRENCY
+    stats["avg_event_ms"] = round(event_ms_total / stats["events"], 1) if stats["events"] else 0.0
+    stats["avg_body_ms"] = round(body_ms_total / stats["bodies"], 1) if stats["bodies"] else 0.0
+    # 1件ずつ順に処理した場合と比べて短くなった時間（イベントの合計 - Webhook全体）
+    stats["saved_ms_total"] = round(event_ms_total - body_ms_total, 1)
+    return stats
+
+
+class UserOrderedWorkerPool:
+    def __init__(self, process, workers=WEBHOOK_WORKERS, max_pending=WEBHOOK_QUEUE_SIZE):
+        self._process = process
+        self._workers = workers
+        self._max_pending = max_pending
+        self._cond = threading.Condition()
+        # ユーザー → 未処理イベント。処理中のユーザーは _ready に入れない
+        self._pending = {}
+        self._ready = deque()
+        self._active_users = set()
+        self._pending_count = 0
+        self._busy = 0
+        self._busy_seconds = 0.0
+        self._started_at = None
+        self._stats = {"enqueued": 0, "processed": 0, "failed": 0, "rejected": 0}
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._started_at = time.monotonic()
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # 積めなければ False（キューが満杯）
+    def submit(self, user_key, item):
+        return self.submit_many([(user_key, item)])
+
+    # [(ユーザー, イベント), ...] をまとめて積む。全部入る空きがなければ1件も積まずに False
+    def submit_many(self, entries):
+        with self._cond:
+            if self._pending_count + len(entries) > self._max_pending:
+                self._stats["rejected"] += len(entries)
+                return False
+            for user_key, item in entries:
+                queue = self._pending.setdefault(user_key, deque())
+                queue.append(item)
+                self._pending_count += 1
+                self._stats["enqueued"] += 1
+                if user_key not in self._active_users and len(queue) == 1:
+                    self._ready.append(user_key)
+                    self._cond.notify()
+            return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                user_key = self._ready.popleft()
+                item = self._pending[user_key].popleft()
+                self._active_users.add(user_key)
+                self._pending_count -= 1
+                self._busy += 1
+
+            started = time.monotonic()
+            try:
+                self._process(item)
+                failed = False
+            except Exception as e:
+                logging.error(f"❌ Webhookイベント処理エラー: {e}")
+                failed = True
+            observe("webhook.event", time.monotonic() - started, failed)
+
+            with self._cond:
+                self._busy -= 1
+                self._busy_seconds += time.monotonic() - started
+                self._stats["failed" if failed else "processed"] += 1
+                self._active_users.discard(user_key)
+                if self._pending[user_key]:
+                    self._ready.append(user_key)
+                    self._cond.notify()
+                else:
+                    del self._pending[user_key]
+
+    def get_stats(self):
+        with self._cond:
+            uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+            stats = dict(self._stats)
+            stats.update({
+                "workers": self._workers,
+                "queue_depth": self._pending_count,
+                "queue_capacity": self._max_pending,
+                "waiting_users": len(self._pending),
+                "busy_workers": self._busy,
+                "utilisation": round(self._busy / self._workers, 3) if self._workers else 0.0,
+                "busy_ratio_since_start": round(self._busy_seconds / (uptime * self._workers), 3) if uptime and self._workers else 0.0,
+            })
+            return stats